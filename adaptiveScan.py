@@ -0,0 +1,266 @@
+''' 測定値に応じて点を追加する適応走査
+'''
+
+import logging
+import socket
+
+import numpy as np
+
+import program
+import scanOrder
+
+logger = logging.getLogger(__name__)
+
+MEASURE_TIMEOUT = 5.0       # socketMeasurement の応答待ち時間 [s]
+
+
+class socketMeasurement():
+    '''ローカルの測定サーバから測定値を受け取る measure コールバック
+
+    プロトコル（1行ずつ，UTF-8，LF 区切り）:
+        送信: "MEASURE <pos_x> <pos_y> <pos_z>"
+        受信: 測定値（float）。測定できなければ "nan"
+
+    接続は最初の呼び出しで開く。接続できないか，通信に失敗したら（応答待ちの
+    timeout を含む）警告を1回だけ出して無効にし，以降は None（測定できなかった）
+    を返す。点ごとに timeout 秒待つことはない。
+    '''
+
+    def __init__(self, port, host='localhost', timeout=MEASURE_TIMEOUT):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.sock = None
+        self.rfile = None
+        self.disabled = False
+
+    def __call__(self, param):
+        if self.disabled:
+            return None
+        try:
+            if self.sock is None:
+                self.sock = socket.create_connection(
+                        (self.host, self.port), timeout=self.timeout)
+                self.rfile = self.sock.makefile('r', encoding='utf-8')
+            self.sock.sendall(
+                    f"MEASURE {param['pos_x']} {param['pos_y']} {param['pos_z']}\n"
+                    .encode('utf-8'))
+            line = self.rfile.readline()
+            if line == '':
+                raise OSError("connection closed")
+        except OSError as e:
+            logger.warning("socketMeasurement: %s:%d: %s (measurement disabled)",
+                           self.host, self.port, e)
+            self.close()
+            self.disabled = True
+            return None
+        try:
+            return float(line)
+        except ValueError:
+            logger.warning("socketMeasurement: bad reply: %r", line)
+            return None
+
+    def close(self):
+        '''接続を閉じる'''
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+
+class adaptiveProgram(program.stageProgram):
+    '''粗い格子から始め，測定値の勾配が大きいところに点を追加するプログラム
+
+    最初は range_x, range_y, range_z の格子（ORDER_SERPENTINE2 の往復走査）だけを持つ。
+    各行の測定値は measure(param) で受け取る（measure() で呼び出す）。
+    すべての行を測り終えて refine() を呼ぶと，格子の軸方向に隣り合う
+    測定済みの2点で |値の差| / 距離 が threshold を超えるところについて，
+    その2点を辺に持つ格子のセルを半分の間隔に分割する点を追加する。
+    これを max_level 回まで繰り返すので，最も細かいところの
+    間隔は step / 2**max_level になる。
+    追加した点は現在位置から移動時間の短い順（最近傍法 + 2-opt）に並べて
+    末尾に加える。tick1 は最初の格子ではラインごと，追加した点では
+    段階ごとに反転する。
+
+    行ごとの格子番号（keys）と測定値（measured）を data と並べて持つので，
+    行の編集（setValues() など）と並べ替えはできない（editable が False）。
+    '''
+
+    def __init__(self, range_x, range_y, range_z, max_level=2, threshold=1.0,
+                 measure=None, repetitions=1, settling_time=1.0, model=None):
+        super().__init__()
+        self.max_level = int(max_level)
+        self.threshold = float(threshold)
+        self.measure_func = measure
+        self.model = model
+        self.level = 0
+        self.repetitions = repetitions
+        self.settling_time = settling_time
+        ranges = [list(r) + [1.0] * (3 - len(r))
+                  for r in (range_x, range_y, range_z)]
+        self.origin = np.array([r[0] for r in ranges], dtype=float)
+        # 最も細かい段階の格子の間隔と点数
+        self.unit = np.array([r[2] for r in ranges], dtype=float) / 2 ** self.max_level
+        counts = [len(np.arange(r[0], r[1] + r[2], r[2])) for r in ranges]
+        self.shape = np.array([(n - 1) * 2 ** self.max_level + 1 for n in counts])
+
+        self.generateGridPosition(
+                ranges[0], ranges[1], ranges[2], repetitions, settling_time,
+                order=scanOrder.ORDER_SERPENTINE2)
+        self.gen_condition.update(
+                {'adaptive': True, 'max_level': self.max_level,
+                 'threshold': self.threshold})
+        self.keys = self.latticeKeys(self.positions())
+        self.measured = np.full(len(self.data), np.nan)
+        self.level_start = 0        # 今の段階の最初の行
+        self.editable = False
+
+    def latticeKeys(self, positions):
+        '''位置を最も細かい格子の番号（1つの整数）にする'''
+        idx = np.rint((positions - self.origin) / self.unit).astype(np.int64)
+        return np.ravel_multi_index(idx.T, self.shape)
+
+    def measure(self, idx):
+        '''idx 行目を measure コールバックで測定し，値を記録する'''
+        if self.measure_func is None:
+            return None
+        value = self.measure_func(self.paramByIndex(idx))
+        self.setMeasurement(idx, value)
+        return value
+
+    def setMeasurement(self, idx, value):
+        '''idx 行目の測定値を記録する（None は測定できなかったものとする）'''
+        self.measured[idx] = np.nan if value is None else value
+
+    @property
+    def done(self):
+        '''これ以上細かくしないか'''
+        return self.level >= self.max_level
+
+    def refinementPoints(self):
+        '''今の段階の点とその隣の点から，追加する点の格子番号を求める'''
+        # 今の段階の点は親の点から 2**(max_level - level) 目盛り離れている
+        spacing = 2 ** (self.max_level - self.level)
+        order = np.argsort(self.keys)
+        sorted_keys = self.keys[order]
+        new_rows = np.arange(self.level_start, len(self.data))
+        idx = np.stack(np.unravel_index(self.keys[new_rows], self.shape), axis=1)
+        axes = [ax for ax in range(3) if self.shape[ax] > 1]
+        found = []
+        for ax in axes:
+            for sign in (1, -1):
+                nb = idx.copy()
+                nb[:, ax] += sign * spacing
+                valid = (nb[:, ax] >= 0) & (nb[:, ax] < self.shape[ax])
+                nb_keys = np.ravel_multi_index(nb[valid].T, self.shape)
+                pos = np.searchsorted(sorted_keys, nb_keys)
+                pos = np.minimum(pos, len(sorted_keys) - 1)
+                hit = sorted_keys[pos] == nb_keys
+                rows_a = new_rows[valid][hit]
+                rows_b = order[pos[hit]]
+                distance = spacing * self.unit[ax]
+                gradient = np.abs(self.measured[rows_a] - self.measured[rows_b]) / distance
+                steep = gradient > self.threshold      # NaN は False
+                mid = (idx[valid][hit][steep] + nb[valid][hit][steep]) // 2
+                found.append(self.cellPoints(mid, ax, axes, spacing // 2))
+        if not found:
+            return np.zeros(0, dtype=np.int64)
+        keys = np.unique(np.concatenate(found))
+        # すでにある点は除く
+        return keys[~np.isin(keys, self.keys)]
+
+    def cellPoints(self, mid, ax, axes, half):
+        '''辺の中点 mid（ax 方向の辺）を共有するセルを half 間隔に分割する点
+
+        Returns:
+            numpy.ndarray: 格子番号（範囲の外の点は含まない）
+        '''
+        # ax 方向には -half, 0, +half，ほかの軸には -2half ... +2half
+        ranges = []
+        for a in range(3):
+            if a == ax:
+                ranges.append(np.arange(-1, 2) * half)
+            elif a in axes:
+                ranges.append(np.arange(-2, 3) * half)
+            else:
+                ranges.append(np.zeros(1, dtype=np.int64))
+        offsets = np.stack(np.meshgrid(*ranges, indexing='ij'), axis=-1).reshape(-1, 3)
+        points = (mid[:, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 3)
+        valid = np.all((points >= 0) & (points < self.shape), axis=1)
+        return np.ravel_multi_index(points[valid].T, self.shape)
+
+    def refine(self, start=None):
+        '''次の段階の点を追加し，追加した行数を返す
+
+        Args:
+            start (list): 現在のステージ位置 [mm]（並べ替えの始点）
+        '''
+        if self.done:
+            return 0
+        keys = self.refinementPoints()
+        self.level += 1
+        if len(keys) == 0:
+            logger.info("adaptiveProgram.refine(): level %d: no points", self.level)
+            # 追加する点がなければそれ以上細かくしない
+            self.level = self.max_level
+            return 0
+        idx = np.stack(np.unravel_index(keys, self.shape), axis=1)
+        positions = self.origin + idx * self.unit
+        if start is None:
+            start = self.positions()[-1]
+        perm = self.travelOrder(positions, np.asarray(start, dtype=float))
+        positions = positions[perm]
+        rows = np.zeros(len(positions), dtype=program.PROGRAM_DTYPE)
+        for ax, colname in enumerate(program.POSITION_COLUMNS):
+            rows[colname] = positions[:, ax]
+        rows['repetitions'] = self.repetitions
+        rows['settling_time'] = self.settling_time
+        if self.level % 2 == 1:
+            rows['ticks'] |= np.uint8(1 << program.tickBit('tick1'))
+        self.level_start = len(self.data)
+        self.data = np.concatenate([self.data, rows])
+        self.keys = np.concatenate([self.keys, keys[perm]])
+        self.measured = np.concatenate([self.measured, np.full(len(rows), np.nan)])
+        logger.info("adaptiveProgram.refine(): level %d: %d points",
+                    self.level, len(rows))
+        return len(rows)
+
+    def travelOrder(self, positions, start):
+        '''start から始めて移動時間の短い順に並べる'''
+        if len(positions) + 1 > scanOrder.NEAREST_MAX_POINTS:
+            return scanOrder.pointOrder(positions, scanOrder.ORDER_HILBERT)
+        model = self.model
+        if model is None:
+            import motionModel
+            model = motionModel.stageMotionModel()
+        # 現在位置を先頭に加えて並べ，最後に取り除く
+        points = np.vstack([start, positions])
+        order = scanOrder.twoOpt(
+                points, scanOrder.nearestNeighbourOrder(points, model), model)
+        return order[1:] - 1
+
+
+def test():
+    '''テストコード（円形の試料の縁を細かく測る）'''
+    logging.basicConfig(level=logging.INFO)
+
+    def measure(param):
+        r = np.hypot(param['pos_x'] - 10, param['pos_y'] - 10)
+        return 1.0 if r < 6 else 0.0
+
+    prog = adaptiveProgram([0, 20, 2], [0, 20, 2], [0, 0], max_level=3,
+                           threshold=0.2, measure=measure)
+    row = 0
+    while True:
+        while row < len(prog):
+            prog.measure(row)
+            row += 1
+        if prog.refine() == 0:
+            break
+    fine = len(np.arange(0, 20.25, 0.25)) ** 2
+    print(f"{len(prog)} points (uniform grid at the finest step: {fine})")
+    print(f"travel {scanOrder.travelTimes(prog.positions()).sum():.0f} s")
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,495 @@
+''' ステージの asyncio トランスポート
+'''
+
+import asyncio
+import logging
+import threading
+
+import stage
+import responseFramer
+
+logger = logging.getLogger(__name__)
+
+# コマンドの優先度（小さいほど優先）
+PRIORITY_EMERGENCY = 0    # L: 停止。待ち行列も送出窓も飛び越して即送出
+PRIORITY_NORMAL = 1       # A:, G:, O:, H:, R: など
+PRIORITY_POLL = 2         # Q:, !: の状態問い合わせ
+
+PRIORITY_NAMES = {
+        PRIORITY_EMERGENCY: 'emergency',
+        PRIORITY_NORMAL: 'normal',
+        PRIORITY_POLL: 'poll',
+        }
+
+
+def commandPriority(cmd):
+    '''コマンド文字列から優先度を決める'''
+    if cmd.startswith('L:'):
+        return PRIORITY_EMERGENCY
+    if cmd.startswith('Q:') or cmd.startswith('!:'):
+        return PRIORITY_POLL
+    return PRIORITY_NORMAL
+
+
+class asyncStage():
+    ''' stage.stage を asyncio で操作するクラス
+
+    シリアルポートの入出力は専用スレッドで回るイベントループが担当する。
+    コマンドはすべて await でき，応答を待たずに複数のコマンドを
+    続けて発行できる（応答は送出順に対応づける）。
+
+    発行されたコマンドは優先度付きの待ち行列に入り，ループ内の
+    ディスパッチャが max_in_flight 個を上限にポートへ送出する。
+    停止（L:）は待ち行列と上限を無視して直ちに送出され，
+    状態問い合わせ（Q:, !:）は他のコマンドより後回しになる。
+
+    start() 後は stage.stage.sendCommand もこのトランスポートを経由するので，
+    同期 API と非同期 API を混在させてもポートの取り合いは起きない。
+
+    Qt からは submit() でコルーチンを投入し，返ってきた
+    concurrent.futures.Future の完了コールバックでシグナルを emit する。
+    シグナルはスレッドをまたぐので GUI スレッドのキューに積まれる。
+    '''
+    POLL_INTERVAL = 0.005   # fileno() が使えない環境での受信ポーリング間隔 [s]
+    DEFAULT_MAX_IN_FLIGHT = 1
+
+    def __init__(self, stg, loop=None, max_in_flight=DEFAULT_MAX_IN_FLIGHT):
+        '''
+        Parameters
+        ----------
+        stg: stage.stage
+            openSerial 済みのステージ
+        loop: asyncio.AbstractEventLoop or None
+            None なら専用スレッドでイベントループを起動する
+        max_in_flight: int
+            応答待ちのまま送出してよいコマンド数の上限
+        '''
+        self.stage = stg
+        self.loop = loop
+        self.own_loop = loop is None
+        self.thread = None
+        self.framer = responseFramer.responseFramer()
+        self.expire_handle = None
+        self.poll_task = None
+        self.use_reader = False
+        self.max_in_flight = max_in_flight
+        self.queue = None
+        self.window = None
+        self.window_holders = set()
+        self.dispatch_task = None
+        self.seq = 0
+        self.resetQueueStats()
+
+    def resetQueueStats(self):
+        '''待ち行列の統計をクリアする'''
+        self.queue_stats = {
+                'max_depth': 0,
+                'count': {p: 0 for p in PRIORITY_NAMES},
+                'wait_total': {p: 0.0 for p in PRIORITY_NAMES},
+                'wait_max': {p: 0.0 for p in PRIORITY_NAMES},
+                }
+
+    def queueDepth(self):
+        '''送出待ちのコマンド数'''
+        if self.queue is None:
+            return 0
+        return self.queue.qsize()
+
+    def queueStats(self):
+        '''待ち行列の統計
+
+        Return
+        ------
+        stats: dict
+            depth, in_flight, max_depth と，優先度名ごとの
+            count, wait_mean, wait_max（送出までの待ち時間 [s]）
+        '''
+        stats = {
+                'depth': self.queueDepth(),
+                'in_flight': len(self.framer.pending),
+                'max_depth': self.queue_stats['max_depth'],
+                }
+        for p, name in PRIORITY_NAMES.items():
+            count = self.queue_stats['count'][p]
+            wait_total = self.queue_stats['wait_total'][p]
+            stats[name] = {
+                    'count': count,
+                    'wait_mean': wait_total / count if count > 0 else 0.0,
+                    'wait_max': self.queue_stats['wait_max'][p],
+                    }
+        return stats
+
+    def isRunning(self):
+        '''トランスポートが動作中かどうか'''
+        return self.stage.transport is self
+
+    def start(self):
+        ''' イベントループを起動し，stage に接続する '''
+        if self.isRunning():
+            return
+        if self.own_loop:
+            self.loop = asyncio.new_event_loop()
+            self.thread = threading.Thread(
+                    target=self.loop.run_forever,
+                    name='asyncStage', daemon=True)
+            self.thread.start()
+        asyncio.run_coroutine_threadsafe(self._attach(), self.loop).result()
+        self.stage.transport = self
+        logger.debug("asyncStage.start(): %s", self.stage.serport)
+
+    def close(self):
+        ''' stage から切り離し，イベントループを停止する '''
+        if not self.isRunning():
+            return
+        self.stage.transport = None
+        asyncio.run_coroutine_threadsafe(self._detach(), self.loop).result()
+        logger.debug("asyncStage.close(): queue stats: %s", self.queueStats())
+        if self.own_loop:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+            self.loop = None
+        logger.debug("asyncStage.close()")
+
+    async def _attach(self):
+        '''受信の監視を開始する（ループ内で実行）'''
+        if self.stage.phantom_port is True:
+            return
+        self.queue = asyncio.PriorityQueue()
+        self.window = asyncio.Semaphore(self.max_in_flight)
+        self.dispatch_task = self.loop.create_task(self._dispatchLoop())
+        try:
+            self.loop.add_reader(self.stage.ser.fileno(), self._onReadable)
+            self.use_reader = True
+        except (AttributeError, NotImplementedError, OSError):
+            # Windows など fileno() が使えないときはポーリング
+            self.use_reader = False
+            self.poll_task = self.loop.create_task(self._pollLoop())
+
+    async def _detach(self):
+        '''受信の監視を終了し，未完了の要求をキャンセルする（ループ内で実行）'''
+        if self.use_reader:
+            self.loop.remove_reader(self.stage.ser.fileno())
+            self.use_reader = False
+        if self.poll_task is not None:
+            self.poll_task.cancel()
+            self.poll_task = None
+        if self.dispatch_task is not None:
+            self.dispatch_task.cancel()
+            self.dispatch_task = None
+            while not self.queue.empty():
+                for fut in self.queue.get_nowait()[3]:
+                    fut.cancel()
+        for req in self.framer.pending:
+            req.token.cancel()
+        self.framer.clear()
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        self.window_holders.clear()
+
+    async def _dispatchLoop(self):
+        '''待ち行列から優先度順にコマンドを取り出して送出する'''
+        while True:
+            await self.window.acquire()
+            entry = await self.queue.get()
+            await self._waitResync()
+            futs = entry[3]
+            if futs[-1].done():
+                # 送出前にキャンセルされたもの
+                self.window.release()
+                continue
+            self.window_holders.add(futs[-1])
+            self._write(entry)
+
+    async def _waitResync(self):
+        '''応答の打ち切りのあと，再同期が終わるまで送出を待つ'''
+        while self.framer.resyncing(self.loop.time()):
+            await asyncio.sleep(self.framer.resync_until - self.loop.time())
+
+    def _write(self, entry):
+        '''コマンド（列）をまとめてポートに書き出し，応答待ちに登録する'''
+        prio, _, data, futs, t_enqueued, timeout = entry
+        now = self.loop.time()
+        wait = now - t_enqueued
+        self.queue_stats['count'][prio] += 1
+        self.queue_stats['wait_total'][prio] += wait
+        self.queue_stats['wait_max'][prio] = max(
+                self.queue_stats['wait_max'][prio], wait)
+        reqs = [self.framer.expect(cmd, now, timeout, token=fut)
+                for cmd, fut in zip(responseFramer.splitCommands(data), futs)]
+        self.stage.ser.write(data)
+        write_time = self.loop.time() - now
+        for req in reqs:
+            req.write_time = write_time
+        self.stage.countIO(len(futs), len(data), 0)
+        self._scheduleExpire()
+
+    def _scheduleExpire(self):
+        '''最も早い締切に打ち切り処理を予約する'''
+        if self.expire_handle is not None:
+            self.expire_handle.cancel()
+            self.expire_handle = None
+        deadline = self.framer.nextDeadline()
+        if deadline is not None:
+            self.expire_handle = self.loop.call_at(deadline, self._onExpire)
+
+    def _onExpire(self):
+        '''締切を過ぎた要求を空文字列の応答で完了させる'''
+        self.expire_handle = None
+        expired = self.framer.expire(self.loop.time())
+        if expired:
+            # 遅れて届く応答を次の要求の応答と取り違えないように捨てる
+            self.stage.ser.reset_input_buffer()
+        self._complete(expired)
+        self._scheduleExpire()
+
+    def _complete(self, reqs):
+        '''応答の得られた（または打ち切られた）要求の Future を完了させる'''
+        self.stage.recordTransactions(reqs)
+        for req in reqs:
+            self._release(req.token)
+            if not req.token.done():
+                req.token.set_result(req.reply)
+
+    def _release(self, fut):
+        '''応答済み（またはタイムアウト）のコマンドの送出枠を返す'''
+        if fut in self.window_holders:
+            self.window_holders.remove(fut)
+            self.window.release()
+
+    def _onReadable(self):
+        '''シリアルポートが読み出し可能になったとき'''
+        n = self.stage.ser.in_waiting
+        if n > 0:
+            self._received(self.stage.ser.read(n))
+
+    async def _pollLoop(self):
+        '''受信ポーリング'''
+        while True:
+            self._onReadable()
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+    def _received(self, data):
+        '''受信データから応答を切り出し，送出順に要求へ割り当てる'''
+        self.stage.countIO(0, 0, len(data))
+        self._complete(self.framer.feed(data, self.loop.time()))
+        self._scheduleExpire()
+
+    async def sendCommand(self, cmd, timeout=None):
+        '''コマンドを送出し，応答を待つ
+
+        応答を待たずに次の sendCommand を発行してよい。
+        送出順は commandPriority() による優先度順（同じ優先度なら発行順）。
+
+        Parameter
+        ----------
+        cmd: string
+            送出コマンド
+        timeout: float or None
+            送出後の応答待ち時間 [s]。None なら responseFramer.commandTimeout()
+
+        Return
+        ------
+        status: string
+            ステージからの返り値。タイムアウトのときは空文字列
+        '''
+        logger.debug("asyncStage.sendCommand: %s", cmd)
+        bufs = await self.sendCommands([cmd], timeout)
+        return bufs[0]
+
+    async def sendCommands(self, cmds, timeout=None):
+        '''複数のコマンドを続けて書き出し，応答をまとめて待つ
+
+        コマンド列は1回の書き込みで送出され，応答は順に対応づけられる。
+        待ち行列上はひとまとまりで扱い，優先度は列中で最も高いものになる。
+
+        Parameter
+        ----------
+        cmds: list of string
+            送出コマンドの列
+        timeout: float or None
+            送出後の各応答の待ち時間 [s]。None ならコマンドごとに
+            responseFramer.commandTimeout() で決まる
+
+        Return
+        ------
+        status: list of string
+            各コマンドへの返り値。タイムアウトしたものは空文字列
+        '''
+        if self.stage.phantom_port is True:
+            return [self.stage.phantomReply(cmd) for cmd in cmds]
+        data = b''.join((cmd + '\r\n').encode('utf-8') for cmd in cmds)
+        prio = min(commandPriority(cmd) for cmd in cmds)
+        return await self.sendEncoded(data, len(cmds), prio, timeout)
+
+    async def sendEncoded(self, data, ncommands, prio=PRIORITY_NORMAL,
+                          timeout=None):
+        '''エンコード済みのコマンド列を送出し，応答をまとめて待つ
+
+        programCompiler で事前に生成したバイト列をそのまま送るときに使う。
+
+        Parameter
+        ----------
+        data: bytes
+            CRLF 区切りのコマンド列
+        ncommands: int
+            data に含まれるコマンド数（= 期待する応答数）
+        prio: int
+            待ち行列での優先度
+        timeout: float or None
+            送出後の各応答の待ち時間 [s]。None ならコマンドごとに
+            responseFramer.commandTimeout() で決まる
+
+        Return
+        ------
+        status: list of string
+            各コマンドへの返り値。タイムアウトしたものは空文字列
+        '''
+        if self.stage.phantom_port is True:
+            return ['OK'] * ncommands
+        futs = [self.loop.create_future() for _ in range(ncommands)]
+        self.seq += 1
+        entry = (prio, self.seq, data, futs, self.loop.time(), timeout)
+        if prio == PRIORITY_EMERGENCY:
+            if self.framer.resyncing(self.loop.time()):
+                # 再同期の終わりを待たない。応答を遅れた応答として捨てないように，
+                # 受信済みのデータを捨てて再同期を打ち切ってから送る
+                self.stage.ser.reset_input_buffer()
+                self.framer.endResync()
+            self._write(entry)
+        else:
+            self.queue.put_nowait(entry)
+            self.queue_stats['max_depth'] = max(
+                    self.queue_stats['max_depth'], self.queue.qsize())
+        # 締切は送出時に responseFramer が設定し，過ぎれば '' で完了する
+        await asyncio.shield(futs[-1])
+        return [fut.result() for fut in futs]
+
+    def submit(self, coro):
+        '''コルーチンをイベントループに投入する（任意のスレッドから）
+
+        Return
+        ------
+        future: concurrent.futures.Future
+        '''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    def request(self, cmd):
+        '''コマンドを送出し応答を待つ（同期版）
+
+        stage.stage.sendCommand から呼ばれる。ループのスレッドからは呼べない。
+        '''
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("asyncStage.request() called in the event loop")
+        return self.submit(self.sendCommand(cmd)).result()
+
+    def requestMany(self, cmds):
+        '''コマンド列を送出し応答を待つ（同期版）
+
+        stage.stage.sendCommands から呼ばれる。
+        '''
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("asyncStage.requestMany() called in the event loop")
+        return self.submit(self.sendCommands(cmds)).result()
+
+    def requestEncoded(self, data, ncommands):
+        '''エンコード済みのコマンド列を送出し応答を待つ（同期版）
+
+        stage.stage.sendEncoded から呼ばれる。
+        '''
+        if threading.current_thread() is self.thread:
+            raise RuntimeError("asyncStage.requestEncoded() called in the event loop")
+        return self.submit(self.sendEncoded(data, ncommands)).result()
+
+    async def getInfo(self):
+        ''' ステージの内部情報を取得する（stage.getInfo 参照）'''
+        if self.stage.phantom_port is not True:
+            ver, buf_pw, buf_sw = await self.sendCommands(
+                    ["?:V", "?:PW", "?:SW"])
+            self.stage.rom_version = ver
+            self.stage.setInfo(buf_pw, buf_sw)
+
+    async def moveTo(self, pos_x, pos_y, pos_z):
+        ''' 指定した位置に移動する
+
+        A: と G: は1回の書き込みで続けて送出し，各コマンドの応答を返す
+        '''
+        logger.debug("asyncStage.moveTo: %f %f %f", pos_x, pos_y, pos_z)
+        bufs = await self.sendCommands(
+                [self.stage.moveToCommand(pos_x, pos_y, pos_z), "G:"])
+        self.stage.last_move_to = [pos_x, pos_y, pos_z]
+        return bufs
+
+    async def outputAndMoveTo(self, val, pos_x, pos_y, pos_z):
+        ''' I/O出力の一括設定と移動を1往復で行い，各コマンドの応答を返す
+        （stage.outputAndMoveTo 参照）'''
+        logger.debug("asyncStage.outputAndMoveTo: %04x %f %f %f",
+                     val, pos_x, pos_y, pos_z)
+        self.stage.io_out = val & 0b1111
+        bufs = await self.sendCommands([
+                self.stage.outputCommand(self.stage.io_out),
+                self.stage.moveToCommand(pos_x, pos_y, pos_z),
+                "G:"])
+        self.stage.last_move_to = [pos_x, pos_y, pos_z]
+        return bufs
+
+    async def outputAndMoveEncoded(self, val, move_data, pos):
+        ''' I/O出力の一括設定とエンコード済みの移動コマンドを1往復で送出し，
+        各コマンドの応答を返す（stage.outputAndMoveEncoded 参照）'''
+        self.stage.io_out = val & 0b1111
+        bufs = await self.sendEncoded(
+                stage.OUTPUT_COMMANDS[self.stage.io_out] + move_data, 3)
+        self.stage.last_move_to = list(pos)
+        return bufs
+
+    async def stop(self):
+        ''' ステージの移動を停止する '''
+        await self.sendCommand("L:W")
+
+    async def query(self):
+        '''現在の状態を問い合わせる'''
+        ret = await self.sendCommand("Q:")
+        return self.stage.parseQuery(ret)
+
+    async def resetOrigin(self):
+        '''電気（論理）原点のリセット（応答を返す）'''
+        return await self.sendCommand("R:W")
+
+    async def gotoMechanicalOrigin(self):
+        '''機械原点復帰（応答を返す）'''
+        return await self.sendCommand("H:W")
+
+    async def isReady(self):
+        '''Readyかどうか'''
+        status = await self.sendCommand("!:")
+        return self.stage.parseIsReady(status)
+
+    async def digitalWriteBulk(self, val:int=0):
+        '''I/Oコネクタに出力状態を一括設定する（応答を返す）'''
+        logger.info("asyncStage.digitalWriteBulk(): val:%04x", val)
+        self.stage.io_out = val & 0b1111
+        return await self.sendCommand(self.stage.outputCommand(self.stage.io_out))
+
+    async def digitalWrite(self, ch:int, on_off:int):
+        '''I/Oコネクタへの出力状態を設定する（stage.digitalWrite 参照）'''
+        o_pattern = self.stage.outputPattern(ch, on_off)
+        if o_pattern is None:
+            return None
+        return await self.digitalWriteBulk(o_pattern)
+
+
+def test():
+    '''テストコード（ファントムポート）'''
+    logging.basicConfig(level=logging.DEBUG)
+    stg = stage.stage()
+    stg.openSerial('Phantom Port')
+    astg = asyncStage(stg)
+    astg.start()
+    print(astg.submit(astg.query()).result())
+    print(stg.isReady())
+    astg.close()
+
+
+if __name__ == '__main__':
+    test()
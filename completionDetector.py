@@ -0,0 +1,127 @@
+''' 移動完了の検出
+'''
+
+import logging
+
+import motionModel
+
+logger = logging.getLogger(__name__)
+
+POLL_QUERY = 'Q:'       # 位置も取得する問い合わせ
+POLL_STATUS = '!:'      # Busy/Ready だけの軽い問い合わせ
+
+
+class completionDetector():
+    '''移動の終了時刻を予測して問い合わせの間隔を決める
+
+    移動距離と駆動モデル（motionModel）から終了時刻を予測し，
+    終了まで間があるうちは残り時間に比例した疎な間隔で Q: を送り
+    （カウンタ表示の更新を兼ねる），終了予測の近くでは短い間隔で !: を送る。
+    予測の立たない移動（機械原点復帰など）は一定間隔で Q: を送る。
+
+    Ready を検出した時点で，直前の Busy 応答との間隔を
+    検出遅れの上限（ready latency）として記録する。
+    '''
+    MIN_INTERVAL = 0.02         # 終了予測付近での問い合わせ間隔 [s]
+    MAX_INTERVAL = 0.25         # 最大の問い合わせ間隔 [s]
+    SPARSE_FRACTION = 0.5       # 終了前は残り時間のこの割合だけ待つ
+    PREDICTION_MARGIN = 0.01    # 予測に加える余裕 [s]
+
+    def __init__(self, stg, model=None):
+        self.stage = stg
+        self.model = model      # motionModel.stageMotionModel。None なら stage の設定から
+        self.t_start = None
+        self.t_predicted = None
+        self.t_last_busy = None
+        self.npolls = 0
+        self.last_latency = None
+        self.resetStats()
+
+    def resetStats(self):
+        '''統計をクリアする'''
+        self.nmoves = 0
+        self.total_polls = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+        self.error_total = 0.0
+        self.npredicted = 0
+
+    def startMove(self, start, target, now):
+        '''移動の開始を通知する
+
+        Args:
+            start (list or None): 移動前の位置 [mm]。None なら予測しない
+            target (list or None): 移動先の位置 [mm]。None なら予測しない
+            now (float): 現在時刻 [s]
+        '''
+        self.t_start = now
+        self.t_last_busy = now
+        self.npolls = 0
+        if start is None or target is None:
+            self.t_predicted = None
+        else:
+            if self.model is None:
+                t_move = motionModel.moveTime(self.stage, start, target)
+            else:
+                t_move = self.model.moveTime(start, target)
+            self.t_predicted = now + t_move + self.PREDICTION_MARGIN
+        logger.debug("completionDetector.startMove(): predicted %s",
+                     None if self.t_predicted is None
+                     else f"{self.t_predicted - now:.3f} s")
+
+    def nextPoll(self, now):
+        '''次の問い合わせまでの時間と，使うコマンドを返す
+
+        Returns:
+            (float, str): 待ち時間 [s] と POLL_QUERY または POLL_STATUS
+        '''
+        if self.t_predicted is None:
+            return self.MAX_INTERVAL, POLL_QUERY
+        remaining = self.t_predicted - now
+        if remaining > 2 * self.MIN_INTERVAL:
+            delay = min(max(remaining * self.SPARSE_FRACTION,
+                            self.MIN_INTERVAL), self.MAX_INTERVAL)
+            return delay, POLL_QUERY
+        return max(remaining, self.MIN_INTERVAL), POLL_STATUS
+
+    def reportStatus(self, ready, now):
+        '''問い合わせの結果を通知する
+
+        Args:
+            ready (bool): Ready であったか
+            now (float): 応答を受け取った時刻 [s]
+        '''
+        self.npolls += 1
+        if not ready:
+            self.t_last_busy = now
+            return
+        if self.t_start is None:
+            return
+        self.last_latency = now - self.t_last_busy
+        self.nmoves += 1
+        self.total_polls += self.npolls
+        self.latency_total += self.last_latency
+        self.latency_max = max(self.latency_max, self.last_latency)
+        if self.t_predicted is not None:
+            self.npredicted += 1
+            self.error_total += now - self.t_predicted
+        self.t_start = None
+
+    def stats(self):
+        '''移動あたりの統計
+
+        Return
+        ------
+        stats: dict
+            moves, polls_per_move, ready_latency_mean, ready_latency_max,
+            prediction_error_mean [s]
+        '''
+        n = max(self.nmoves, 1)
+        return {
+                'moves': self.nmoves,
+                'polls_per_move': self.total_polls / n,
+                'ready_latency_mean': self.latency_total / n,
+                'ready_latency_max': self.latency_max,
+                'prediction_error_mean':
+                    self.error_total / max(self.npredicted, 1),
+                }
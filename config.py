@@ -10,6 +10,8 @@ from socket import gethostname
 
 logger = logging.getLogger(__name__)
 
+APP_NAME = "shotControl"
+VENDER_NAME = "makutaga"
 DEFAULT_CONFIG_FILE = 'config.ini'
 DEFAULT_PARAMS = {
         'device_name': 'Unknown',
@@ -8,11 +8,13 @@ from PyQt5 import QtCore, QtGui
 from PyQt5.QtWidgets import QDialog, QMainWindow, QWidget, QApplication, QPushButton
 from PyQt5.QtWidgets import QDialogButtonBox, QVBoxLayout, QHBoxLayout
 from PyQt5.QtWidgets import QGridLayout
-from PyQt5.QtWidgets import QLabel, QRadioButton, QLineEdit
+from PyQt5.QtWidgets import QLabel, QRadioButton, QLineEdit, QComboBox, QCheckBox
 from PyQt5.QtWidgets import QFileDialog
 from PyQt5.QtCore import Qt
 
 import stage
+import scanOrder
+import surfaceRegion
 
 logger = logging.getLogger(__name__)
 
@@ -26,15 +28,25 @@ DEFAULT_PARAMS = {
         'y_start' : 100.0, 'y_stop' : 150.0, 'y_step' : 1.0,
         'z_start' : 30.0, 'z_stop' : 40.0, 'z_step' : 1.0,
         'settling_time' : 1.0,
-        'repetitions' : 1
+        'repetitions' : 1,
+        'order' : scanOrder.ORDER_RASTER,
+        'plane' : '',
+        'region' : surfaceRegion.REGION_NONE,
+        'region_params' : '',
+        'adaptive' : False,
+        'refine_levels' : 2,
+        'refine_threshold' : 1.0
         }
 
 class createProgramDialog(QDialog):
+    ESTIMATE_DELAY = 300     # 入力が止まってから見積もるまでの時間 [ms]
 
-    def __init__(self, parent=None):
+    def __init__(self, parent=None, estimator=None):
         super().__init__()
         self.mode = PROGRAM_MODE_CUBE
         self.params = {}
+        # estimator(params) は所要時間の見積りを文字列で返す
+        self.estimator = estimator
 
         logger.debug('createProgramDialog.__init__(): candidate_divice: %s')
         self.setWindowTitle("Create program")
@@ -47,7 +59,7 @@ class createProgramDialog(QDialog):
 
         self.label = QLabel('Dimension')
         self.rb_1d = QRadioButton('Line')
-        self.rb_2d = QRadioButton('Surface', enabled=False)
+        self.rb_2d = QRadioButton('Surface')
         self.rb_3d = QRadioButton('Cube')
 
         self.rb_1d.pressed.connect(self.rb_1d_selected)
@@ -94,6 +106,47 @@ class createProgramDialog(QDialog):
         self.le_repetitions = QLineEdit()
         layout_settling_time.addWidget(self.le_repetitions)
 
+        layout_order = QHBoxLayout()
+        layout_order.addWidget(QLabel("Scan order:"))
+        self.cb_order = QComboBox()
+        self.cb_order.addItems(scanOrder.ORDERS)
+        layout_order.addWidget(self.cb_order, 1)
+
+        # SURFACE のときだけ使う
+        layout_surface = QGridLayout()
+        layout_surface.addWidget(QLabel("Plane (3 points):"), 0, 0)
+        self.le_plane = QLineEdit()
+        self.le_plane.setPlaceholderText("x, y, z; x, y, z; x, y, z  (empty: z = z start)")
+        layout_surface.addWidget(self.le_plane, 0, 1, 1, 2)
+        layout_surface.addWidget(QLabel("Region:"), 1, 0)
+        self.cb_region = QComboBox()
+        self.cb_region.addItems(surfaceRegion.REGIONS)
+        layout_surface.addWidget(self.cb_region, 1, 1)
+        self.le_region = QLineEdit()
+        layout_surface.addWidget(self.le_region, 1, 2)
+        self.cb_region.currentTextChanged.connect(self.regionSelected)
+        self.enableSurfaceParams(False)
+
+        # CUBE のときだけ使う
+        layout_adaptive = QHBoxLayout()
+        self.chk_adaptive = QCheckBox("Adaptive refinement")
+        layout_adaptive.addWidget(self.chk_adaptive)
+        layout_adaptive.addWidget(QLabel("Levels:"))
+        self.le_refine_levels = QLineEdit()
+        layout_adaptive.addWidget(self.le_refine_levels)
+        layout_adaptive.addWidget(QLabel("Gradient threshold [/mm]:"))
+        self.le_refine_threshold = QLineEdit()
+        layout_adaptive.addWidget(self.le_refine_threshold)
+        self.chk_adaptive.toggled.connect(self.adaptiveToggled)
+
+        layout_estimate = QHBoxLayout()
+        layout_estimate.addWidget(QLabel("Estimated time:"))
+        self.lbl_estimate = QLabel('-')
+        layout_estimate.addWidget(self.lbl_estimate, 1)
+        self.estimate_timer = QtCore.QTimer()
+        self.estimate_timer.setSingleShot(True)
+        self.estimate_timer.timeout.connect(self.updateEstimate)
+
         layout_axes.addWidget(self.le_x_start, 1, 1)
         layout_axes.addWidget(self.le_x_stop, 1, 2)
         layout_axes.addWidget(self.le_x_step, 1, 3)
@@ -108,8 +161,23 @@ class createProgramDialog(QDialog):
         layout.addLayout(layout_rb)
         layout.addLayout(layout_axes)
         layout.addLayout(layout_settling_time)
+        layout.addLayout(layout_order)
+        layout.addLayout(layout_surface)
+        layout.addLayout(layout_adaptive)
+        layout.addLayout(layout_estimate)
         layout.addWidget(buttonbox)
 
+        for le in (self.le_x_start, self.le_x_stop, self.le_x_step,
+                   self.le_y_start, self.le_y_stop, self.le_y_step,
+                   self.le_z_start, self.le_z_stop, self.le_z_step,
+                   self.le_settling_time, self.le_repetitions,
+                   self.le_plane, self.le_region,
+                   self.le_refine_levels, self.le_refine_threshold):
+            le.textChanged.connect(self.requestEstimate)
+        self.cb_order.currentIndexChanged.connect(self.requestEstimate)
+        self.cb_region.currentIndexChanged.connect(self.requestEstimate)
+        self.chk_adaptive.toggled.connect(self.requestEstimate)
+
         self.le_x_start.setFocusPolicy(Qt.StrongFocus)
         self.le_x_start.setFocus()
 
@@ -119,38 +187,112 @@ class createProgramDialog(QDialog):
         self.le_x_step.setEnabled(True)
         self.le_y_step.setEnabled(False)
         self.le_z_step.setEnabled(False)
+        self.cb_order.setEnabled(False)
+        self.enableSurfaceParams(False)
         self.mode = PROGRAM_MODE_LINE
+        self.enableAdaptiveParams(False)
+        self.requestEstimate()
 
     def rb_2d_selected(self):
         logger.debug('createProgramDialog.rb_2d_selected()')
         self.le_x_step.setEnabled(True)
         self.le_y_step.setEnabled(True)
         self.le_z_step.setEnabled(False)
+        self.cb_order.setEnabled(True)
+        self.enableSurfaceParams(True)
         self.mode = PROGRAM_MODE_SURFACE
+        self.enableAdaptiveParams(False)
+        self.requestEstimate()
 
     def rb_3d_selected(self):
         logger.debug('createProgramDialog.rb_3d_selected()')
         self.le_x_step.setEnabled(True)
         self.le_y_step.setEnabled(True)
         self.le_z_step.setEnabled(True)
+        self.cb_order.setEnabled(True)
+        self.enableSurfaceParams(False)
         self.mode = PROGRAM_MODE_CUBE
+        self.enableAdaptiveParams(True)
+        self.requestEstimate()
+
+    def enableAdaptiveParams(self, enabled):
+        '''適応走査の入力欄の有効・無効'''
+        self.chk_adaptive.setEnabled(enabled)
+        self.adaptiveToggled(self.chk_adaptive.isChecked())
+
+    def adaptiveToggled(self, checked):
+        '''適応走査では走査順は選べない（往復走査から始める）'''
+        use = checked and self.chk_adaptive.isEnabled()
+        self.le_refine_levels.setEnabled(use)
+        self.le_refine_threshold.setEnabled(use)
+        self.cb_order.setEnabled(self.mode != PROGRAM_MODE_LINE and not use)
+
+    def enableSurfaceParams(self, enabled):
+        '''平面と領域の入力欄の有効・無効'''
+        self.le_plane.setEnabled(enabled)
+        self.cb_region.setEnabled(enabled)
+        self.le_region.setEnabled(
+                enabled and self.cb_region.currentText() != surfaceRegion.REGION_NONE)
+
+    def regionSelected(self, kind):
+        '''領域の種類に応じて入力欄の説明を変える'''
+        if kind == surfaceRegion.REGION_CIRCLE:
+            self.le_region.setPlaceholderText("cx, cy, r")
+        elif kind == surfaceRegion.REGION_POLYGON:
+            self.le_region.setPlaceholderText("x1, y1; x2, y2; x3, y3; ...")
+        else:
+            self.le_region.setPlaceholderText("")
+        self.le_region.setEnabled(
+                self.cb_region.isEnabled() and kind != surfaceRegion.REGION_NONE)
+
+    def requestEstimate(self):
+        '''入力が変わったら少し待ってから所要時間を見積もる'''
+        if self.estimator is not None:
+            self.estimate_timer.start(self.ESTIMATE_DELAY)
+
+    def updateEstimate(self):
+        '''入力中の条件で所要時間を見積もって表示する'''
+        try:
+            params = self.readParams()
+        except ValueError:
+            self.lbl_estimate.setText('-')
+            return
+        self.lbl_estimate.setText(self.estimator(params))
 
     def accept(self):
         logger.debug('createProgramDialog.accept()')
         super().accept()
-
-        self.params['mode'] = self.mode
-        self.params['x_start'] = float(self.le_x_start.text())
-        self.params['x_stop'] = float(self.le_x_stop.text())
-        self.params['x_step'] = float(self.le_x_step.text())
-        self.params['y_start'] = float(self.le_y_start.text())
-        self.params['y_stop'] = float(self.le_y_stop.text())
-        self.params['y_step'] = float(self.le_y_step.text())
-        self.params['z_start'] = float(self.le_z_start.text())
-        self.params['z_stop'] = float(self.le_z_stop.text())
-        self.params['z_step'] = float(self.le_z_step.text())
-        self.params['settling_time'] = float(self.le_settling_time.text())
-        self.params['repetitions'] = int(self.le_repetitions.text())
+        self.estimate_timer.stop()
+
+        self.params.update(self.readParams())
+
+    def readParams(self):
+        '''入力欄の値を params の形の辞書にする（不正な値は ValueError）'''
+        params = {}
+        params['mode'] = self.mode
+        params['x_start'] = float(self.le_x_start.text())
+        params['x_stop'] = float(self.le_x_stop.text())
+        params['x_step'] = float(self.le_x_step.text())
+        params['y_start'] = float(self.le_y_start.text())
+        params['y_stop'] = float(self.le_y_stop.text())
+        params['y_step'] = float(self.le_y_step.text())
+        params['z_start'] = float(self.le_z_start.text())
+        params['z_stop'] = float(self.le_z_stop.text())
+        params['z_step'] = float(self.le_z_step.text())
+        params['settling_time'] = float(self.le_settling_time.text())
+        params['repetitions'] = int(self.le_repetitions.text())
+        params['order'] = self.cb_order.currentText()
+        params['plane'] = self.le_plane.text()
+        params['region'] = self.cb_region.currentText()
+        params['region_params'] = self.le_region.text()
+        params['adaptive'] = self.chk_adaptive.isChecked()
+        params['refine_levels'] = int(self.le_refine_levels.text())
+        params['refine_threshold'] = float(self.le_refine_threshold.text())
+        if self.mode == PROGRAM_MODE_SURFACE:
+            # 書式の誤りはここで ValueError にする
+            surfaceRegion.parsePlane(params['plane'])
+            surfaceRegion.parseRegion(params['region'], params['region_params'])
+        return params
 
     def storeParamsToConfig(self, conf):
         for k in DEFAULT_PARAMS.keys():
@@ -172,16 +314,22 @@ class createProgramDialog(QDialog):
                     self.params[k] = int(conf[k])
                 elif isinstance(def_v, float) is True:
                     self.params[k] = float(conf[k])
+                elif isinstance(def_v, str) is True:
+                    self.params[k] = conf[k]
             else:
                 self.params[k] = def_v
 
     def setPlaceHolderFromParams(self):
+        # toggle() では pressed が出ないので *_selected も呼ぶ
         if self.params['mode'] == PROGRAM_MODE_LINE:
             self.rb_1d.toggle()
+            self.rb_1d_selected()
         elif self.params['mode'] == PROGRAM_MODE_SURFACE:
             self.rb_2d.toggle()
+            self.rb_2d_selected()
         elif self.params['mode'] == PROGRAM_MODE_CUBE:
             self.rb_3d.toggle()
+            self.rb_3d_selected()
 
         self.le_x_start.setText(str(self.params['x_start']))
         self.le_x_stop.setText(str(self.params['x_stop']))
@@ -197,6 +345,15 @@ class createProgramDialog(QDialog):
 
         self.le_settling_time.setText(str(self.params['settling_time']))
         self.le_repetitions.setText(str(self.params['repetitions']))
+        if self.params['order'] in scanOrder.ORDERS:
+            self.cb_order.setCurrentText(self.params['order'])
+        self.le_plane.setText(self.params['plane'])
+        if self.params['region'] in surfaceRegion.REGIONS:
+            self.cb_region.setCurrentText(self.params['region'])
+        self.le_region.setText(self.params['region_params'])
+        self.chk_adaptive.setChecked(self.params['adaptive'])
+        self.le_refine_levels.setText(str(self.params['refine_levels']))
+        self.le_refine_threshold.setText(str(self.params['refine_threshold']))
 
 class testWindow(QMainWindow):
     def __init__(self):
@@ -0,0 +1,319 @@
+''' ステージの駆動時間のモデル
+'''
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# 各軸の速度設定のデフォルト（SHOT-304GS の出荷時設定相当）
+DEFAULT_START_SPEED = 500       # 起動速度 [pps]
+DEFAULT_MAX_SPEED = 5000        # 最高速度 [pps]
+DEFAULT_ACCEL_TIME = 0.2        # 加減速時間 [s]
+
+# 補正値（calibration() のキー）を config に保存するときのキー
+CALIBRATION_CONFIG_KEYS = {
+        'time_scale': 'motion_time_scale',
+        'move_overhead': 'motion_move_overhead',
+        'step_overhead': 'motion_step_overhead',
+        }
+
+
+def trapezoidTime(npulses, start_speed, max_speed, accel_time):
+    '''台形駆動で npulses 移動するのにかかる時間 [s]
+
+    最高速度に届かない短い移動は三角駆動になる。
+    '''
+    npulses = abs(npulses)
+    if npulses == 0:
+        return 0.0
+    if accel_time <= 0 or max_speed <= start_speed:
+        return npulses / max_speed
+    accel = (max_speed - start_speed) / accel_time
+    d_accel = (start_speed + max_speed) / 2 * accel_time
+    if npulses >= 2 * d_accel:
+        return 2 * accel_time + (npulses - 2 * d_accel) / max_speed
+    v_peak = (start_speed ** 2 + accel * npulses) ** 0.5
+    return 2 * (v_peak - start_speed) / accel
+
+
+def trapezoidPosition(t, npulses, start_speed, max_speed, accel_time):
+    '''台形駆動の開始から t 秒後の移動量 [pulse]（符号は npulses に従う）'''
+    sign = 1 if npulses >= 0 else -1
+    n = abs(npulses)
+    t_total = trapezoidTime(n, start_speed, max_speed, accel_time)
+    if t >= t_total:
+        return npulses
+    if accel_time <= 0 or max_speed <= start_speed:
+        return sign * int(max_speed * t)
+    accel = (max_speed - start_speed) / accel_time
+    t_ramp = min(accel_time, t_total / 2)
+    d_ramp = start_speed * t_ramp + accel * t_ramp ** 2 / 2
+    if t < t_ramp:
+        d = start_speed * t + accel * t ** 2 / 2
+    elif t < t_total - t_ramp:
+        d = d_ramp + max_speed * (t - t_ramp)
+    else:
+        tr = t_total - t
+        d = n - (start_speed * tr + accel * tr ** 2 / 2)
+    return sign * int(min(d, n))
+
+
+def moveTime(stg, start, target):
+    '''start から target への移動にかかる時間の予測 [s]
+
+    各軸は同時に動くので，最も時間のかかる軸で決まる。
+
+    Args:
+        stg (stage.stage): 速度設定とパルス換算に使うステージ
+        start (list): 移動前の位置 [mm]
+        target (list): 移動先の位置 [mm]
+    '''
+    return stageMotionModel.fromStage(stg).moveTime(start, target)
+
+
+def trapezoidTimes(npulses, start_speed, max_speed, accel_time):
+    '''trapezoidTime の配列版
+
+    Args:
+        npulses (numpy.ndarray): 移動量 [pulse]
+
+    Returns:
+        numpy.ndarray: 移動時間 [s]
+    '''
+    n = np.abs(np.asarray(npulses, dtype=float))
+    if accel_time <= 0 or max_speed <= start_speed:
+        return n / max_speed
+    accel = (max_speed - start_speed) / accel_time
+    d_accel = (start_speed + max_speed) / 2 * accel_time
+    t_full = 2 * accel_time + (n - 2 * d_accel) / max_speed
+    v_peak = np.sqrt(start_speed ** 2 + accel * n)
+    t_triangle = 2 * (v_peak - start_speed) / accel
+    return np.where(n >= 2 * d_accel, t_full, t_triangle)
+
+
+class axisModel():
+    '''1軸の駆動モデル
+
+    速度設定（起動速度・最高速度・加減速時間）と，
+    コマンド上のパルス換算 pulses_per_mm を持つ。
+    resolution はコントローラから得た distance_per_pulse / divisions による
+    1パルスあたりの実移動量 [um]。
+    '''
+
+    def __init__(self, start_speed=DEFAULT_START_SPEED,
+                 max_speed=DEFAULT_MAX_SPEED, accel_time=DEFAULT_ACCEL_TIME,
+                 pulses_per_mm=500, distance_per_pulse=1.0, divisions=2):
+        self.start_speed = start_speed
+        self.max_speed = max_speed
+        self.accel_time = accel_time
+        self.pulses_per_mm = pulses_per_mm
+        self.resolution = distance_per_pulse / max(divisions, 1)
+
+    def toPulses(self, length_mm):
+        '''パルスに換算（stage.toPulses と同じく 0 方向へ切り捨て）'''
+        return np.trunc(np.asarray(length_mm, dtype=float) * self.pulses_per_mm)
+
+    def moveTimes(self, start, target):
+        '''start から target [mm] への移動時間 [s]（配列可）'''
+        return trapezoidTimes(
+                self.toPulses(target) - self.toPulses(start),
+                self.start_speed, self.max_speed, self.accel_time)
+
+
+class stageMotionModel():
+    '''ステージ全体の駆動時間モデルとプログラムの所要時間の見積り
+
+    各軸の axisModel に加えて，実測から求める補正値を持つ。
+
+    - time_scale: 駆動時間の倍率
+    - move_overhead: 移動1回あたりの余分な時間（通信や完了検出の遅れ）[s]
+    - step_overhead: 1ステップあたりの余分な時間（タイマや I/O 出力）[s]
+    '''
+    AXES = ('pos_x', 'pos_y', 'pos_z')
+
+    def __init__(self, axes=None, time_scale=1.0,
+                 move_overhead=0.0, step_overhead=0.0):
+        if axes is None:
+            axes = [axisModel() for _ in self.AXES]
+        self.axes = axes
+        self.time_scale = time_scale
+        self.move_overhead = move_overhead
+        self.step_overhead = step_overhead
+
+    @classmethod
+    def fromStage(cls, stg, **kwargs):
+        '''stage.stage の速度設定と内部情報からモデルを作る'''
+        axes = [axisModel(
+                    stg.start_speed[ax], stg.max_speed[ax], stg.accel_time[ax],
+                    stg.npulses_per_mm, stg.distance_per_pulse[ax],
+                    stg.divisions[ax])
+                for ax in range(len(cls.AXES))]
+        return cls(axes, **kwargs)
+
+    def calibration(self):
+        '''補正値を辞書で返す（config への保存用）'''
+        return {
+                'time_scale': self.time_scale,
+                'move_overhead': self.move_overhead,
+                'step_overhead': self.step_overhead,
+                }
+
+    def moveTime(self, start, target):
+        '''start から target [mm] への移動時間の予測 [s]
+
+        各軸は同時に動くので，最も時間のかかる軸で決まる。
+        '''
+        t = 0.0
+        for ax, model in enumerate(self.axes):
+            t = max(t, float(model.moveTimes(start[ax], target[ax])))
+        return t * self.time_scale
+
+    def moveTimes(self, positions, start=None):
+        '''位置の列を順にたどるときの各移動の時間 [s]
+
+        Args:
+            positions (numpy.ndarray): (nrows, 3) の位置 [mm]
+            start (list): 最初の移動の開始位置 [mm]。None なら先頭の位置
+
+        Returns:
+            numpy.ndarray: 各行へ移動する時間（nrows 個）
+        '''
+        positions = np.asarray(positions, dtype=float)
+        if len(positions) == 0:
+            return np.zeros(0)
+        if start is None:
+            start = positions[0]
+        prev = np.vstack([np.asarray(start, dtype=float)[np.newaxis, :],
+                          positions[:-1]])
+        t = np.zeros(len(positions))
+        for ax, model in enumerate(self.axes):
+            np.maximum(t, model.moveTimes(prev[:, ax], positions[:, ax]), out=t)
+        return t * self.time_scale
+
+    def estimateProgram(self, df, trigger_duration, start=None):
+        '''プログラムの各行の所要時間を見積もる
+
+        Args:
+            df: stageProgram.data などのレコード配列（または DataFrame）
+            trigger_duration (float): トリガ出力の時間 [s]
+            start (list): 実行開始時のステージ位置 [mm]
+
+        Returns:
+            dict of numpy.ndarray: move_time, settle_time, trigger_time,
+            total_time [s]（いずれも行ごと）
+        '''
+        positions = np.stack(
+                [np.asarray(df[ax], dtype=float) for ax in self.AXES], axis=1)
+        reps = np.asarray(df['repetitions'], dtype=float)
+        move_time = self.moveTimes(positions, start) + self.move_overhead
+        settle_time = np.asarray(df['settling_time'], dtype=float) * reps
+        trigger_time = trigger_duration * reps
+        total_time = move_time + settle_time + trigger_time + self.step_overhead
+        return {
+                'move_time': move_time,
+                'settle_time': settle_time,
+                'trigger_time': trigger_time,
+                'total_time': total_time,
+                }
+
+    def estimateTotals(self, chunks, trigger_duration, start=None):
+        '''分割して読み出したプログラムの所要時間の合計を見積もる
+
+        全体を展開しないので，大きなプログラムにも使える。
+
+        Args:
+            chunks (iterable): iterChunks() の結果（レコード配列）
+            trigger_duration (float): トリガ出力の時間 [s]
+            start (list): 実行開始時のステージ位置 [mm]
+
+        Returns:
+            dict of float: move_time, settle_time, trigger_time, total_time [s]
+        '''
+        totals = dict.fromkeys(
+                ('move_time', 'settle_time', 'trigger_time', 'total_time'), 0.0)
+        for chunk in chunks:
+            if len(chunk) == 0:
+                continue
+            estimate = self.estimateProgram(chunk, trigger_duration, start)
+            for k in totals:
+                totals[k] += float(estimate[k].sum())
+            start = [float(chunk[ax][-1]) for ax in self.AXES]
+        return totals
+
+    def calibrate(self, predicted_move, measured_move, measured_step,
+                  expected_step):
+        '''実行時の計測から補正値を求める
+
+        駆動時間は measured_move = time_scale * predicted_move + move_overhead
+        として最小二乗で当てはめる（予測値にばらつきがなければ
+        move_overhead だけ求める）。step_overhead はステップの実測から
+        移動・待ち・トリガの時間を引いた残りの平均。
+
+        Args:
+            predicted_move (array): 補正前のモデルによる移動時間 [s]
+            measured_move (array): 移動コマンドから Ready までの実測 [s]
+            measured_step (array): ステップ全体の実測 [s]
+            expected_step (array): 移動の実測と待ち・トリガ時間の和 [s]
+        '''
+        predicted_move = np.asarray(predicted_move, dtype=float)
+        measured_move = np.asarray(measured_move, dtype=float)
+        if len(predicted_move) == 0:
+            return
+        if len(predicted_move) >= 2 and np.ptp(predicted_move) > 1e-3:
+            scale, offset = np.polyfit(predicted_move, measured_move, 1)
+            if scale > 0:
+                self.time_scale = float(scale)
+                self.move_overhead = max(float(offset), 0.0)
+            else:
+                self.move_overhead = max(
+                        float(np.mean(measured_move - predicted_move * self.time_scale)), 0.0)
+        else:
+            self.move_overhead = max(
+                    float(np.mean(measured_move - predicted_move * self.time_scale)), 0.0)
+        self.step_overhead = max(float(np.mean(
+                np.asarray(measured_step, dtype=float)
+                - np.asarray(expected_step, dtype=float))), 0.0)
+        logger.info("stageMotionModel.calibrate(): %s", self.calibration())
+
+
+def formatDuration(seconds):
+    '''秒数を h:mm:ss 形式（1日以上は日数付き）にする'''
+    seconds = int(round(seconds))
+    days, rest = divmod(seconds, 86400)
+    hours, rest = divmod(rest, 3600)
+    minutes, secs = divmod(rest, 60)
+    if days > 0:
+        return f"{days}d {hours:d}:{minutes:02d}:{secs:02d}"
+    return f"{hours:d}:{minutes:02d}:{secs:02d}"
+
+
+def summarizeEstimate(estimate):
+    '''estimateProgram（または estimateTotals）の結果を合計して1行の文字列にする'''
+    return (f"{formatDuration(np.sum(estimate['total_time']))}"
+            f" (move {formatDuration(np.sum(estimate['move_time']))},"
+            f" settle {formatDuration(np.sum(estimate['settle_time']))},"
+            f" trigger {formatDuration(np.sum(estimate['trigger_time']))})")
+
+
+def test():
+    '''テストコード'''
+    import program
+
+    model = stageMotionModel()
+    for n in (0, 10, 100, 1000, 10000):
+        t_vec = float(trapezoidTimes(n, DEFAULT_START_SPEED, DEFAULT_MAX_SPEED,
+                                     DEFAULT_ACCEL_TIME))
+        t = trapezoidTime(n, DEFAULT_START_SPEED, DEFAULT_MAX_SPEED,
+                          DEFAULT_ACCEL_TIME)
+        assert abs(t - t_vec) < 1e-9, (n, t, t_vec)
+    prog = program.test_data()
+    estimate = model.estimateProgram(prog.data, 0.1)
+    print(f"{len(prog)} rows: {summarizeEstimate(estimate)}")
+    totals = model.estimateTotals(prog.iterChunks(1000), 0.1)
+    assert abs(totals['total_time'] - estimate['total_time'].sum()) < 1e-6
+
+
+if __name__ == '__main__':
+    test()
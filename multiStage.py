@@ -0,0 +1,314 @@
+''' 複数の SHOT コントローラの同時運転
+'''
+
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+import stage
+import asyncStage
+import program
+import completionDetector
+import motionModel
+
+logger = logging.getLogger(__name__)
+
+
+class stageController():
+    '''multiStage が管理するコントローラ1台分
+
+    stage.stage と，共有のイベントループに載せた asyncStage.asyncStage を持つ。
+    移動完了は completionDetector の予測に従って asyncio.sleep で待つので，
+    待っている間は CPU を使わない。
+    '''
+    # unit of DURATION is [s]
+    OSCI_TRIGGER_DURATION = 0.1
+    OSCI_TRIGGER_CHANNEL = 1
+    TICK_CHANNEL = 3
+
+    def __init__(self, name, loop):
+        self.name = name
+        self.stage = stage.stage()
+        self.astage = asyncStage.asyncStage(self.stage, loop=loop)
+        self.model = motionModel.stageMotionModel.fromStage(self.stage)
+        self.detector = completionDetector.completionDetector(
+                self.stage, self.model)
+        self.resetStats()
+
+    def resetStats(self):
+        '''スループットの統計をクリアする'''
+        self.steps = 0
+        self.t_started = None
+        self.t_finished = None
+        self.move_time = 0.0
+        self.io_stats = stage.stage.emptyIOStats()
+        self.detector.resetStats()
+
+    def open(self, portname):
+        '''シリアルポートを開く（ブロックする）'''
+        self.stage.openSerial(portname)
+        self.astage.start()
+
+    def close(self):
+        '''トランスポートを止めてシリアルポートを閉じる'''
+        self.astage.close()
+        if self.stage.ser is not None and self.stage.ser.is_open:
+            self.stage.ser.close()
+
+    async def getInfo(self):
+        '''内部情報を取得し，駆動モデルを作り直す'''
+        await self.astage.getInfo()
+        self.model = motionModel.stageMotionModel.fromStage(self.stage)
+        self.detector.model = self.model
+
+    async def waitReady(self, start, target):
+        '''移動の完了を待つ
+
+        completionDetector.nextPoll の間隔で Q: または !: を送り，Ready で返る
+        '''
+        self.detector.startMove(start, target, time.monotonic())
+        while True:
+            delay, cmd = self.detector.nextPoll(time.monotonic())
+            await asyncio.sleep(delay)
+            if cmd == completionDetector.POLL_STATUS:
+                ready = await self.astage.isReady()
+            else:
+                ready = (await self.astage.query())['ack3'] == 'R'
+            self.detector.reportStatus(ready, time.monotonic())
+            if ready:
+                return
+
+    async def runStep(self, param, tick=None):
+        '''プログラムの1行を実行する
+
+        runEngine.moveToRow と同じく，直前のトリガ OFF と tick の出力を移動と
+        1往復で送出し，完了待ち，settling_time 待ちとトリガ出力の繰り返しを行う。
+        最後のトリガは ON のまま返り，次の移動と一緒に OFF にする。
+
+        Args:
+            param: program.programRow（paramByIndex() の結果でもよい）
+            tick (int or None): tick1 の出力。None なら出力しない
+        '''
+        if self.t_started is None:
+            self.t_started = time.monotonic()
+        start = list(self.stage.last_move_to)
+        target = [param['pos_x'], param['pos_y'], param['pos_z']]
+        val = self.stage.outputPattern(self.OSCI_TRIGGER_CHANNEL, stage.IO_OFF)
+        if tick is not None:
+            tick_bit = 1 << (self.TICK_CHANNEL - 1)
+            val = val | tick_bit if tick == 1 else val & ~tick_bit
+        t_move = time.monotonic()
+        await self.astage.outputAndMoveTo(val, *target)
+        await self.waitReady(start, target)
+        self.move_time += time.monotonic() - t_move
+
+        for rep in range(int(param['repetitions'])):
+            if rep > 0:
+                await self.astage.digitalWrite(
+                        self.OSCI_TRIGGER_CHANNEL, stage.IO_OFF)
+            await asyncio.sleep(float(param['settling_time']))
+            await self.astage.digitalWrite(self.OSCI_TRIGGER_CHANNEL, stage.IO_ON)
+            await asyncio.sleep(self.OSCI_TRIGGER_DURATION)
+
+        self.steps += 1
+        for k, v in self.stage.endStep().items():
+            self.io_stats[k] += v
+        self.t_finished = time.monotonic()
+
+    async def finish(self):
+        '''最後のトリガを OFF にする'''
+        await self.astage.digitalWrite(self.OSCI_TRIGGER_CHANNEL, stage.IO_OFF)
+
+    async def runProgram(self, prog, start_row=0):
+        '''プログラムを start_row 行目から最後まで実行する'''
+        try:
+            for param in program.rowReader(prog).iterRows(start_row):
+                await self.runStep(param, param.tick())
+        finally:
+            await asyncio.shield(self.finish())
+
+    def stats(self):
+        '''スループットの統計
+
+        Return
+        ------
+        stats: dict
+            steps, elapsed, steps_per_s, move_time_mean [s] と
+            ステップあたりの round_trips, bytes_written, bytes_read，
+            completionDetector.stats() の各項目
+        '''
+        elapsed = 0.0
+        if self.t_started is not None and self.t_finished is not None:
+            elapsed = self.t_finished - self.t_started
+        n = max(self.steps, 1)
+        ret = {
+                'steps': self.steps,
+                'elapsed': elapsed,
+                'steps_per_s': self.steps / elapsed if elapsed > 0 else 0.0,
+                'move_time_mean': self.move_time / n,
+                }
+        for k, v in self.io_stats.items():
+            ret[f'{k}_per_step'] = v / n
+        ret.update(self.detector.stats())
+        return ret
+
+
+class multiStage():
+    '''複数のコントローラを1つのプロセスから運転する
+
+    すべてのコントローラの asyncStage は1本のスレッドで回る
+    共有のイベントループに載せるので，シリアル入出力は並行に進む。
+
+    - runIndependent(): コントローラごとに別のプログラムを独立に実行
+    - runCombined(): 各コントローラのプログラムを1行ずつ同期して実行
+      （全台のステップが終わるまで次の行に進まない）
+
+    run* は concurrent.futures.Future を返す。stop() で全台を止める。
+    '''
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(
+                target=self.loop.run_forever, name='multiStage', daemon=True)
+        self.thread.start()
+        self.controllers = {}
+        self.run_future = None
+
+    def open(self, ports):
+        '''シリアルポートを並行に開き，内部情報を取得する
+
+        Args:
+            ports (dict): コントローラ名からポート名への対応
+        '''
+        for name in ports:
+            self.controllers[name] = stageController(name, self.loop)
+        with concurrent.futures.ThreadPoolExecutor(len(ports)) as pool:
+            futs = [pool.submit(self.controllers[name].open, port)
+                    for name, port in ports.items()]
+            for fut in futs:
+                fut.result()
+        self.submit(self._gather(
+                [self.controllers[name].getInfo() for name in ports])).result()
+        logger.info("multiStage.open(): %s", ports)
+
+    def close(self):
+        '''全台を止めてポートを閉じ，イベントループを停止する'''
+        if self.run_future is not None and not self.run_future.done():
+            self.stop()
+        for ctrl in self.controllers.values():
+            ctrl.close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+    def submit(self, coro):
+        '''コルーチンを共有のイベントループに投入する'''
+        return asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+    async def _gather(self, coros):
+        '''コルーチンを並行に実行する（submit 用）'''
+        return await asyncio.gather(*coros)
+
+    def runIndependent(self, progs):
+        '''コントローラごとにプログラムを独立に実行する
+
+        Args:
+            progs (dict): コントローラ名から program.stageProgram
+                （または program.lazyGridProgram）への対応
+
+        Return
+        ------
+        future: concurrent.futures.Future
+        '''
+        for name in progs:
+            self.controllers[name].resetStats()
+        self.run_future = self.submit(self._gather(
+                [self.controllers[name].runProgram(prog)
+                 for name, prog in progs.items()]))
+        return self.run_future
+
+    async def _runCombined(self, progs):
+        ctrls = [self.controllers[name] for name in progs]
+        readers = [program.rowReader(prog) for prog in progs.values()]
+        try:
+            for row in range(len(next(iter(progs.values())))):
+                # 全台の同じ行が終わるのを待ってから次の行に進む
+                params = [reader.row(row) for reader in readers]
+                await asyncio.gather(
+                        *(ctrl.runStep(param, param.tick())
+                          for ctrl, param in zip(ctrls, params)))
+        finally:
+            await asyncio.shield(asyncio.gather(
+                    *(ctrl.finish() for ctrl in ctrls)))
+
+    def runCombined(self, progs):
+        '''各コントローラのプログラムを1行ずつ同期して実行する
+
+        Args:
+            progs (dict): コントローラ名から program.stageProgram への対応。
+                行数はすべて同じでなければならない
+
+        Return
+        ------
+        future: concurrent.futures.Future
+        '''
+        nrows = {len(prog) for prog in progs.values()}
+        if len(nrows) > 1:
+            raise ValueError(
+                    f"multiStage.runCombined(): row counts differ: {nrows}")
+        for name in progs:
+            self.controllers[name].resetStats()
+        self.run_future = self.submit(self._runCombined(progs))
+        return self.run_future
+
+    def stop(self):
+        '''実行中のプログラムを中断し，全台を停止する'''
+        if self.run_future is not None:
+            self.run_future.cancel()
+        self.submit(self._gather(
+                [ctrl.astage.stop() for ctrl in self.controllers.values()])).result()
+
+    def stats(self):
+        '''コントローラ名ごとの stageController.stats()'''
+        return {name: ctrl.stats() for name, ctrl in self.controllers.items()}
+
+    def report(self):
+        '''スループットの統計を表形式の文字列にする'''
+        lines = [f"{'name':10s}{'steps':>7s}{'elapsed':>10s}{'steps/s':>9s}"
+                 f"{'move[ms]':>10s}{'rt/step':>9s}{'polls/mv':>10s}"]
+        for name, st in self.stats().items():
+            lines.append(
+                    f"{name:10s}{st['steps']:7d}{st['elapsed']:10.2f}"
+                    f"{st['steps_per_s']:9.2f}{st['move_time_mean'] * 1e3:10.1f}"
+                    f"{st['round_trips_per_step']:9.1f}{st['polls_per_move']:10.1f}")
+        return '\n'.join(lines)
+
+
+def test():
+    '''テストコード（shotEmulator 2台で同期実行）'''
+    import shotEmulator
+
+    logging.basicConfig(level=logging.INFO)
+    emulators = [shotEmulator.shotEmulator() for _ in range(2)]
+    ports = {f"stage{i}": emu.start() for i, emu in enumerate(emulators)}
+    mst = multiStage()
+    try:
+        mst.open(ports)
+        progs = {name: program.test_data(
+                    range_x=(0, 2), range_y=(0, 1), range_z=(0, 0),
+                    settling_time=0.05)
+                 for name in ports}
+        mst.runCombined(progs).result()
+        print(mst.report())
+        mst.runIndependent(progs).result()
+        print(mst.report())
+    finally:
+        mst.close()
+        for emu in emulators:
+            emu.stop()
+
+
+if __name__ == '__main__':
+    test()
@@ -15,9 +15,17 @@ logger = logging.getLogger(__name__)
 
 
 class portSettingDialog(QDialog):
+    '''シリアルポートを選ぶダイアログ
+
+    devices はポートの一覧（list）か，stage.scanDevices() の
+    concurrent.futures.Future。Future が終わっていなければ，
+    終わったときに一覧を加える（None ならここで get_device_list() する）。
+    '''
     phantomPort = 'Phantom Port'
 
-    def __init__(self, parent=None, candidate_device=None):
+    devicesFound = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None, candidate_device=None, devices=None):
         super().__init__()
     
         logger.debug('portSettingDialog.__init__(): candidate_divice: %s',
@@ -30,17 +38,42 @@ class portSettingDialog(QDialog):
         buttonbox.accepted.connect(self.accept)
         buttonbox.rejected.connect(self.reject)
 
+        self.candidate_device = candidate_device
         self.cbox = QComboBox()
         self.cbox.addItem(self.phantomPort)
-        self.cbox.addItems(stage.get_device_list())
-        matched_idx = self.cbox.findText(candidate_device)
-        if matched_idx >= 0:
-            self.cbox.setCurrentIndex(matched_idx)
 
         layout = QVBoxLayout(self)
         layout.addWidget(self.cbox)
         layout.addWidget(buttonbox)
 
+        if devices is None:
+            devices = stage.get_device_list()
+        if isinstance(devices, list):
+            self.addDevices(devices)
+        else:
+            # 完了コールバックは別スレッドで呼ばれるのでシグナルで受け取る
+            self.devicesFound.connect(self.scanFinished)
+            self.cbox.setToolTip('Scanning serial ports...')
+            devices.add_done_callback(self.devicesFound.emit)
+
+    def scanFinished(self, fut):
+        self.cbox.setToolTip('')
+        if fut.exception() is not None:
+            logger.warning("portSettingDialog: cannot list serial ports: %s",
+                           fut.exception())
+            return
+        self.addDevices(fut.result())
+
+    def addDevices(self, devices):
+        '''ポートの一覧を加え，candidate_device があれば選ぶ'''
+        user_selected = self.cbox.currentIndex() > 0
+        self.cbox.addItems(devices)
+        if self.candidate_device is None or user_selected:
+            return
+        matched_idx = self.cbox.findText(self.candidate_device)
+        if matched_idx >= 0:
+            self.cbox.setCurrentIndex(matched_idx)
+
     def selectedPort(self):
         return self.cbox.currentText()
 
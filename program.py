@@ -1,31 +1,348 @@
 ''' プログラム処理クラス
 '''
 
+import contextlib
+import json
 import logging
+import os
+import tempfile
 
 import numpy as np
-import pandas as pd
+
+import scanOrder
+import surfaceRegion
 
 logger = logging.getLogger(__name__)
 
+CHUNK_SIZE = 65536     # iterChunks() の既定の行数
+MAX_UNDO = 100          # 取り消せる編集（トランザクション）の数
+ROW_PREFETCH = 256      # rowReader が一度に programRow にする行数
+
+# プログラム1行分のレコード（31 bytes/行）。
+# tick は ticks のビット（tick1 が bit0, ... tick8 が bit7）に詰める
+PROGRAM_DTYPE = np.dtype([
+        ('pos_x', 'f8'), ('pos_y', 'f8'), ('pos_z', 'f8'),
+        ('settling_time', 'f4'), ('repetitions', 'u2'), ('ticks', 'u1')])
+POSITION_COLUMNS = ['pos_x', 'pos_y', 'pos_z']
+VALUE_COLUMNS = POSITION_COLUMNS + ['settling_time', 'repetitions']
+MAX_TICKS = 8
+
+# バイナリ形式（.shotp）
+#   MAGIC (8 bytes), version (u4), ヘッダ長 (u4), ヘッダ（JSON, UTF-8），
+#   DATA_ALIGN 境界から PROGRAM_DTYPE の行を nrows 個
+BINARY_SUFFIX = '.shotp'
+BINARY_MAGIC = b'SHOTPRG\0'
+BINARY_VERSION = 1
+DATA_ALIGN = 64
+
+
+def tickBit(colname):
+    '''tick のカラム名（tick1 ... tick8）からビット番号を求める'''
+    if colname.startswith('tick') and colname[4:].isdigit():
+        n = int(colname[4:])
+        if 1 <= n <= MAX_TICKS:
+            return n - 1
+    raise ValueError(f"program: not a tick column: {colname}")
+
+
+def recordsToValues(records, columns):
+    '''レコード配列を columns の順の2次元 float 配列にする（tick は 0/1）'''
+    values = np.empty((len(records), len(columns)))
+    for c, colname in enumerate(columns):
+        if colname in VALUE_COLUMNS:
+            values[:, c] = records[colname]
+        else:
+            values[:, c] = (records['ticks'] >> tickBit(colname)) & 1
+    return values
+
+
+def recordsToDataFrame(records, columns, start=0):
+    '''レコード配列を DataFrame にする（書き出し用。pandas はここで読み込む）'''
+    import pandas as pd
+
+    data = {}
+    for colname in columns:
+        if colname in VALUE_COLUMNS:
+            data[colname] = records[colname]
+        else:
+            data[colname] = (records['ticks'] >> tickBit(colname)) & 1
+    return pd.DataFrame(data, index=np.arange(start, start + len(records)))
+
+
+class programRow():
+    '''プログラムの1行（Python の数値で持つ軽いレコード）
+
+    param['pos_x'] と param.pos_x のどちらでも参照できる。
+    numpy のスカラーを作らないので，実行中の行の参照に使う。
+    '''
+    __slots__ = ('index', 'pos_x', 'pos_y', 'pos_z',
+                 'settling_time', 'repetitions', 'ticks')
+
+    def __init__(self, index, pos_x, pos_y, pos_z, settling_time,
+                 repetitions, ticks):
+        self.index = index
+        self.pos_x = pos_x
+        self.pos_y = pos_y
+        self.pos_z = pos_z
+        self.settling_time = settling_time
+        self.repetitions = repetitions
+        self.ticks = ticks
+
+    def __getitem__(self, name):
+        return getattr(self, name)
+
+    def tick(self, colname='tick1'):
+        '''tick（0 または 1）'''
+        return (self.ticks >> tickBit(colname)) & 1
+
+    def __repr__(self):
+        return (f"programRow({self.index}: {self.pos_x}, {self.pos_y}, "
+                f"{self.pos_z}, {self.settling_time}, {self.repetitions}, "
+                f"{self.ticks:#04x})")
+
+
+def recordsToRows(records, start=0):
+    '''レコード配列を programRow のリストにする（start は先頭の行番号）'''
+    # tolist() で全フィールドを一度に Python の数値にする
+    return [programRow(idx, *values)
+            for idx, values in enumerate(records.tolist(), start)]
+
+
+class rowReader():
+    '''プログラムの行を programRow で返す（先読みつき）
+
+    row(idx) は idx から chunk_size 行をまとめて programRow にしておき，
+    続く行はそこから返す。プログラムが編集されたら（version が変われば）
+    読み直す。rows(start, stop) を持つプログラムならどれでも使える。
+    '''
+
+    def __init__(self, prog, chunk_size=ROW_PREFETCH):
+        self.prog = prog
+        self.chunk_size = chunk_size
+        self.start = 0
+        self.cache = []
+        self.version = None
+
+    def row(self, idx):
+        '''idx 行目の programRow'''
+        k = idx - self.start
+        if (k < 0 or k >= len(self.cache)
+                or self.version != getattr(self.prog, 'version', 0)):
+            self.fill(idx)
+            k = 0
+        return self.cache[k]
+
+    def fill(self, idx):
+        '''idx 行目から chunk_size 行を読む'''
+        if idx < 0 or idx >= len(self.prog):
+            raise IndexError(f"rowReader: row {idx} out of range")
+        self.version = getattr(self.prog, 'version', 0)
+        self.start = idx
+        self.cache = recordsToRows(
+                self.prog.rows(idx, idx + self.chunk_size), idx)
+
+    def __iter__(self):
+        return self.iterRows()
+
+    def iterRows(self, start=0):
+        '''start 行目から最後まで1行ずつ返す
+
+        行数は毎回確かめるので，途中で増えた行（読み込み中のプログラム，
+        適応走査の追加点）も返す。
+        '''
+        idx = start
+        while idx < len(self.prog):
+            yield self.row(idx)
+            idx += 1
+
+
+def writeBinaryHeader(f, nrows, tick_names, gen_condition, data_offset=None):
+    '''バイナリ形式のヘッダを書き，行データの開始位置を返す
+
+    data_offset を与えると，行データがその位置から始まるように詰める
+    （書き出し中にヘッダを書き直すとき用）。
+    '''
+    header = {
+            'nrows': int(nrows),
+            'schema': PROGRAM_DTYPE.descr,
+            'tick_names': list(tick_names),
+            'gen_condition': gen_condition,
+            }
+    text = json.dumps(
+            header, default=lambda o: o.item() if hasattr(o, 'item') else str(o))
+    text = text.encode('utf-8')
+    head_len = len(BINARY_MAGIC) + 8 + len(text)
+    if data_offset is None:
+        data_offset = -(-head_len // DATA_ALIGN) * DATA_ALIGN
+    elif head_len > data_offset:
+        raise ValueError(f"writeBinaryHeader(): header too long: {head_len}")
+    text += b' ' * (data_offset - head_len)
+    f.write(BINARY_MAGIC)
+    f.write(np.array([BINARY_VERSION, len(text)], dtype='<u4').tobytes())
+    f.write(text)
+    return data_offset
+
+
+def writeBinaryFile(filename, nrows, tick_names, gen_condition, chunks):
+    '''バイナリ形式のファイルを書く（chunks はレコード配列を順に返すもの）
+
+    同じディレクトリの一時ファイルに書いてから os.replace() で置き換える。
+    読み込んだファイルは np.memmap で開いたままなので，同じファイルへ直接
+    書き出すと切り詰められて（SIGBUS で落ちて）中身が失われる。
+    '''
+    fd, tmpname = tempfile.mkstemp(
+            suffix='.tmp', prefix=os.path.basename(filename) + '.',
+            dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        # mkstemp は 0600 で作るので，open() と同じ umask に従う権限にする
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        with os.fdopen(fd, 'wb') as f:
+            offset = writeBinaryHeader(f, nrows, tick_names, gen_condition)
+            f.seek(offset)
+            for chunk in chunks:
+                f.write(np.ascontiguousarray(chunk, dtype=PROGRAM_DTYPE).tobytes())
+        os.replace(tmpname, filename)
+    except BaseException:
+        os.unlink(tmpname)
+        raise
+
+
+def readBinaryHeader(filename):
+    '''バイナリ形式のヘッダを読む
+
+    Returns:
+        (dict, int): ヘッダと行データの開始位置
+    '''
+    with open(filename, 'rb') as f:
+        magic = f.read(len(BINARY_MAGIC))
+        if magic != BINARY_MAGIC:
+            raise ValueError(f"{filename}: not a program file")
+        version, text_len = np.frombuffer(f.read(8), dtype='<u4')
+        if version != BINARY_VERSION:
+            raise ValueError(f"{filename}: unsupported version: {version}")
+        header = json.loads(f.read(int(text_len)).decode('utf-8'))
+    if np.dtype([tuple(d) for d in header['schema']]) != PROGRAM_DTYPE:
+        raise ValueError(f"{filename}: unsupported schema: {header['schema']}")
+    return header, len(BINARY_MAGIC) + 8 + int(text_len)
+
+
+def readProgram(filename):
+    '''拡張子（.shotp または .csv）に応じてプログラムを読み込む'''
+    prog = stageProgram()
+    if filename.endswith(BINARY_SUFFIX):
+        prog.read_binary(filename)
+    else:
+        prog.read_csv(filename)
+    return prog
+
+
+def convert(src, dst, overwrite=False):
+    '''CSV とバイナリ形式を相互に変換する（拡張子で判断）
+
+    CSV から .shotp へは programImport.csvImporter で分割して読むので，
+    大きなファイルでもメモリを使い切らない。
+    dst がすでにあれば overwrite が True でない限り FileExistsError を送出する。
+    '''
+    if os.path.exists(dst) and not overwrite:
+        raise FileExistsError(f"convert(): {dst} already exists")
+    if not src.endswith(BINARY_SUFFIX) and dst.endswith(BINARY_SUFFIX):
+        import programImport
+
+        nrows = programImport.csvImporter(src, dst, overwrite=True).run()
+        logger.info("convert(): %s -> %s (%d rows)", src, dst, nrows)
+        return
+    prog = readProgram(src)
+    if dst.endswith(BINARY_SUFFIX):
+        prog.to_binary(dst)
+    else:
+        prog.to_csv(dst)
+    logger.info("convert(): %s -> %s (%d rows)", src, dst, len(prog))
+
+
+def rowIndex(rows, nrows):
+    '''行の指定（int, slice, 配列, bool 配列）を slice か int 配列にする'''
+    if isinstance(rows, slice):
+        return slice(*rows.indices(nrows))
+    if np.isscalar(rows):
+        idx = int(rows)
+        if idx < 0:
+            idx += nrows
+        if not 0 <= idx < nrows:
+            raise IndexError(f"row {rows} out of range")
+        return slice(idx, idx + 1)
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        return np.flatnonzero(rows)
+    return rows.astype(np.int64)
+
+
+class editDiff():
+    '''編集1回分の差分（data のフィールド1つ，対象の行だけ）'''
+    __slots__ = ('field', 'rows', 'old', 'new')
+
+    def __init__(self, field, rows, old, new):
+        self.field = field
+        self.rows = rows        # slice または int 配列
+        self.old = old
+        self.new = new
+
+
 class stageProgram:
-    '''ステージのプログラムクラス'''
+    '''ステージのプログラムクラス
+
+    各行は PROGRAM_DTYPE の構造化配列 data に固定の型で格納する。
+    行の参照（paramByIndex）は data のレコードをそのまま返すので
+    Series などは作らない。DataFrame が必要なときは to_dataframe() を使う。
+
+    編集は setValues(), applyExpression(), offset(), scale(), setBlock() で
+    まとめて行う。transaction() の中の編集は1つの取り消し単位になり，
+    終わったときに1回だけ listeners に変更された行を知らせる。
+    取り消し用には変更したフィールドと行の差分（editDiff）だけを残す。
+    '''
     def __init__(self):
-        self.df = pd.DataFrame(
-                columns=('pos_x', 'pos_y', 'pos_z', 'settling_time',
-                    'repetitions', 'tick1'))
+        self.data = np.zeros(0, dtype=PROGRAM_DTYPE)
+        self.tick_names = ['tick1']   # 使っている tick のカラム名
         self.gen_condition = {}    # 生成条件
+        self.filename = None       # 読み書きしたファイル名（CSV または .shotp）
+        self.modified = False      # ファイルの内容から変更されたか
+        self.listeners = []        # 編集の通知先 func(rows)
+        self.undo_log = []         # editDiff のリストのリスト
+        self.redo_log = []
+        self.pending = None        # トランザクション中の editDiff
+        self.version = 0           # data を変更するたびに増える（rowReader 用）
+        self.editable = True       # False なら setValues() などの編集はできない
 
     def setPosition(self, xxx, yyy, zzz, repetitions=1, settling_time=1):
         '''meshgrid で生成された numpy.ndarray からプログラムを生成'''
-        xs = xxx.flatten()
-        ys = yyy.flatten()
-        zs = zzz.flatten()
-        self.df['pos_x'] = xs
-        self.df['pos_y'] = ys
-        self.df['pos_z'] = zs
-        self.df['repetitions'] = np.ones_like(xs, dtype=int) * repetitions
-        self.df['settling_time'] = np.ones_like(xs) * settling_time
+        xs = np.ravel(xxx)
+        self.clearHistory()
+        self.data = np.zeros(len(xs), dtype=PROGRAM_DTYPE)
+        self.data['pos_x'] = xs
+        self.data['pos_y'] = np.ravel(yyy)
+        self.data['pos_z'] = np.ravel(zzz)
+        self.data['repetitions'] = repetitions
+        self.data['settling_time'] = settling_time
+
+    def setTickColumn(self, colname, values):
+        '''tick のカラムに 0/1 の配列を設定する'''
+        bit = np.uint8(1 << tickBit(colname))
+        on = np.asarray(values) != 0
+        self.data['ticks'] = np.where(
+                on, self.data['ticks'] | bit, self.data['ticks'] & ~bit)
+        self.version += 1
+        if colname not in self.tick_names:
+            self.tick_names.append(colname)
+            self.tick_names.sort(key=tickBit)
+
+    def tickColumn(self, colname='tick1'):
+        '''tick のカラムを 0/1 の配列で返す'''
+        return (self.data['ticks'] >> tickBit(colname)) & 1
+
+    def tick(self, idx, colname='tick1'):
+        '''idx 行目の tick（0 または 1）'''
+        return (int(self.data['ticks'][idx]) >> tickBit(colname)) & 1
 
     def setTick(self, inv_samples, colname='tick1'):
         ''' flip tickの生成。
@@ -36,17 +353,64 @@ class stageProgram:
             inv_samples (int):        出力が反転するサンプル数
             colname (str, optional): tickのカラム名。default: tick1'''
 
-        self.df[colname] = 0
-        one_flags = np.arange(len(self.df)) % (2 * inv_samples) >= inv_samples
-        self.df.loc[one_flags, colname] = 1
+        one_flags = np.arange(len(self.data)) % (2 * inv_samples) >= inv_samples
+        self.setTickColumn(colname, one_flags)
+
+    def setLineTick(self, fast_axis='pos_z', colname='tick1'):
+        '''ライン（高速軸以外の座標の組）が変わるごとに反転する tick を生成する
+
+        走査順を並べ替えたあとでも，tick がラインの区切りを表すようにする。
+        ラスタ順の格子では setTick(高速軸の点数) と同じ結果になる。
+
+        Args:
+            fast_axis (str, optional): 高速軸のカラム名。default: pos_z
+            colname (str, optional): tickのカラム名。default: tick1
+        '''
+        keys = np.stack([self.data[c] for c in POSITION_COLUMNS
+                         if c != fast_axis], axis=1)
+        changed = np.zeros(len(keys), dtype=int)
+        if len(keys) > 1:
+            changed[1:] = np.any(keys[1:] != keys[:-1], axis=1)
+        self.setTickColumn(colname, np.cumsum(changed) % 2)
+
+    def positions(self):
+        '''(n, 3) の位置の配列 [mm]'''
+        return np.stack([self.data[c] for c in POSITION_COLUMNS], axis=1)
+
+    def reorder(self, order, model=None, grid_shape=None):
+        '''走査順を並べ替え，tick を作り直す
+
+        Args:
+            order (str): scanOrder.ORDERS のいずれか
+            model (motionModel.stageMotionModel, optional):
+                移動時間の計算に使うモデル。default: 速度設定のデフォルト
+            grid_shape (tuple, optional): meshgrid の形。
+                往復走査（ORDER_SERPENTINE, ORDER_SERPENTINE2）では必須
+        '''
+        if not self.editable:
+            raise ValueError(f"{type(self).__name__}: the program cannot be reordered")
+        if order in (scanOrder.ORDER_SERPENTINE, scanOrder.ORDER_SERPENTINE2):
+            if grid_shape is None:
+                raise ValueError(f"reorder(): '{order}' needs grid_shape")
+            naxes = 2 if order == scanOrder.ORDER_SERPENTINE2 else 1
+            perm = scanOrder.serpentineOrder(grid_shape, naxes)
+        else:
+            perm = scanOrder.pointOrder(self.positions(), order, model)
+        self.data = self.data[perm]
+        self.clearHistory()
+        self.setLineTick()
+        if self.filename is not None:
+            self.modified = True
+        logger.debug("reorder(): %s", order)
 
-        
     def generateGridPosition(self, range_x, range_y, range_z,
-            repetitions=1, settling_time=1.0):
+            repetitions=1, settling_time=1.0,
+            order=scanOrder.ORDER_RASTER, model=None):
         '''3次元格子状の位置を生成する。
 
-        生成結果は stageProgram.df に収納される。
+        生成結果は stageProgram.data に収納される。
         range_x, range_y, range_z の3番目の step は省略可。デフォルトは1
+        z軸が高速軸，y軸が最も遅い軸。
 
         Args:
             range_x (list): x軸方向の範囲。[start, stop[, step]] の形のリスト
@@ -54,6 +418,9 @@ class stageProgram:
             range_z (list): z軸方向の範囲。[start, stop[, step]] の形のリスト
             repetitions (int, optional): 測定繰り返し回数 default=1
             settling_time (float): セトリングタイム default=1.0
+            order (str, optional): 走査順（scanOrder.ORDERS）default: raster
+            model (motionModel.stageMotionModel, optional):
+                走査順の最適化に使う駆動モデル
         '''
         if len(range_x) < 3:
             range_x.append(1.0)
@@ -66,13 +433,89 @@ class stageProgram:
         zz = np.arange(range_z[0], range_z[1] + range_z[2], range_z[2])
         xxx, yyy, zzz = np.meshgrid(xx, yy, zz)
         self.setPosition(xxx, yyy, zzz, repetitions, settling_time)
-        self.setTick(len(zz + 1))
+        self.gen_condition = {
+                'range_x': list(range_x), 'range_y': list(range_y),
+                'range_z': list(range_z), 'order': order}
+        if order == scanOrder.ORDER_RASTER:
+            self.setTick(len(zz))
+        else:
+            self.reorder(order, model, grid_shape=xxx.shape)
+
+    def generateSurfacePosition(self, range_u, range_v, height=0.0,
+            plane=None, region=None, axes=('pos_x', 'pos_y'),
+            repetitions=1, settling_time=1.0,
+            order=scanOrder.ORDER_RASTER, model=None):
+        '''平面上の2次元格子状の位置を生成する。
+
+        axes の2軸で格子を作り，残りの軸の座標は plane の3点を通る平面
+        （None なら height の一定値）から求める。region の外の点は生成しない。
+        マスクは格子全体に対してまとめて計算する。
+        axes[0] が高速軸，axes[1] が遅い軸。
+
+        Args:
+            range_u (list): axes[0] 方向の範囲。[start, stop, step] の形のリスト
+            range_v (list): axes[1] 方向の範囲。[start, stop, step] の形のリスト
+            height (float, optional): plane が None のときの残りの軸の座標
+            plane (numpy.ndarray, optional): 平面上の3点 (3, 3) [mm]
+            region (dict, optional): surfaceRegion.parseRegion() の領域。
+                axes の2軸の座標で表す
+            axes (tuple, optional): 格子の2軸のカラム名。default: (pos_x, pos_y)
+            repetitions (int, optional): 測定繰り返し回数 default=1
+            settling_time (float): セトリングタイム default=1.0
+            order (str, optional): 走査順（scanOrder.ORDERS）default: raster
+            model (motionModel.stageMotionModel, optional):
+                走査順の最適化に使う駆動モデル
+        '''
+        uu = np.arange(range_u[0], range_u[1] + range_u[2], range_u[2])
+        vv = np.arange(range_v[0], range_v[1] + range_v[2], range_v[2])
+        uuu, vvv = np.meshgrid(uu, vv)
+        shape = uuu.shape
+        ax_u = POSITION_COLUMNS.index(axes[0])
+        ax_v = POSITION_COLUMNS.index(axes[1])
+        if plane is None:
+            www = np.full(shape, float(height))
+        else:
+            www = surfaceRegion.planeHeight(plane, uuu, vvv, (ax_u, ax_v))
+        inside = surfaceRegion.regionMask(region, uuu, vvv).ravel()
+        line = np.broadcast_to(np.arange(shape[0])[:, np.newaxis], shape).ravel()
+
+        # 格子全体で並べ替えてから領域の外の点を除く
+        if order in (scanOrder.ORDER_SERPENTINE, scanOrder.ORDER_SERPENTINE2):
+            perm = scanOrder.serpentineOrder(shape, 1)
+            perm = perm[inside[perm]]
+        else:
+            perm = np.flatnonzero(inside)
+            if order in (scanOrder.ORDER_HILBERT, scanOrder.ORDER_MORTON):
+                uv = np.stack([uuu.ravel()[perm], vvv.ravel()[perm]], axis=1)
+                perm = perm[scanOrder.pointOrder(uv, order)]
+
+        coords = [None] * 3
+        coords[ax_u] = uuu.ravel()[perm]
+        coords[ax_v] = vvv.ravel()[perm]
+        coords[3 - ax_u - ax_v] = www.ravel()[perm]
+        self.setPosition(*coords, repetitions, settling_time)
+        line = line[perm]
+        if order == scanOrder.ORDER_NEAREST:
+            sub = scanOrder.pointOrder(self.positions(), order, model)
+            self.data = self.data[sub]
+            line = line[sub]
+        # tick は遅い軸の格子の行が変わるごとに反転する
+        changed = np.zeros(len(line), dtype=int)
+        changed[1:] = line[1:] != line[:-1]
+        self.setTickColumn('tick1', np.cumsum(changed) % 2)
+        self.gen_condition = {
+                'range_u': list(range_u), 'range_v': list(range_v),
+                'axes': list(axes), 'height': float(height),
+                'plane': None if plane is None else np.asarray(plane).tolist(),
+                'region': region, 'order': order}
+        logger.debug("generateSurfacePosition(): %d of %d points",
+                     len(self.data), inside.size)
 
     def generateLinePosition(self, range_x, range_y, range_z, step,
             repetitions=1, settling_time=1.0):
         '''直線状の位置を生成する。
 
-        生成結果は stageProgram.df に格納される。
+        生成結果は stageProgram.data に格納される。
         直線は始点から step 間隔で生成される。
 
         Args:
@@ -94,17 +537,417 @@ class stageProgram:
         self.setPosition(xxx, yyy, zzz, repetitions, settling_time)
         self.setTick(1)
 
+    def __len__(self):
+        return len(self.data)
+
+    @property
+    def columns(self):
+        '''カラム名のリスト'''
+        return VALUE_COLUMNS + self.tick_names
+
     def paramByIndex(self, idx):
-        '''インデックス指定でプログラムパラメータを取得'''
-        return self.df.loc[idx]
+        '''インデックス指定でプログラムパラメータを取得
+
+        data のレコード（numpy.void）を返す。param['pos_x'] のように参照する。
+        tick は tick() で取得する。
+        '''
+        return self.data[idx]
+
+    def rows(self, start, stop):
+        '''start 行目から stop 行目の手前までのレコード配列（data のビュー）'''
+        return self.data[start:stop]
+
+    def row(self, idx):
+        '''idx 行目の programRow（続けて参照するなら rowReader を使う）'''
+        return recordsToRows(self.data[idx:idx + 1], idx)[0]
+
+    def setValue(self, idx, colname, value):
+        '''idx 行目の colname の値を変更する'''
+        self.setValues(idx, colname, value)
+
+    def addListener(self, func):
+        '''編集の通知先を登録する。func(rows) の rows は変更された行番号の配列'''
+        self.listeners.append(func)
+
+    def removeListener(self, func):
+        '''編集の通知先を外す'''
+        if func in self.listeners:
+            self.listeners.remove(func)
+
+    def notify(self, diffs):
+        '''diffs で変更された行を listeners に知らせる'''
+        self.version += 1
+        if not self.listeners or not diffs:
+            return
+        rows = np.unique(np.concatenate(
+                [np.arange(len(self.data))[d.rows] if isinstance(d.rows, slice)
+                 else d.rows for d in diffs]))
+        for func in self.listeners:
+            func(rows)
+
+    def clearHistory(self):
+        '''取り消しの記録を消す（行の並びが変わったとき）'''
+        self.undo_log = []
+        self.redo_log = []
+        self.version += 1
+
+    @contextlib.contextmanager
+    def transaction(self):
+        '''中の編集を1つの取り消し単位にまとめ，最後に1回だけ通知する
+
+        例外が起きたら中の編集をすべて元に戻す。入れ子にしてもよい
+        （いちばん外側でまとめる）。
+        '''
+        if self.pending is not None:
+            yield self
+            return
+        self.pending = []
+        try:
+            yield self
+        except BaseException:
+            for diff in reversed(self.pending):
+                self.data[diff.field][diff.rows] = diff.old
+            self.version += 1
+            raise
+        else:
+            diffs = self.pending
+            if diffs:
+                self.undo_log.append(diffs)
+                del self.undo_log[:-MAX_UNDO]
+                self.redo_log = []
+                self.modified = True
+                self.notify(diffs)
+        finally:
+            self.pending = None
+
+    def writeField(self, field, rows, values):
+        '''data のフィールドの rows 行を書き換えて差分を記録する'''
+        if not self.editable:
+            raise ValueError(f"{type(self).__name__}: the program cannot be edited")
+        with self.transaction():
+            rows = rowIndex(rows, len(self.data))
+            old = self.data[field][rows].copy()
+            self.data[field][rows] = values
+            self.pending.append(
+                    editDiff(field, rows, old, self.data[field][rows].copy()))
+
+    def setValues(self, rows, colname, values):
+        '''rows 行の colname に values を設定する（スカラーは全行に同じ値）'''
+        rows = rowIndex(rows, len(self.data))
+        values = np.asarray(values, dtype=float)
+        if not np.all(np.isfinite(values)):
+            raise ValueError(f"setValues(): {colname}: not a finite number")
+        if colname in VALUE_COLUMNS:
+            if colname == 'repetitions' and np.any(
+                    (values != np.rint(values)) | (values < 0) | (values > 0xffff)):
+                raise ValueError(f"setValues(): {colname}: not a repetition count")
+            self.writeField(colname, rows, values)
+        else:
+            bit = np.uint8(1 << tickBit(colname))
+            ticks = self.data['ticks'][rows]
+            self.writeField('ticks', rows, np.where(
+                    values != 0, ticks | bit, ticks & ~bit))
+
+    def columnValues(self, rows, colname):
+        '''rows 行の colname の値（float 配列。tick は 0/1）'''
+        records = self.data[rowIndex(rows, len(self.data))]
+        return recordsToValues(records, [colname])[:, 0]
+
+    def applyExpression(self, rows, colname, expr):
+        '''rows 行の colname に式の値を設定する
+
+        Args:
+            expr (str or callable): 文字列なら numpy の式として評価する。
+                value（colname の今の値），各カラム名，np が使える。
+                callable なら同じ名前の辞書を受け取って値を返す関数
+        '''
+        rows = rowIndex(rows, len(self.data))
+        names = {c: self.columnValues(rows, c) for c in self.columns}
+        names['value'] = names.get(colname, self.columnValues(rows, colname))
+        if callable(expr):
+            values = expr(names)
+        else:
+            try:
+                values = eval(compile(expr, '<expression>', 'eval'),
+                              {'__builtins__': {}, 'np': np}, names)
+            except Exception as e:
+                raise ValueError(f"applyExpression(): {expr}: {e}") from e
+        self.setValues(rows, colname, values)
+
+    def offset(self, rows, colnames, delta):
+        '''rows 行の colnames に delta を足す'''
+        with self.transaction():
+            for colname in colnames:
+                self.setValues(rows, colname,
+                               self.columnValues(rows, colname) + delta)
+
+    def scale(self, rows, colnames, factor, center=0.0):
+        '''rows 行の colnames を center を中心に factor 倍する'''
+        with self.transaction():
+            for colname in colnames:
+                values = self.columnValues(rows, colname)
+                self.setValues(rows, colname, center + (values - center) * factor)
+
+    def setBlock(self, row, col, values):
+        '''row 行 col 列を左上とする2次元の値の表を設定する（貼り付け用）
+
+        表のうちプログラムの外にはみ出す部分は捨てる。
+        '''
+        values = np.atleast_2d(np.asarray(values, dtype=float))
+        nrows = min(values.shape[0], len(self.data) - row)
+        ncols = min(values.shape[1], len(self.columns) - col)
+        with self.transaction():
+            for c in range(max(ncols, 0)):
+                self.setValues(slice(row, row + nrows), self.columns[col + c],
+                               values[:nrows, c])
+
+    def undo(self):
+        '''最後の編集を取り消す。取り消すものがなければ False'''
+        if not self.undo_log:
+            return False
+        diffs = self.undo_log.pop()
+        for diff in reversed(diffs):
+            self.data[diff.field][diff.rows] = diff.old
+        self.redo_log.append(diffs)
+        self.modified = True
+        self.notify(diffs)
+        return True
+
+    def redo(self):
+        '''取り消した編集をやり直す。やり直すものがなければ False'''
+        if not self.redo_log:
+            return False
+        diffs = self.redo_log.pop()
+        for diff in diffs:
+            self.data[diff.field][diff.rows] = diff.new
+        self.undo_log.append(diffs)
+        self.modified = True
+        self.notify(diffs)
+        return True
+
+    def values(self, start, stop):
+        '''start 行目から stop 行目の手前までを columns の順の2次元配列で返す'''
+        return recordsToValues(self.data[start:stop], self.columns)
+
+    def iterChunks(self, chunk_size=CHUNK_SIZE):
+        '''chunk_size 行ずつのレコード配列（data のビュー）を順に返す'''
+        for start in range(0, len(self.data), chunk_size):
+            yield self.data[start:start + chunk_size]
+
+    def to_dataframe(self):
+        '''DataFrame に変換する（書き出しや解析用。変更しても data には反映されない）'''
+        return recordsToDataFrame(self.data, self.columns)
+
+    @property
+    def df(self):
+        '''to_dataframe() と同じ（読み出し専用）'''
+        return self.to_dataframe()
 
     def to_csv(self, filename='prog.csv'):
         '''CSVの書き出し'''
-        self.df.to_csv(filename, index_label='idx')
+        self.to_dataframe().to_csv(filename, index_label='idx')
+        self.filename = filename
+        self.modified = False
 
     def read_csv(self, filename='prog.csv'):
-        '''CSVの読み込み'''
-        self.df = pd.read_csv(filename, header=0, index_col=0)
+        '''CSVの読み込み
+
+        idx カラムは行番号とみなす。tick1 ... tick8 以外の未知のカラムは無視する。
+        '''
+        import pandas as pd
+
+        df = pd.read_csv(filename, header=0, index_col=0)
+        self.clearHistory()
+        self.data = np.zeros(len(df), dtype=PROGRAM_DTYPE)
+        self.tick_names = ['tick1']
+        for colname in df.columns:
+            if colname in VALUE_COLUMNS:
+                self.data[colname] = df[colname].to_numpy()
+            else:
+                try:
+                    self.setTickColumn(
+                            colname, df[colname].fillna(0).to_numpy())
+                except ValueError:
+                    logger.warning("read_csv(): unknown column: %s", colname)
+        self.filename = filename
+        self.modified = False
+
+    def to_binary(self, filename='prog' + BINARY_SUFFIX):
+        '''バイナリ形式（.shotp）の書き出し（読み込んだファイル自身にも書ける）'''
+        writeBinaryFile(filename, len(self.data), self.tick_names,
+                        self.gen_condition, self.iterChunks())
+        self.filename = filename
+        self.modified = False
+
+    def read_binary(self, filename='prog' + BINARY_SUFFIX):
+        '''バイナリ形式（.shotp）の読み込み
+
+        行データは np.memmap で開くので，読み込みはすぐに終わり，
+        実際の読み出しは参照された行のページだけになる。
+        copy-on-write で開くので，編集してもファイルは変わらない。
+        '''
+        header, offset = readBinaryHeader(filename)
+        nrows = header['nrows']
+        self.clearHistory()
+        if nrows > 0:
+            self.data = np.memmap(filename, dtype=PROGRAM_DTYPE, mode='c',
+                                  offset=offset, shape=(nrows,))
+        else:
+            self.data = np.zeros(0, dtype=PROGRAM_DTYPE)
+        self.tick_names = header['tick_names']
+        self.gen_condition = header['gen_condition']
+        self.filename = filename
+        self.modified = False
+
+
+class lazyGridProgram:
+    '''3次元格子のプログラムを範囲の定義だけから必要な行ごとに生成するクラス
+
+    generateGridPosition と同じ点・同じ順序（ラスタまたは往復走査）・
+    同じ tick を，行番号からの計算で求める。
+    生成は定数時間・定数メモリで，len()，paramByIndex() による
+    任意の行の参照，iterChunks() による分割読み出しができる。
+    to_dataframe() は全体を展開する（大きなプログラムでは避ける）。
+    '''
+    ORDERS = (scanOrder.ORDER_RASTER, scanOrder.ORDER_SERPENTINE,
+              scanOrder.ORDER_SERPENTINE2)
+
+    def __init__(self, range_x, range_y, range_z,
+                 repetitions=1, settling_time=1.0,
+                 order=scanOrder.ORDER_RASTER):
+        '''
+        Args:
+            range_x (list): x軸方向の範囲。[start, stop[, step]] の形のリスト
+            range_y (list): y軸方向の範囲。[start, stop[, step]] の形のリスト
+            range_z (list): z軸方向の範囲。[start, stop[, step]] の形のリスト
+            repetitions (int, optional): 測定繰り返し回数 default=1
+            settling_time (float): セトリングタイム default=1.0
+            order (str, optional): lazyGridProgram.ORDERS のいずれか
+        '''
+        if order not in self.ORDERS:
+            raise ValueError(f"lazyGridProgram: unsupported order: {order}")
+        self.ranges = []
+        for rng in (range_x, range_y, range_z):
+            start, stop = float(rng[0]), float(rng[1])
+            step = float(rng[2]) if len(rng) >= 3 else 1.0
+            # np.arange(start, stop + step, step) と同じ点数
+            num = max(int(np.ceil((stop + step - start) / step)), 0)
+            self.ranges.append((start, step, num))
+        self.nx = self.ranges[0][2]
+        self.ny = self.ranges[1][2]
+        self.nz = self.ranges[2][2]
+        self.repetitions = repetitions
+        self.settling_time = settling_time
+        self.order = order
+        self.tick_names = ['tick1']
+        self.gen_condition = {
+                'range_x': list(range_x), 'range_y': list(range_y),
+                'range_z': list(range_z), 'order': order}
+        self.filename = None
+        self.modified = False
+
+    def __len__(self):
+        return self.nx * self.ny * self.nz
+
+    @property
+    def columns(self):
+        '''カラム名のリスト'''
+        return VALUE_COLUMNS + self.tick_names
+
+    def gridIndex(self, idx):
+        '''行番号（配列可）から格子の添字 (iy, ix, iz) と tick を求める
+
+        y 軸が最も遅く z 軸が高速軸（generateGridPosition の meshgrid と同じ）。
+        tick はライン（高速軸の1往路）ごとに反転する。
+        '''
+        idx = np.asarray(idx, dtype=np.int64)
+        line, k = np.divmod(idx, self.nz)
+        iy, j = np.divmod(line, self.nx)
+        if self.order == scanOrder.ORDER_SERPENTINE2:
+            ix = np.where(iy % 2 == 1, self.nx - 1 - j, j)
+        else:
+            ix = j
+        if self.order == scanOrder.ORDER_RASTER:
+            iz = k
+        else:
+            iz = np.where(line % 2 == 1, self.nz - 1 - k, k)
+        return iy, ix, iz, line % 2
+
+    def rows(self, start, stop):
+        '''start 行目から stop 行目の手前までのレコード配列'''
+        stop = min(stop, len(self))
+        idx = np.arange(start, max(stop, start))
+        iy, ix, iz, tick = self.gridIndex(idx)
+        (x0, dx, _), (y0, dy, _), (z0, dz, _) = self.ranges
+        records = np.zeros(len(idx), dtype=PROGRAM_DTYPE)
+        records['pos_x'] = x0 + ix * dx
+        records['pos_y'] = y0 + iy * dy
+        records['pos_z'] = z0 + iz * dz
+        records['settling_time'] = self.settling_time
+        records['repetitions'] = self.repetitions
+        records['ticks'] = tick
+        return records
+
+    def paramByIndex(self, idx):
+        '''インデックス指定でプログラムパラメータを取得（O(1)）'''
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"lazyGridProgram: index out of range: {idx}")
+        return self.rows(idx, idx + 1)[0]
+
+    def tick(self, idx, colname='tick1'):
+        '''idx 行目の tick（0 または 1）'''
+        if tickBit(colname) != 0:
+            return 0
+        return int(self.gridIndex(idx)[3])
+
+    def values(self, start, stop):
+        '''start 行目から stop 行目の手前までを columns の順の2次元配列で返す'''
+        return recordsToValues(self.rows(start, stop), self.columns)
+
+    def iterChunks(self, chunk_size=CHUNK_SIZE):
+        '''chunk_size 行ずつのレコード配列を順に返す'''
+        for start in range(0, len(self), chunk_size):
+            yield self.rows(start, start + chunk_size)
+
+    def __iter__(self):
+        '''1行ずつ paramByIndex と同じ形で返す'''
+        for chunk in self.iterChunks():
+            yield from chunk
+
+    def to_dataframe(self):
+        '''全体を展開した DataFrame'''
+        logger.info("lazyGridProgram: materializing %d rows", len(self))
+        return recordsToDataFrame(self.rows(0, len(self)), self.columns)
+
+    @property
+    def df(self):
+        '''to_dataframe() と同じ（読み出し専用）'''
+        return self.to_dataframe()
+
+    def materialize(self):
+        '''同じ内容の stageProgram を返す（編集や並べ替えのため）'''
+        prog = stageProgram()
+        prog.data = self.rows(0, len(self))
+        prog.gen_condition = dict(self.gen_condition)
+        return prog
+
+    def to_csv(self, filename='prog.csv'):
+        '''CSVの書き出し（分割して書くので全体を展開しない）'''
+        start = 0
+        for n, chunk in enumerate(self.iterChunks()):
+            recordsToDataFrame(chunk, self.columns, start).to_csv(
+                    filename, index_label='idx',
+                    mode='w' if n == 0 else 'a', header=(n == 0))
+            start += len(chunk)
+        self.filename = filename
+        self.modified = False
+
+    def to_binary(self, filename='prog' + BINARY_SUFFIX):
+        '''バイナリ形式（.shotp）の書き出し（分割して書く）'''
+        writeBinaryFile(filename, len(self), self.tick_names,
+                        self.gen_condition, self.iterChunks())
+        self.filename = filename
+        self.modified = False
 
 
 def test_data(
@@ -125,6 +968,48 @@ def test_data(
     return prog
 
 
+def benchmark(nrows=200000):
+    '''行の参照の速さ（rows/s）を比べる'''
+    import time
+
+    prog = test_data(range_x=(0, nrows // 100 - 1), range_y=(0, 9),
+                     range_z=(0, 9))
+    df = prog.to_dataframe()
+
+    def readRow(param):
+        return (param['pos_x'], param['pos_y'], param['pos_z'],
+                param['settling_time'], param['repetitions'])
+
+    reader = rowReader(prog)
+    lazy = lazyGridProgram((0, nrows // 100 - 1), (0, 9), (0, 9))
+    lazy_reader = rowReader(lazy)
+    cases = [
+            ('df.loc (pandas Series)', len(prog) // 100,
+             lambda idx: readRow(df.loc[idx])),
+            ('paramByIndex (numpy record)', len(prog),
+             lambda idx: readRow(prog.paramByIndex(idx))),
+            ('row (programRow)', len(prog),
+             lambda idx: readRow(prog.row(idx))),
+            ('rowReader.row (prefetch)', len(prog),
+             lambda idx: readRow(reader.row(idx))),
+            ('lazyGridProgram.paramByIndex', len(lazy) // 10,
+             lambda idx: readRow(lazy.paramByIndex(idx))),
+            ('rowReader.row (lazyGrid)', len(lazy),
+             lambda idx: readRow(lazy_reader.row(idx))),
+            ]
+    for name, n, func in cases:
+        t0 = time.perf_counter()
+        for idx in range(n):
+            func(idx)
+        elapsed = time.perf_counter() - t0
+        print(f"{name:30s}{n / elapsed:12.0f} rows/s")
+    t0 = time.perf_counter()
+    for param in rowReader(prog):
+        readRow(param)
+    print(f"{'rowReader iteration':30s}"
+          f"{len(prog) / (time.perf_counter() - t0):12.0f} rows/s")
+
+
 def test():
     '''テストコード'''
 
@@ -132,8 +1017,42 @@ def test():
     prog.to_csv('prog.csv')
     prog.read_csv('prog.csv')
 
-    print(prog)
+    print(prog.to_dataframe())
+    print(f"{prog.data.nbytes / len(prog):.0f} bytes/row")
+
+    convert('prog.csv', 'prog' + BINARY_SUFFIX, overwrite=True)
+    prog_bin = readProgram('prog' + BINARY_SUFFIX)
+    assert np.array_equal(prog_bin.data, prog.data)
+    reader = rowReader(prog_bin, chunk_size=100)
+    assert [p.pos_x for p in reader] == prog.data['pos_x'].tolist()
+    prog_bin.setValue(5, 'pos_x', -1.0)
+    assert reader.row(5).pos_x == -1.0
+    print(f"{os.path.getsize('prog' + BINARY_SUFFIX)} bytes")
 
 
 if __name__ == '__main__':
-    test()
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+            "files", nargs='*',
+            help="SRC DST: convert between CSV and binary (.shotp) programs")
+    parser.add_argument(
+            "--force", action='store_true',
+            help="overwrite DST if it exists")
+    parser.add_argument(
+            "--bench", action='store_true',
+            help="measure the speed of row access")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.bench:
+        benchmark()
+    elif len(args.files) == 2:
+        try:
+            convert(args.files[0], args.files[1], overwrite=args.force)
+        except FileExistsError as e:
+            parser.error(f"{e} (use --force to overwrite)")
+    elif len(args.files) == 0:
+        test()
+    else:
+        parser.error("give both SRC and DST")
@@ -0,0 +1,195 @@
+''' ステージプログラムのコマンド列への事前変換
+'''
+
+import logging
+import os
+
+import numpy as np
+
+import stage
+
+logger = logging.getLogger(__name__)
+
+COMPILE_FORMAT_VERSION = 1
+CACHE_SUFFIX = '.shotc.npz'
+
+
+class compiledProgram():
+    '''コマンド列に変換済みのステージプログラム
+
+    各行の A: と G: はエンコード済みのバイト列として1本のバッファに
+    連結されている。行 i のコマンドは buf[offsets[i]:offsets[i+1]]。
+    tick 出力は行ごとのビットパターン tick_bits として持ち，
+    実行時の出力状態と合成して（tickPattern()），移動と一緒に送る
+    O: を stage.OUTPUT_COMMANDS から引く。
+    positions は (nrows, 3) の float 配列，tick_bits は uint8 の配列。
+    '''
+
+    def __init__(self, buf, offsets, positions, tick_bits, tick_mask, key=''):
+        self.buf = buf
+        self.offsets = offsets
+        self.positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        self.tick_bits = np.asarray(tick_bits, dtype=np.uint8)
+        self.tick_mask = int(tick_mask)
+        self.key = key
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def moveCommand(self, row):
+        '''row 行目への移動コマンド（A: と G:）のバイト列'''
+        return self.buf[self.offsets[row]:self.offsets[row + 1]]
+
+    def position(self, row):
+        '''row 行目の位置 (pos_x, pos_y, pos_z) [mm]'''
+        return tuple(self.positions[row].tolist())
+
+    def tickPattern(self, row, io_out):
+        '''現在の出力状態 io_out に row 行目の tick を反映した出力パターン'''
+        return (io_out & ~self.tick_mask & 0b1111) | int(self.tick_bits[row])
+
+    def save(self, filename):
+        '''npz 形式で保存する'''
+        with open(filename, 'wb') as f:
+            np.savez(
+                    f,
+                    buf=np.frombuffer(self.buf, dtype=np.uint8),
+                    offsets=self.offsets,
+                    positions=self.positions,
+                    tick_bits=self.tick_bits,
+                    tick_mask=np.array(self.tick_mask),
+                    key=np.array(self.key))
+
+    @classmethod
+    def load(cls, filename):
+        '''save() で保存したものを読み込む'''
+        with np.load(filename) as npz:
+            return cls(
+                    npz['buf'].tobytes(),
+                    npz['offsets'],
+                    npz['positions'],
+                    npz['tick_bits'],
+                    int(npz['tick_mask']),
+                    str(npz['key']))
+
+
+def encodeMoveCommands(pulses):
+    '''パルス数の配列 (nrows, naxes) を A:W...\\r\\nG:\\r\\n の列に変換する
+
+    stage.stage.moveToCommand と同じ書式を NumPy でまとめて生成する。
+
+    Returns:
+        (bytes, numpy.ndarray): 連結したバイト列と，各行の開始位置（nrows+1 個）
+    '''
+    nrows = pulses.shape[0]
+    if nrows == 0:
+        return b'', np.zeros(1, dtype=np.int64)
+    cmds = np.full(nrows, 'A:W')
+    for ax in range(pulses.shape[1]):
+        p = pulses[:, ax]
+        cmds = np.char.add(cmds, np.where(p < 0, '-P', '+P'))
+        cmds = np.char.add(cmds, np.abs(p).astype(str))
+    cmds = np.char.add(cmds, '\r\nG:\r\n')
+    encoded = np.char.encode(cmds, 'ascii')
+    offsets = np.zeros(nrows + 1, dtype=np.int64)
+    np.cumsum(np.char.str_len(encoded), out=offsets[1:])
+    return b''.join(encoded.tolist()), offsets
+
+
+def compileProgram(prog, npulses_per_mm, tick_channels=None, key=''):
+    '''stageProgram をコマンド列に変換する
+
+    Args:
+        prog (program.stageProgram): 変換するプログラム
+        npulses_per_mm (float): stage.stage.npulses_per_mm
+        tick_channels (dict): tick のカラム名から出力チャネル番号への対応
+        key (str): キャッシュの照合に使う文字列
+
+    Returns:
+        compiledProgram: 変換結果
+    '''
+    if tick_channels is None:
+        tick_channels = {}
+    positions = prog.positions()
+    # stage.toPulses と同じく int() による 0 方向への切り捨て
+    pulses = (npulses_per_mm * positions).astype(np.int64)
+    buf, offsets = encodeMoveCommands(pulses)
+
+    tick_bits = np.zeros(len(prog), dtype=np.uint8)
+    tick_mask = 0
+    for colname, ch in tick_channels.items():
+        mask = 1 << (ch - 1)
+        tick_mask |= mask
+        if colname in prog.tick_names:
+            tick_bits |= np.where(prog.tickColumn(colname) == 1, mask, 0).astype(np.uint8)
+
+    logger.debug("compileProgram(): %d rows, %d bytes", len(prog), len(buf))
+    return compiledProgram(buf, offsets, positions, tick_bits, tick_mask, key)
+
+
+def cacheKey(filename, npulses_per_mm, tick_channels):
+    '''CSV ファイルと変換条件からキャッシュの照合用文字列を作る'''
+    st = os.stat(filename)
+    channels = ','.join(f"{k}:{v}" for k, v in sorted(tick_channels.items()))
+    return (f"v{COMPILE_FORMAT_VERSION}|{st.st_size}|{st.st_mtime_ns}"
+            f"|{npulses_per_mm}|{channels}")
+
+
+def loadOrCompile(prog, stg, tick_channels=None):
+    '''キャッシュがあれば読み込み，なければ変換してキャッシュする
+
+    キャッシュはプログラムの CSV の隣に <csv>.shotc.npz として置く。
+    CSV から読み込んでいない（または編集された）プログラムは毎回変換する。
+
+    Args:
+        prog (program.stageProgram): 変換するプログラム
+        stg (stage.stage): パルス換算に使うステージ
+        tick_channels (dict): tick のカラム名から出力チャネル番号への対応
+
+    Returns:
+        compiledProgram: 変換結果
+    '''
+    if tick_channels is None:
+        tick_channels = {}
+    if prog.filename is None or prog.modified is True:
+        return compileProgram(prog, stg.npulses_per_mm, tick_channels)
+
+    key = cacheKey(prog.filename, stg.npulses_per_mm, tick_channels)
+    cache_name = prog.filename + CACHE_SUFFIX
+    if os.path.exists(cache_name):
+        try:
+            compiled = compiledProgram.load(cache_name)
+            if compiled.key == key and len(compiled) == len(prog):
+                logger.debug("loadOrCompile(): cache hit: %s", cache_name)
+                return compiled
+        except (OSError, ValueError, KeyError):
+            logger.warning("loadOrCompile(): broken cache: %s", cache_name)
+
+    compiled = compileProgram(prog, stg.npulses_per_mm, tick_channels, key)
+    try:
+        compiled.save(cache_name)
+    except OSError:
+        logger.warning("loadOrCompile(): cannot write cache: %s", cache_name)
+    return compiled
+
+
+def test():
+    '''テストコード'''
+    import program
+
+    stg = stage.stage()
+    prog = program.test_data()
+    prog.setTick(11)
+    compiled = compileProgram(prog, stg.npulses_per_mm, {'tick1': 3})
+    for row in (0, 1, len(compiled) - 1):
+        param = prog.paramByIndex(row)
+        expected = stg.moveToCommand(
+                param['pos_x'], param['pos_y'], param['pos_z']) + '\r\nG:\r\n'
+        assert compiled.moveCommand(row) == expected.encode('utf-8')
+        tick = 0b0100 if prog.tick(row) == 1 else 0
+        assert compiled.tickPattern(row, 0b0001) == 0b0001 | tick
+    print(f"{len(compiled)} rows, {len(compiled.buf)} bytes")
+
+
+if __name__ == '__main__':
+    test()
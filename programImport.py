@@ -0,0 +1,364 @@
+''' 大きな CSV プログラムの分割読み込み
+'''
+
+import logging
+import os
+import tempfile
+import threading
+
+import numpy as np
+
+import program
+
+logger = logging.getLogger(__name__)
+
+PROGRESS_INTERVAL = 1       # 何チャンクごとに進捗を報告するか
+
+
+def checkColumns(columns):
+    '''CSV のカラム名を確かめ，tick のカラム名のリストを返す
+
+    VALUE_COLUMNS がすべてなければ ValueError。
+    tick1 ... tick8 以外の未知のカラムは警告して無視する。
+    stageProgram.read_csv と同じく tick1 は常に含める。
+    '''
+    missing = [c for c in program.VALUE_COLUMNS if c not in columns]
+    if missing:
+        raise ValueError(f"missing columns: {', '.join(missing)}")
+    tick_names = ['tick1']
+    for colname in columns:
+        if colname in program.VALUE_COLUMNS:
+            continue
+        try:
+            program.tickBit(colname)
+        except ValueError:
+            logger.warning("checkColumns(): unknown column: %s", colname)
+            continue
+        if colname not in tick_names:
+            tick_names.append(colname)
+    tick_names.sort(key=program.tickBit)
+    return tick_names
+
+
+def chunkToRecords(df, tick_names, first_line):
+    '''読み込んだ DataFrame の1チャンクを確かめてレコード配列にする
+
+    Args:
+        df (pandas.DataFrame): read_csv のチャンク
+        tick_names (list): tick のカラム名
+        first_line (int): チャンク先頭行のファイル上の行番号（エラー表示用）
+
+    Returns:
+        numpy.ndarray: PROGRAM_DTYPE のレコード配列
+    '''
+    import pandas as pd
+
+    def fail(colname, bad, what):
+        line = first_line + int(np.flatnonzero(bad)[0])
+        raise ValueError(f"line {line}: {colname}: {what}")
+
+    records = np.zeros(len(df), dtype=program.PROGRAM_DTYPE)
+    for colname in program.VALUE_COLUMNS:
+        values = pd.to_numeric(df[colname], errors='coerce').to_numpy(float)
+        bad = ~np.isfinite(values)
+        if bad.any():
+            fail(colname, bad, "not a number")
+        if colname == 'repetitions':
+            bad = (values != np.rint(values)) | (values < 0) | (values > 0xffff)
+            if bad.any():
+                fail(colname, bad, "not a repetition count")
+        elif colname == 'settling_time':
+            bad = values < 0
+            if bad.any():
+                fail(colname, bad, "negative time")
+        records[colname] = values
+    for colname in tick_names:
+        if colname not in df.columns:
+            continue
+        values = pd.to_numeric(df[colname], errors='coerce').fillna(0).to_numpy()
+        bad = (values != 0) & (values != 1)
+        if bad.any():
+            fail(colname, bad, "tick must be 0 or 1")
+        records['ticks'] |= (values != 0).astype(np.uint8) << program.tickBit(colname)
+    return records
+
+
+class csvImporter():
+    '''CSV プログラムを分割して読み，バイナリ形式（.shotp）に書き出す
+
+    pandas.read_csv を chunk_size 行ずつ読み，カラム名と値を確かめながら
+    .shotp に追記していくので，使うメモリはファイルの大きさによらない。
+    ヘッダの行数はチャンクごとに書き直すので，途中で止まっても
+    それまでの行は .shotp として読める。
+
+    start() で別スレッドで読み込み，program() の streamingProgram で
+    読み込み済みの行から参照（実行）できる。
+    進捗は progress(rows, bytes_read, total_bytes) で通知する
+    （読み込みのスレッドから呼ばれる）。最後の呼び出しは finished が
+    True になってから行う。
+
+    dst を指定しなければ一時ディレクトリに一時ファイルを作って書き出す
+    （temporary が True。removeTemporary() で消す）。dst がすでにあるときは
+    overwrite が True でなければ FileExistsError を送出する。
+    '''
+
+    def __init__(self, src, dst=None, chunk_size=program.CHUNK_SIZE,
+                 progress=None, overwrite=False):
+        self.src = src
+        self.temporary = dst is None
+        if dst is None:
+            fd, dst = tempfile.mkstemp(
+                    prefix=os.path.basename(src) + '.', suffix=program.BINARY_SUFFIX)
+            os.close(fd)
+        elif os.path.exists(dst) and not overwrite:
+            raise FileExistsError(f"csvImporter: {dst} already exists")
+        self.dst = dst
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.tick_names = ['tick1']
+        self.available = 0          # 書き出し済みの行数
+        self.bytes_read = 0
+        self.total_bytes = os.path.getsize(src)
+        self.error = None           # 失敗したときの例外
+        self.data_offset = None
+        self.done = threading.Event()
+        self.cancelled = threading.Event()
+        self.thread = None
+
+    @property
+    def finished(self):
+        '''読み込みが（成功か失敗で）終わったか'''
+        return self.done.is_set()
+
+    def run(self):
+        '''読み込みを行い，行数を返す（呼び出したスレッドで実行）'''
+        import pandas as pd
+
+        try:
+            # カラム名は最初に確かめておく
+            self.tick_names = checkColumns(list(pd.read_csv(
+                    self.src, header=0, index_col=0, nrows=0).columns))
+            with open(self.src, 'rb') as fin, open(self.dst, 'wb') as fout:
+                self.data_offset = self.reserveHeader(fout)
+                reader = pd.read_csv(fin, header=0, index_col=0,
+                                     chunksize=self.chunk_size)
+                for n, df in enumerate(reader):
+                    if self.cancelled.is_set():
+                        raise ValueError("import cancelled")
+                    records = chunkToRecords(
+                            df, self.tick_names, self.available + 2)
+                    fout.seek(0, os.SEEK_END)
+                    fout.write(records.tobytes())
+                    self.writeHeader(fout, self.available + len(records))
+                    fout.flush()
+                    self.available += len(records)
+                    self.bytes_read = fin.tell()
+                    if self.progress is not None and n % PROGRESS_INTERVAL == 0:
+                        self.progress(
+                                self.available, self.bytes_read, self.total_bytes)
+            self.bytes_read = self.total_bytes
+            logger.info("csvImporter: %s -> %s (%d rows)",
+                        self.src, self.dst, self.available)
+        except (OSError, ValueError) as e:
+            self.error = e
+            logger.warning("csvImporter: %s: %s", self.src, e)
+            if self.cancelled.is_set():
+                # 失敗したときは読み込めた行を表示に残すので，一時ファイルは
+                # streamingProgram.release()（プログラムを替えたとき）まで残す
+                self.removeTemporary()
+            raise
+        finally:
+            self.done.set()
+            # 終了（失敗を含む）も progress で知らせる
+            if self.progress is not None:
+                self.progress(self.available, self.bytes_read, self.total_bytes)
+        return self.available
+
+    def reserveHeader(self, f):
+        '''行数が増えても書き直せる長さでヘッダを書き，行データの開始位置を返す'''
+        offset = program.writeBinaryHeader(
+                f, np.iinfo(np.int64).max, self.tick_names, {})
+        self.writeHeader(f, 0, offset)
+        f.truncate(offset)
+        return offset
+
+    def writeHeader(self, f, nrows, offset=None):
+        '''ヘッダの行数を書き直す'''
+        f.seek(0)
+        program.writeBinaryHeader(
+                f, nrows, self.tick_names, {},
+                self.data_offset if offset is None else offset)
+
+    def removeTemporary(self):
+        '''一時ファイルに書き出していれば消す
+
+        POSIX では np.memmap で開いたままでも消せる（閉じるまで内容は残る）。
+        Windows など消せないときはそのままにする。
+        '''
+        if not self.temporary:
+            return
+        try:
+            os.unlink(self.dst)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.debug("csvImporter: cannot remove %s: %s", self.dst, e)
+
+    def start(self):
+        '''別スレッドで読み込みを始める'''
+        self.thread = threading.Thread(
+                target=self._runThread, name='csvImporter', daemon=True)
+        self.thread.start()
+
+    def _runThread(self):
+        try:
+            self.run()
+        except (OSError, ValueError):
+            pass    # self.error に記録済み
+
+    def cancel(self):
+        '''読み込みを中断する'''
+        self.cancelled.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def wait(self, timeout=None):
+        '''読み込みの終了を待つ。失敗していれば例外を送出する'''
+        self.done.wait(timeout)
+        if self.error is not None:
+            raise self.error
+        return self.finished
+
+    def program(self):
+        '''読み込み済みの行を参照する streamingProgram'''
+        return streamingProgram(self)
+
+
+class streamingProgram:
+    '''csvImporter が書き出し中の .shotp を参照するプログラム
+
+    len() は読み込み済みの行数で，読み込みが進むと増える。
+    行は .shotp を np.memmap で開いて参照する（必要なときに開き直す）。
+    読み込みが終わったら materialize() で stageProgram にする。
+    '''
+
+    def __init__(self, importer):
+        self.importer = importer
+        self.data = np.zeros(0, dtype=program.PROGRAM_DTYPE)
+        self.gen_condition = {}
+        self.filename = importer.src
+        self.modified = False
+        self.materialized = None    # materialize() の結果
+
+    def __len__(self):
+        return self.importer.available
+
+    @property
+    def tick_names(self):
+        return self.importer.tick_names
+
+    @property
+    def columns(self):
+        '''カラム名のリスト'''
+        return program.VALUE_COLUMNS + self.tick_names
+
+    @property
+    def finished(self):
+        '''すべての行が読み込まれたか'''
+        return self.importer.finished and self.importer.error is None
+
+    @property
+    def growing(self):
+        '''まだ行が増えるか（読み込み中か）'''
+        return not self.importer.finished
+
+    def rows(self, start, stop):
+        '''start 行目から stop 行目の手前までのレコード配列'''
+        if self.materialized is not None:
+            # 一時ファイルは消してあるので開き直さない
+            return self.materialized.rows(start, stop)
+        nrows = len(self)
+        stop = min(stop, nrows)
+        if stop > len(self.data):
+            self.data = np.memmap(
+                    self.importer.dst, dtype=program.PROGRAM_DTYPE, mode='r',
+                    offset=self.importer.data_offset, shape=(nrows,))
+        return self.data[start:stop]
+
+    def paramByIndex(self, idx):
+        '''インデックス指定でプログラムパラメータを取得'''
+        if idx >= len(self):
+            raise IndexError(f"streamingProgram: row {idx} is not loaded yet")
+        return self.rows(idx, idx + 1)[0]
+
+    def tick(self, idx, colname='tick1'):
+        '''idx 行目の tick（0 または 1）'''
+        if colname not in self.tick_names:
+            return 0
+        return (int(self.paramByIndex(idx)['ticks']) >> program.tickBit(colname)) & 1
+
+    def values(self, start, stop):
+        '''start 行目から stop 行目の手前までを columns の順の2次元配列で返す'''
+        return program.recordsToValues(self.rows(start, stop), self.columns)
+
+    def iterChunks(self, chunk_size=program.CHUNK_SIZE):
+        '''読み込み済みの行を chunk_size 行ずつのレコード配列で順に返す'''
+        for start in range(0, len(self), chunk_size):
+            yield self.rows(start, start + chunk_size)
+
+    def materialize(self):
+        '''読み込みの終了を待ち，.shotp を開いた stageProgram を返す
+
+        一時ファイルは開いたあとに消すので，2回目からは同じものを返す。
+        '''
+        if self.materialized is None:
+            self.importer.wait()
+            prog = program.readProgram(self.importer.dst)
+            prog.filename = self.importer.src
+            self.importer.removeTemporary()
+            self.materialized = prog
+        return self.materialized
+
+    def release(self):
+        '''使い終わったとき（ほかのプログラムに替えたとき）に一時ファイルを消す
+
+        読み込み中なら中断する。読み込みに失敗して途中までの行を
+        表示していた場合も，ここで一時ファイルが消える。
+        '''
+        if not self.importer.finished:
+            self.importer.cancel()
+        self.importer.removeTemporary()
+
+    def to_csv(self, filename='prog.csv'):
+        '''CSVの書き出し'''
+        self.materialize().to_csv(filename)
+
+    def to_binary(self, filename='prog' + program.BINARY_SUFFIX):
+        '''バイナリ形式（.shotp）の書き出し'''
+        self.materialize().to_binary(filename)
+
+
+def test():
+    '''テストコード'''
+    import time
+
+    logging.basicConfig(level=logging.INFO)
+    prog = program.test_data()
+    prog.to_csv('prog.csv')
+
+    def progress(rows, bytes_read, total_bytes):
+        print(f"{rows:8d} rows {bytes_read / total_bytes * 100:5.1f} %")
+
+    importer = csvImporter('prog.csv', chunk_size=1000, progress=progress)
+    importer.start()
+    sprog = importer.program()
+    while len(sprog) == 0 and not importer.finished:
+        time.sleep(0.01)
+    print("first row:", sprog.paramByIndex(0))
+    importer.wait()
+    assert np.array_equal(sprog.rows(0, len(sprog)), prog.data)
+    assert np.array_equal(sprog.materialize().data, prog.data)
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,193 @@
+''' programTableModel クラス
+'''
+
+import collections
+import logging
+
+import numpy as np
+
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import Qt
+
+import program
+
+logger = logging.getLogger(__name__)
+
+
+class programTableModel(QtCore.QAbstractTableModel):
+    '''プログラムの配列をそのまま表示するテーブルモデル
+
+    セルの文字列は表示されるときに作る。values() でまとめて
+    FETCH_ROWS 行ずつ読み，行ごとの文字列を CACHE_ROWS 行まで
+    LRU で覚えておくので，行数によらず読み込みは一瞬で終わる。
+    書式はカラムの型で決める（整数のカラムと tick は INT_FORMAT）。
+    編集は setData から edit_func(row, column, value) に渡す
+    （None ならプログラムの setValue を直接呼ぶ）。
+    '''
+    CACHE_ROWS = 4096
+    FETCH_ROWS = 64
+    VALUE_FORMAT = '{:.3f}'
+    INT_FORMAT = '{:d}'
+
+    def __init__(self, prog=None, parent=None):
+        super().__init__(parent)
+        self.program = prog
+        self.nrows = 0 if prog is None else len(prog)
+        self.columns = [] if prog is None else list(prog.columns)
+        self.formatters = self.columnFormatters(self.columns)
+        self.cache = collections.OrderedDict()     # 行番号 -> 文字列のリスト
+        self.edit_func = None
+        self.row_colors = np.zeros(0, dtype=np.uint8)
+        self.brushes = [None]
+
+    def setProgram(self, prog, reset=True):
+        '''表示するプログラムを替える
+
+        reset=False は同じ内容のプログラムへの置き換え（展開したものなど）で，
+        ビューの現在位置や選択を保つ。
+        '''
+        if reset:
+            self.beginResetModel()
+        self.program = prog
+        self.cache.clear()
+        if reset:
+            self.nrows = len(prog)
+            self.columns = list(prog.columns)
+            self.formatters = self.columnFormatters(self.columns)
+            self.row_colors = np.zeros(0, dtype=np.uint8)
+            self.endResetModel()
+
+    def columnFormatters(self, columns):
+        '''カラムごとの値（float）を文字列にする関数のリスト'''
+        def formatInt(v):
+            return self.INT_FORMAT.format(int(v))
+
+        return [self.VALUE_FORMAT.format
+                if colname in program.VALUE_COLUMNS
+                and program.PROGRAM_DTYPE[colname].kind == 'f'
+                else formatInt for colname in columns]
+
+    def appendRows(self, nrows):
+        '''プログラムの nrows 行目までを表示する（読み込み中や適応走査で増えた行）'''
+        if nrows <= self.nrows:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.nrows, nrows - 1)
+        # 最後の行は途中まで読んだ状態で覚えているかもしれない
+        self.cache.pop(self.nrows - 1, None)
+        self.nrows = nrows
+        self.endInsertRows()
+
+    def rowsChanged(self, rows):
+        '''rows（昇順の行番号の配列）の表示を更新する'''
+        if len(rows) == 0:
+            return
+        for row in rows:
+            self.cache.pop(int(row), None)
+        self.dataChanged.emit(
+                self.index(int(rows[0]), 0),
+                self.index(int(rows[-1]), len(self.columns) - 1))
+
+    def setRowColors(self, row_colors, colors):
+        '''行の背景色を設定する
+
+        Args:
+            row_colors (numpy.ndarray): 行ごとの colors の番号（0 は色なし）
+            colors (list): 番号 1, 2, ... の QColor
+        '''
+        self.row_colors = np.asarray(row_colors, dtype=np.uint8)
+        self.brushes = [None] + [QtGui.QBrush(c) for c in colors]
+        if self.nrows > 0:
+            self.dataChanged.emit(
+                    self.index(0, 0),
+                    self.index(self.nrows - 1, len(self.columns) - 1),
+                    [Qt.BackgroundRole])
+
+    def rowText(self, row):
+        '''row 行目の文字列のリスト（LRU キャッシュを通す）'''
+        text = self.cache.get(row)
+        if text is not None:
+            self.cache.move_to_end(row)
+            return text
+        start = row - row % self.FETCH_ROWS
+        stop = min(start + self.FETCH_ROWS, self.nrows)
+        values = self.program.values(start, stop)
+        for r, vals in enumerate(values, start):
+            self.cache[r] = [fmt(v) for fmt, v in zip(self.formatters, vals.tolist())]
+            self.cache.move_to_end(r)
+        while len(self.cache) > self.CACHE_ROWS:
+            self.cache.popitem(last=False)
+        return self.cache[row]
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else self.nrows
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            return self.rowText(index.row())[index.column()]
+        if role == Qt.BackgroundRole:
+            row = index.row()
+            if row < len(self.row_colors):
+                return self.brushes[self.row_colors[row]]
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole:
+            return None
+        if orientation == Qt.Horizontal:
+            if section < len(self.columns):
+                return self.columns[section]
+            return None
+        return str(section)
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        if not getattr(self.program, 'editable', True):
+            return Qt.ItemIsSelectable | Qt.ItemIsEnabled
+        return Qt.ItemIsSelectable | Qt.ItemIsEnabled | Qt.ItemIsEditable
+
+    def setData(self, index, value, role=Qt.EditRole):
+        '''編集された値をプログラムに書き込む（表示はプログラムの通知で更新）'''
+        if not index.isValid() or role != Qt.EditRole:
+            return False
+        try:
+            value = float(value)
+        except ValueError:
+            logger.warning("setData(): not a number: %s", value)
+            return False
+        row, col = index.row(), index.column()
+        if self.edit_func is not None:
+            return bool(self.edit_func(row, col, value))
+        self.program.setValue(row, self.columns[col], value)
+        self.rowsChanged([row])
+        return True
+
+
+def test():
+    '''テストコード（100万行のプログラムを表示する）'''
+    import sys
+    import time
+
+    from PyQt5.QtWidgets import QApplication, QTableView
+
+    logging.basicConfig(level=logging.INFO)
+    app = QApplication(sys.argv)
+    prog = program.lazyGridProgram((0, 99), (0, 99), (0, 99))
+    t0 = time.perf_counter()
+    model = programTableModel(prog)
+    view = QTableView()
+    view.setModel(model)
+    view.show()
+    print(f"{len(prog)} rows shown in {time.perf_counter() - t0:.3f} s")
+    view.scrollToBottom()
+    print("last row:", model.rowText(len(prog) - 1))
+    app.exec_()
+
+
+if __name__ == '__main__':
+    test()
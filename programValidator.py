@@ -0,0 +1,219 @@
+''' プログラム全体の事前検査
+'''
+
+import logging
+
+import numpy as np
+
+import program
+import motionModel
+
+logger = logging.getLogger(__name__)
+
+PULSE_LIMIT = 268435455     # A: コマンドで指定できるパルス数の絶対値の上限
+QUANTIZATION_TOLERANCE = 1e-6   # パルスの格子からのずれの許容量 [パルス]
+
+# 行ごとの検査結果（ビットの組み合わせ）
+ISSUE_TRAVEL = 0x01         # 移動範囲（またはパルス数の範囲）の外
+ISSUE_STEP = 0x02           # 前の行からの移動量が max_step を超える
+ISSUE_RATE = 0x04           # 1行の所要時間が 1 / max_step_rate より短い
+ISSUE_QUANTIZATION = 0x08   # 位置がパルスの格子に乗っていない（切り捨てられる）
+ISSUE_DUPLICATE = 0x10      # 前の行と同じパルス位置（まとめられる）
+
+ISSUE_NAMES = {
+        ISSUE_TRAVEL: 'out of travel range',
+        ISSUE_STEP: 'step too large',
+        ISSUE_RATE: 'step rate too high',
+        ISSUE_QUANTIZATION: 'not on the pulse grid',
+        ISSUE_DUPLICATE: 'same pulse target as previous row',
+        }
+ERROR_ISSUES = ISSUE_TRAVEL | ISSUE_STEP    # 実行前に確認が必要なもの
+
+# config のキー（値は 'x,y,z' または1つの値。空なら検査しない）
+LIMIT_KEYS = {
+        'travel_min': 'travel_min',
+        'travel_max': 'travel_max',
+        'max_step': 'max_step',
+        'max_step_rate': 'max_step_rate',
+        }
+
+
+def parseAxisValues(text):
+    '''config の 'x,y,z' または1つの値を3軸分の配列にする（空なら None）'''
+    text = text.strip()
+    if text == '':
+        return None
+    values = [float(v) for v in text.split(',')]
+    if len(values) == 1:
+        values = values * 3
+    if len(values) != 3:
+        raise ValueError(f"parseAxisValues(): need 1 or 3 values: {text}")
+    return np.array(values)
+
+
+class programLimits():
+    '''検査の条件
+
+    travel_min, travel_max, max_step は軸ごとの配列 [mm]（None なら検査しない）。
+    max_step_rate は1秒あたりの行数の上限（None なら検査しない）。
+    '''
+
+    def __init__(self, travel_min=None, travel_max=None, max_step=None,
+                 max_step_rate=None):
+        self.travel_min = None if travel_min is None else np.asarray(travel_min, float)
+        self.travel_max = None if travel_max is None else np.asarray(travel_max, float)
+        self.max_step = None if max_step is None else np.asarray(max_step, float)
+        self.max_step_rate = max_step_rate
+
+    @classmethod
+    def fromConfig(cls, conf):
+        '''config（LIMIT_KEYS）から作る'''
+        rate = conf.get(LIMIT_KEYS['max_step_rate'], '').strip()
+        return cls(
+                travel_min=parseAxisValues(conf.get(LIMIT_KEYS['travel_min'], '')),
+                travel_max=parseAxisValues(conf.get(LIMIT_KEYS['travel_max'], '')),
+                max_step=parseAxisValues(conf.get(LIMIT_KEYS['max_step'], '')),
+                max_step_rate=float(rate) if rate != '' else None)
+
+
+class validationReport():
+    '''validateProgram() の結果
+
+    flags は行ごとの ISSUE_* の組み合わせ（uint8）。
+    '''
+
+    def __init__(self, flags, max_quantization_error):
+        self.flags = flags
+        self.max_quantization_error = max_quantization_error     # [mm]
+
+    def __len__(self):
+        return len(self.flags)
+
+    def rows(self, issues=0xff):
+        '''issues のいずれかに当たる行番号'''
+        return np.flatnonzero(self.flags & issues)
+
+    def count(self, issue):
+        '''issue に当たる行数'''
+        return int(np.count_nonzero(self.flags & issue))
+
+    @property
+    def ok(self):
+        '''ERROR_ISSUES に当たる行がないか'''
+        return not np.any(self.flags & ERROR_ISSUES)
+
+    def summary(self, max_rows=5):
+        '''検査結果の要約（文字列）'''
+        lines = [f"{len(self)} rows checked"]
+        for issue, name in ISSUE_NAMES.items():
+            rows = self.rows(issue)
+            if len(rows) == 0:
+                continue
+            shown = ', '.join(str(r) for r in rows[:max_rows])
+            if len(rows) > max_rows:
+                shown += ', ...'
+            level = 'error' if issue & ERROR_ISSUES else 'warning'
+            lines.append(f"{level}: {name}: {len(rows)} rows ({shown})")
+            if issue == ISSUE_QUANTIZATION:
+                lines.append(f"    max deviation {self.max_quantization_error * 1e3:.4f} um")
+        if len(lines) == 1:
+            lines.append("no problems found")
+        return '\n'.join(lines)
+
+
+def validateProgram(prog, stg, limits=None, model=None,
+                    trigger_duration=0.0, start=None):
+    '''プログラムの全行を検査する
+
+    iterChunks() のチャンクごとにまとめて検査するので，大きなプログラムでも
+    行ごとのループにはならない。パルスへの換算は stage.toPulses と同じ
+    （npulses_per_mm を掛けて 0 方向へ切り捨て）。
+
+    Args:
+        prog: stageProgram, lazyGridProgram など iterChunks() を持つプログラム
+        stg (stage.stage): パルスへの換算に使う
+        limits (programLimits): None なら移動範囲はパルス数の範囲だけを見る
+        model (motionModel.stageMotionModel): max_step_rate の検査に使う
+        trigger_duration (float): トリガ出力の時間 [s]
+        start (list): 実行開始時のステージ位置 [mm]
+
+    Returns:
+        validationReport
+    '''
+    if limits is None:
+        limits = programLimits()
+    if limits.max_step_rate is not None and model is None:
+        model = motionModel.stageMotionModel.fromStage(stg)
+    prev_pos = None if start is None else np.asarray(start, dtype=float)
+    prev_pulses = None
+    flags = np.zeros(len(prog), dtype=np.uint8)
+    max_error = 0.0
+    row = 0
+    for chunk in prog.iterChunks():
+        n = len(chunk)
+        pos = np.stack([np.asarray(chunk[ax], dtype=float)
+                        for ax in program.POSITION_COLUMNS], axis=1)
+        exact = stg.npulses_per_mm * pos
+        pulses = np.trunc(exact)
+        f = np.zeros(n, dtype=np.uint8)
+
+        out = np.any(np.abs(pulses) > PULSE_LIMIT, axis=1)
+        if limits.travel_min is not None:
+            out |= np.any(pos < limits.travel_min, axis=1)
+        if limits.travel_max is not None:
+            out |= np.any(pos > limits.travel_max, axis=1)
+        f[out] |= ISSUE_TRAVEL
+
+        deviation = np.abs(exact - pulses)
+        off_grid = np.any(deviation > QUANTIZATION_TOLERANCE, axis=1)
+        f[off_grid] |= ISSUE_QUANTIZATION
+        if off_grid.any():
+            max_error = max(max_error,
+                            float(deviation.max()) / stg.npulses_per_mm)
+
+        if limits.max_step is not None:
+            before = pos[:-1] if prev_pos is None else np.vstack([prev_pos, pos[:-1]])
+            steps = np.abs(pos[len(pos) - len(before):] - before)
+            f[n - len(before):][np.any(steps > limits.max_step, axis=1)] |= ISSUE_STEP
+
+        before = pulses[:-1] if prev_pulses is None else np.vstack([prev_pulses, pulses[:-1]])
+        same = np.all(pulses[n - len(before):] == before, axis=1)
+        f[n - len(before):][same] |= ISSUE_DUPLICATE
+
+        if limits.max_step_rate is not None:
+            times = model.estimateProgram(
+                    chunk, trigger_duration, start=prev_pos)['total_time']
+            f[times < 1 / limits.max_step_rate] |= ISSUE_RATE
+
+        flags[row:row + n] = f
+        row += n
+        prev_pos = pos[-1]
+        prev_pulses = pulses[-1:]
+    report = validationReport(flags, max_error)
+    logger.info("validateProgram(): %s", report.summary().replace('\n', '; '))
+    return report
+
+
+def test():
+    '''テストコード'''
+    import stage
+
+    stg = stage.stage()
+    prog = program.test_data(range_x=(0, 3), range_y=(0, 1), range_z=(0, 0))
+    prog.setValue(2, 'pos_x', 2.002)        # 2.002 * 500 は 1001 にわずかに届かない
+    prog.setValue(4, 'pos_x', prog.data['pos_x'][3])
+    prog.setValue(4, 'pos_y', prog.data['pos_y'][3])
+    prog.setValue(5, 'pos_y', 600000)
+    limits = programLimits(travel_min=[-100] * 3, travel_max=[100] * 3,
+                           max_step=[2] * 3, max_step_rate=1.0)
+    report = validateProgram(prog, stg, limits, start=[0, 0, 0])
+    print(prog.to_dataframe())
+    print(report.summary())
+    assert report.rows(ISSUE_QUANTIZATION).tolist() == [2]
+    assert report.rows(ISSUE_DUPLICATE).tolist() == [4]
+    assert 5 in report.rows(ISSUE_TRAVEL)
+    assert not report.ok
+
+
+if __name__ == '__main__':
+    test()
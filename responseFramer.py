@@ -0,0 +1,219 @@
+''' ステージからの応答の切り出しと要求への対応づけ
+'''
+
+import collections
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TIMEOUT = 5.0
+RESYNC_QUIET = 0.2      # 打ち切りのあと，この時間受信が途切れるまで受信データを捨てる [s]
+
+# コマンドごとの応答待ち時間 [s]
+COMMAND_TIMEOUTS = {
+        'Q:': 0.5,
+        '!:': 0.5,
+        'O:': 1.0,
+        'H:': 60.0,
+        }
+
+
+def commandTimeout(cmd):
+    '''コマンド文字列から応答待ち時間を決める'''
+    return COMMAND_TIMEOUTS.get(cmd[:2], DEFAULT_TIMEOUT)
+
+
+def splitCommands(data):
+    '''CRLF 区切りのコマンド列（bytes）をコマンド文字列のリストにする'''
+    return [c.decode('utf-8') for c in data.split(b'\r\n')[:-1]]
+
+
+class pendingReply():
+    '''応答待ちの要求1つ分'''
+    __slots__ = ('cmd', 'deadline', 'reply', 'token',
+                 'sent', 'received', 'write_time')
+
+    def __init__(self, cmd, sent, deadline, token=None):
+        self.cmd = cmd
+        self.deadline = deadline
+        self.reply = None       # 応答文字列。タイムアウトのときは ''
+        self.token = token      # 呼び出し側が自由に使う（Future など）
+        self.sent = sent        # 送出時刻
+        self.received = None    # 応答の受信時刻。タイムアウトのときは None
+        self.write_time = 0.0   # 書き出しにかかった時間（呼び出し側が設定）
+
+
+class responseFramer():
+    '''CRLF 区切りの応答を逐次切り出し，送出順に要求へ割り当てる
+
+    受信したバイト列を feed() に渡すと，完結した応答が取り出され，
+    応答待ちの要求に古い順に割り当てられる。
+    1回の読み出しに複数の応答が含まれていてもよい（パイプライン時）。
+
+    要求ごとに締切を持ち，expire() で締切を過ぎたものを打ち切る。
+    応答は送出順に返るので，締切は先行する要求より前にはならないようにする。
+
+    打ち切った要求の応答が遅れて届くと，次の要求の応答と取り違えて
+    以降がすべて1つずれる。そこで打ち切ったときは残りの応答待ちも打ち切り，
+    受信途中のデータを捨てて再同期に入る。再同期中（resyncing() が True）は
+    受信データを捨て，RESYNC_QUIET の間受信が途切れたら終わる。
+    呼び出し側は再同期が終わるまで新しい要求を送らない。
+    '''
+
+    def __init__(self):
+        self.buf = bytearray()
+        self.pending = collections.deque()
+        self.resync_until = None    # 再同期の終わる時刻（再同期中でなければ None）
+        self.unexpected = 0
+        self.expired = 0
+        self.discarded = 0          # 再同期中に捨てたバイト数
+
+    def clear(self):
+        '''受信途中のデータと応答待ちを破棄する'''
+        self.buf.clear()
+        self.pending.clear()
+        self.resync_until = None
+
+    def resyncing(self, now):
+        '''再同期中なら True（RESYNC_QUIET の間受信がなければ終わる）'''
+        if self.resync_until is None:
+            return False
+        if now < self.resync_until:
+            return True
+        logger.info("responseFramer: resynchronized (%d bytes discarded)", self.discarded)
+        self.resync_until = None
+        return False
+
+    def endResync(self):
+        '''再同期を打ち切る（待てない緊急のコマンドを送る前に）
+
+        受信途中のデータは捨てる。受信バッファの破棄は呼び出し側で行う。
+        '''
+        if self.resync_until is not None:
+            logger.info("responseFramer: resync ended early (%d bytes discarded)",
+                        self.discarded)
+        self.buf.clear()
+        self.resync_until = None
+
+    def expect(self, cmd, now, timeout=None, token=None):
+        '''送出したコマンドを応答待ちに登録する
+
+        Parameters
+        ----------
+        cmd: string
+            送出したコマンド
+        now: float
+            送出時刻 [s]
+        timeout: float or None
+            応答待ち時間。None なら commandTimeout(cmd)
+        token:
+            pendingReply.token に入れる値
+
+        Return
+        ------
+        req: pendingReply
+        '''
+        if timeout is None:
+            timeout = commandTimeout(cmd)
+        deadline = now + timeout
+        if self.pending:
+            # 先に送った要求の応答より前には届かない
+            deadline = max(deadline, self.pending[-1].deadline)
+        req = pendingReply(cmd, now, deadline, token)
+        self.pending.append(req)
+        return req
+
+    def feed(self, data, now=None):
+        '''受信データを追加し，応答の得られた要求を返す
+
+        now を与えると pendingReply.received に記録する。
+        再同期中は捨てる（受信があれば再同期を延ばす）。
+
+        Return
+        ------
+        done: list of pendingReply
+        '''
+        if self.resync_until is not None and data:
+            self.discarded += len(data)
+            if now is not None:
+                self.resync_until = max(self.resync_until, now + RESYNC_QUIET)
+            return []
+        self.buf.extend(data)
+        done = []
+        start = 0
+        while True:
+            pos = self.buf.find(b'\n', start)
+            if pos < 0:
+                break
+            line = bytes(self.buf[start:pos]).strip().decode('utf-8', errors='replace')
+            start = pos + 1
+            if not self.pending:
+                self.unexpected += 1
+                logger.warning("responseFramer: unexpected reply: %s", line)
+                continue
+            req = self.pending.popleft()
+            req.reply = line
+            req.received = now
+            done.append(req)
+        if start > 0:
+            del self.buf[:start]
+        return done
+
+    def expire(self, now):
+        '''締切を過ぎた要求を打ち切る
+
+        1つでも打ち切ったら，後の応答待ちもすべて打ち切って再同期に入る
+        （遅れた応答を後の要求に割り当てないため）。
+
+        Return
+        ------
+        expired: list of pendingReply
+            reply は '' になる
+        '''
+        if not self.pending or self.pending[0].deadline > now:
+            return []
+        logger.warning("responseFramer: timeout: %s (%d more pending dropped)",
+                       self.pending[0].cmd, len(self.pending) - 1)
+        expired = list(self.pending)
+        for req in expired:
+            req.reply = ''
+        self.expired += len(expired)
+        self.pending.clear()
+        self.buf.clear()
+        self.resync_until = now + RESYNC_QUIET
+        return expired
+
+    def nextDeadline(self):
+        '''最も早い締切（応答待ちがなければ None）'''
+        if not self.pending:
+            return None
+        return self.pending[0].deadline
+
+
+def test():
+    '''テストコード'''
+    framer = responseFramer()
+    # 長いコマンドの応答が届いたあとの短いコマンドは，長い締切を引き継がない
+    framer.expect('H:W', 0.0)
+    assert [req.reply for req in framer.feed(b'OK\r\n', 0.1)] == ['OK']
+    req = framer.expect('Q:', 1.0)
+    assert req.deadline == 1.0 + COMMAND_TIMEOUTS['Q:'], req.deadline
+    # 応答待ちが残っていれば，その締切より前にはしない
+    framer.expect('H:W', 2.0)
+    assert framer.expect('Q:', 2.1).deadline == 2.0 + COMMAND_TIMEOUTS['H:']
+    # 打ち切ったら残りも打ち切り，再同期中の受信は捨てる
+    expired = framer.expire(1.6)
+    assert [r.cmd for r in expired] == ['Q:', 'H:W', 'Q:'], expired
+    assert framer.resyncing(1.7)
+    assert framer.feed(b'OK\r\n', 1.7) == []
+    assert not framer.resyncing(1.7 + RESYNC_QUIET)
+    # 再同期を打ち切れば，すぐに送ったコマンドの応答を受け取る
+    framer.expire(framer.expect('Q:', 3.0).deadline)
+    framer.endResync()
+    framer.expect('L:W', 3.6)
+    assert [req.reply for req in framer.feed(b'OK\r\n', 3.61)] == ['OK']
+    print("ok")
+
+
+if __name__ == '__main__':
+    test()
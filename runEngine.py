@@ -0,0 +1,669 @@
+''' プログラム実行のエンジン（Qt に依存しない状態機械）
+'''
+
+import concurrent.futures
+import functools
+import logging
+import time
+
+import stage
+import program
+import completionDetector
+import motionModel
+
+logger = logging.getLogger(__name__)
+
+TRIGGER_DURATION = 0.1      # トリガ出力の時間 [s]（MyWindow と同じ）
+TRIGGER_CHANNEL = 1
+TICK_CHANNEL = 3
+
+# 状態
+STATE_IDLE = 'idle'             # 実行していない（手動の移動は監視する）
+STATE_MOVING = 'moving'         # 行の位置へ移動中
+STATE_SETTLING = 'settling'     # セトリング待ち
+STATE_TRIGGER = 'trigger'       # トリガ出力中
+STATE_WAITING = 'waiting'       # 次の行の読み込み待ち
+STATE_MEASURING = 'measuring'   # 適応走査の測定値の受け取りか点の追加（作業スレッド）
+STATES = (STATE_IDLE, STATE_MOVING, STATE_SETTLING, STATE_TRIGGER, STATE_WAITING,
+          STATE_MEASURING)
+
+# subscribe() で受け取るイベントと data の内容
+EVENT_STATE = 'state'           # state
+EVENT_ROW = 'row'               # row: 実行する行が変わった
+EVENT_ROWS_ADDED = 'rows_added'     # nrows: 適応走査で行が増えた
+EVENT_OUTPUT = 'output'         # channel, on: I/O 出力を変えた
+EVENT_POSITION = 'position'     # stage.query() の結果（pos_x, ..., ack3）
+EVENT_READY = 'ready'           # latency: 移動が完了した（None は不明）
+EVENT_BUSY = 'busy'             # 移動中の応答があった
+EVENT_STEP = 'step'             # row, io: 1行の実行が終わった
+EVENT_FINISHED = 'finished'     # reason ('end' / 'stopped'), steps
+
+FINISH_END = 'end'
+FINISH_STOPPED = 'stopped'
+
+
+class runEngine():
+    '''プログラムの実行（移動，完了待ち，tick，セトリング，トリガの繰り返し）
+
+    現在の行（row），繰り返しの残り回数，tick とトリガの出力，
+    移動完了の監視（completionDetector による問い合わせ）を持つ状態機械。
+    時間待ちは scheduler（asyncio のイベントループと同じ call_later,
+    call_soon_threadsafe を持つもの）に任せるので，Qt がなくても動く。
+    GUI は subscribe() でイベントを受け取って表示するだけにする。
+
+    rowReader で行を読むので，読み込み中のプログラム（growing が True の間は
+    次の行を待つ）や，measure() と refine() を持つ適応走査のプログラムも実行できる。
+    measure() と refine() は時間がかかる（測定サーバとの通信など）ので，
+    作業スレッドで実行し，終わってから次の行に進む。
+    '''
+
+    def __init__(self, stg, scheduler, astage=None, detector=None,
+                 trigger_duration=TRIGGER_DURATION,
+                 trigger_channel=TRIGGER_CHANNEL, tick_channel=TICK_CHANNEL):
+        '''
+        Args:
+            stg (stage.stage): ステージ
+            scheduler: call_later(delay, func, *args) と
+                call_soon_threadsafe(func, *args) を持つもの
+            astage (asyncStage.asyncStage): 動いていれば問い合わせに使う
+            detector (completionDetector.completionDetector): 移動完了の検出
+            trigger_duration (float): トリガ出力の時間 [s]
+            trigger_channel (int): トリガの出力チャネル
+            tick_channel (int): tick1 の出力チャネル
+        '''
+        self.stage = stg
+        self.scheduler = scheduler
+        self.astage = astage
+        self.detector = (completionDetector.completionDetector(stg)
+                         if detector is None else detector)
+        self.trigger_duration = trigger_duration
+        self.trigger_channel = trigger_channel
+        self.tick_channel = tick_channel
+        self.subscribers = []
+        self.state = STATE_IDLE
+        self.program = None
+        self.row_reader = None
+        self.compiled = None
+        self.row = 0
+        self.remaining_count = 0
+        self.step_handle = None     # セトリングまたはトリガの待ち
+        self.poll_handle = None
+        self.poll_cmd = completionDetector.POLL_QUERY
+        self.moving = False
+        self.query_in_flight = False
+        self.worker = None          # measure() と refine() を実行するスレッド
+        self.run_count = 0          # 作業スレッドの結果が今の実行のものか確かめる
+        self.resetStats()
+
+    def resetStats(self):
+        '''実行の統計をクリアする'''
+        self.steps = 0
+        self.io_stats = stage.stage.emptyIOStats()
+        self.timings = []       # (予測移動時間, 実測移動時間, 実測ステップ時間, 予定ステップ時間)
+        self.step_t_move = None
+        self.step_predicted_move = 0.0
+        self.step_measured_move = None
+        self.t_started = None
+        self.t_finished = None
+        self.phase_time = {state: 0.0 for state in STATES}     # 状態ごとの時間 [s]
+        self.t_state = None
+
+    @property
+    def running(self):
+        '''プログラムを実行中か'''
+        return self.state != STATE_IDLE
+
+    def subscribe(self, func):
+        '''イベントの通知先を登録する。func(event, data) の data は dict'''
+        self.subscribers.append(func)
+
+    def unsubscribe(self, func):
+        '''イベントの通知先を外す'''
+        if func in self.subscribers:
+            self.subscribers.remove(func)
+
+    def emit(self, event, **data):
+        for func in list(self.subscribers):
+            func(event, data)
+
+    def setState(self, state):
+        if state != self.state:
+            now = time.monotonic()
+            if self.t_state is not None:
+                self.phase_time[self.state] += now - self.t_state
+            self.t_state = now
+            self.state = state
+            self.emit(EVENT_STATE, state=state)
+
+    def setProgram(self, prog, compiled=None):
+        '''実行するプログラムを替える（実行中は同じ内容のものへの置き換えに限る）'''
+        self.program = prog
+        self.row_reader = program.rowReader(prog)
+        self.compiled = compiled
+
+    # -------- 実行 --------
+
+    def run(self, prog=None, start_row=0, compiled=None):
+        '''start_row 行目から実行を始める
+
+        Args:
+            prog: 実行するプログラム（None なら setProgram() したもの）
+            compiled (programCompiler.compiledProgram): 変換済みのコマンド
+        '''
+        if self.running:
+            raise RuntimeError("runEngine.run(): already running")
+        if prog is not None:
+            self.setProgram(prog, compiled)
+        elif compiled is not None:
+            self.compiled = compiled
+        if self.program is None or start_row >= len(self.program):
+            raise ValueError(f"runEngine.run(): no row {start_row} to run")
+        self.resetStats()
+        self.detector.resetStats()
+        self.stage.endStep()
+        self.t_started = time.monotonic()
+        self.t_state = self.t_started
+        self.run_count += 1
+        self.row = start_row
+        logger.debug("run(): start_row:%d", start_row)
+        self.emit(EVENT_ROW, row=self.row)
+        self.moveToRow()
+
+    def stop(self, stop_stage=True):
+        '''実行を中断する
+
+        stop_stage が True なら，実行の状態を片付ける前にステージの移動を
+        止める（L:，実行中でなくても送る）。
+        '''
+        if stop_stage:
+            self.stopStage()
+        if not self.running:
+            return
+        self.cancelStep()
+        if self.state in (STATE_TRIGGER, STATE_WAITING, STATE_MEASURING):
+            self.output(self.trigger_channel, False)
+        self.finish(FINISH_STOPPED)
+
+    def rowsAdded(self):
+        '''読み込み中のプログラムの行が増えたか，読み込みが終わったときに呼ぶ'''
+        if self.state == STATE_WAITING:
+            self.nextRow()
+
+    def cancelStep(self):
+        if self.step_handle is not None:
+            self.step_handle.cancel()
+            self.step_handle = None
+
+    def moveToRow(self):
+        '''トリガの OFF，その行の tick と，行の位置への移動を1往復で送出する
+
+        astage が動いていれば非同期に送出し，送り終えてから完了の監視を始める
+        '''
+        val = self.stage.outputPattern(self.trigger_channel, stage.IO_OFF)
+        tick_bit = 1 << (self.tick_channel - 1)
+        start = list(self.stage.last_move_to)
+        if self.compiled is not None:
+            val = self.compiled.tickPattern(self.row, val)
+            target = list(self.compiled.position(self.row))
+            move_data = self.compiled.moveCommand(self.row)
+            if self.asyncRunning():
+                coro = self.astage.outputAndMoveEncoded(val, move_data, target)
+            else:
+                self.stage.outputAndMoveEncoded(val, move_data, target)
+        else:
+            param = self.row_reader.row(self.row)
+            val = val | tick_bit if param.tick() == 1 else val & ~tick_bit
+            target = [param.pos_x, param.pos_y, param.pos_z]
+            if self.asyncRunning():
+                coro = self.astage.outputAndMoveTo(val, *target)
+            else:
+                self.stage.outputAndMoveTo(val, *target)
+        self.cancelPoll()
+        self.emit(EVENT_OUTPUT, channel=self.trigger_channel, on=False)
+        self.emit(EVENT_OUTPUT, channel=self.tick_channel, on=bool(val & tick_bit))
+        self.setState(STATE_MOVING)
+        if self.asyncRunning():
+            self.submitThen(coro, self.moveSent, start, target)
+        else:
+            self.watchMove(start, target)
+
+    def startRow(self):
+        '''移動が終わった行のセトリングを始める（tick は moveToRow() で出力済み）'''
+        param = self.row_reader.row(self.row)
+        self.remaining_count = param.repetitions
+        self.setState(STATE_SETTLING)
+        self.step_handle = self.scheduler.call_later(
+                param.settling_time, self.settlingTimeup)
+        logger.debug("startRow(): row:%d settling_time:%f repetitions:%d",
+                     self.row, param.settling_time, self.remaining_count)
+
+    def settlingTimeup(self):
+        '''セトリングが終わったらトリガを出力する'''
+        self.step_handle = None
+        if self.state != STATE_SETTLING:
+            return
+        self.setState(STATE_TRIGGER)
+        self.step_handle = self.scheduler.call_later(
+                self.trigger_duration, self.triggerTimeup)
+        self.output(self.trigger_channel, True)
+
+    def triggerTimeup(self):
+        '''トリガの出力が終わったら，繰り返すか次の行に進む'''
+        self.step_handle = None
+        if self.state != STATE_TRIGGER:
+            return
+        self.remaining_count -= 1
+        if self.remaining_count > 0:
+            self.output(self.trigger_channel, False)
+            self.setState(STATE_SETTLING)
+            self.step_handle = self.scheduler.call_later(
+                    self.row_reader.row(self.row).settling_time,
+                    self.settlingTimeup)
+            return
+        self.countStep()
+        if hasattr(self.program, 'measure'):
+            # トリガを出し終えた点の測定値を受け取ってから次の行に進む
+            self.setState(STATE_MEASURING)
+            self.runInWorker(self.program.measure, (self.row,), self.measured)
+            return
+        self.nextRow()
+
+    def measured(self, run_count, value):
+        '''measure() が終わったら次の行に進む'''
+        if run_count != self.run_count or self.state != STATE_MEASURING:
+            return
+        self.nextRow()
+
+    def nextRow(self):
+        '''次の行に進む。最後の行なら終了する'''
+        if self.row + 1 < len(self.program):
+            self.row += 1
+        elif getattr(self.program, 'growing', False):
+            # 次の行の読み込みを待つ（rowsAdded() で再開）
+            self.setState(STATE_WAITING)
+            return
+        elif hasattr(self.program, 'refine'):
+            # 測定値の勾配が大きいところに点を追加する（refined() で再開）
+            self.setState(STATE_MEASURING)
+            self.runInWorker(self.program.refine,
+                             (list(self.stage.last_move_to),), self.refined)
+            return
+        else:
+            self.finishRows()
+            return
+        self.emit(EVENT_ROW, row=self.row)
+        self.moveToRow()
+
+    def refined(self, run_count, nrows):
+        '''refine() が終わったら，追加した点に進むか終了する'''
+        if run_count != self.run_count or self.state != STATE_MEASURING:
+            return
+        if not nrows:
+            self.finishRows()
+            return
+        self.emit(EVENT_ROWS_ADDED, nrows=len(self.program))
+        self.row += 1
+        self.emit(EVENT_ROW, row=self.row)
+        self.moveToRow()
+
+    def finishRows(self):
+        '''最後の行まで実行したので終了する'''
+        self.output(self.trigger_channel, False)
+        self.finish(FINISH_END)
+
+    def runInWorker(self, func, args, then):
+        '''func(*args) を作業スレッドで実行し，終わったら scheduler で
+        then(run_count, 結果) を呼ぶ（結果は futureResult() のとおり）
+        '''
+        if self.worker is None:
+            self.worker = concurrent.futures.ThreadPoolExecutor(
+                    1, thread_name_prefix='runEngine')
+        fut = self.worker.submit(func, *args)
+        then = functools.partial(then, self.run_count)
+
+        def done(f):
+            if not f.cancelled() and f.exception() is not None:
+                logger.error("runInWorker(): %s failed: %r", func.__name__, f.exception())
+            self.scheduler.call_soon_threadsafe(then, futureResult(f))
+
+        fut.add_done_callback(done)
+
+    def finish(self, reason):
+        self.t_finished = time.monotonic()
+        self.setState(STATE_IDLE)
+        self.logStats()
+        self.emit(EVENT_FINISHED, reason=reason, steps=self.steps)
+
+    def countStep(self):
+        '''1ステップ分の通信量と所要時間を集計する'''
+        if self.step_t_move is not None and self.step_measured_move is not None:
+            param = self.row_reader.row(self.row)
+            self.timings.append((
+                    self.step_predicted_move,
+                    self.step_measured_move,
+                    time.monotonic() - self.step_t_move,
+                    self.step_measured_move + param.repetitions * (
+                        param.settling_time + self.trigger_duration)))
+        self.step_t_move = None
+        self.step_measured_move = None
+        io = self.stage.endStep()
+        logger.debug("step I/O: %s", io)
+        self.steps += 1
+        for k, v in io.items():
+            self.io_stats[k] += v
+        self.emit(EVENT_STEP, row=self.row, io=io)
+
+    def output(self, ch, on):
+        '''ch の出力を on にする（astage が動いていれば応答を待たない）
+
+        EVENT_OUTPUT は応答が届いてから発行する
+        '''
+        on_off = stage.IO_ON if on else stage.IO_OFF
+        if self.asyncRunning():
+            self.submitThen(self.astage.digitalWrite(ch, on_off),
+                            self.outputDone, ch, on)
+            return
+        self.stage.digitalWrite(ch, on_off)
+        self.emit(EVENT_OUTPUT, channel=ch, on=on)
+
+    def outputDone(self, ch, on, result):
+        '''非同期に送出した出力コマンドの応答を処理する'''
+        if result is None:
+            logger.warning("outputDone(): output command to ch %d failed", ch)
+            return
+        self.emit(EVENT_OUTPUT, channel=ch, on=on)
+
+    def resetOrigin(self):
+        '''現在位置を電気（論理）原点にし，位置を問い合わせる'''
+        if self.asyncRunning():
+            self.submitThen(self.astage.resetOrigin(),
+                            lambda result: self.query())
+            return
+        self.stage.resetOrigin()
+        self.query()
+
+    def gotoMechanicalOrigin(self):
+        '''機械原点復帰を始め，完了を監視する'''
+        if self.asyncRunning():
+            self.submitThen(self.astage.gotoMechanicalOrigin(),
+                            self.moveSent, None, None)
+            return
+        self.stage.gotoMechanicalOrigin()
+        self.watchMove(None, None)
+
+    def stats(self):
+        '''実行の統計
+
+        Return
+        ------
+        stats: dict
+            steps, elapsed, steps_per_s と，ステップあたりの
+            round_trips, bytes_written, bytes_read，completionDetector.stats() の各項目，
+            phase_time（moving, settling, trigger, waiting の合計時間 [s]）
+        '''
+        elapsed = 0.0
+        if self.t_started is not None:
+            t_end = time.monotonic() if self.t_finished is None else self.t_finished
+            elapsed = t_end - self.t_started
+        n = max(self.steps, 1)
+        ret = {
+                'steps': self.steps,
+                'elapsed': elapsed,
+                'steps_per_s': self.steps / elapsed if elapsed > 0 else 0.0,
+                }
+        for k, v in self.io_stats.items():
+            ret[f'{k}_per_step'] = v / n
+        ret.update(self.detector.stats())
+        ret['phase_time'] = {state: t for state, t in self.phase_time.items()
+                             if state != STATE_IDLE}
+        return ret
+
+    def logStats(self):
+        st = self.stats()
+        if self.steps > 0:
+            logger.info(
+                    "run I/O: %d steps, %.1f round trips/step, "
+                    "%.1f bytes written/step, %.1f bytes read/step",
+                    self.steps, st['round_trips_per_step'],
+                    st['bytes_written_per_step'], st['bytes_read_per_step'])
+        if st['moves'] > 0:
+            logger.info(
+                    "move completion: %d moves, %.1f polls/move, "
+                    "ready latency mean %.1f ms max %.1f ms, "
+                    "prediction error %.1f ms",
+                    st['moves'], st['polls_per_move'],
+                    st['ready_latency_mean'] * 1e3,
+                    st['ready_latency_max'] * 1e3,
+                    st['prediction_error_mean'] * 1e3)
+
+    # -------- 移動と完了の監視 --------
+
+    def moveTo(self, pos_x, pos_y, pos_z):
+        '''指定された位置にステージを移動し，完了を監視する'''
+        start = list(self.stage.last_move_to)
+        target = [pos_x, pos_y, pos_z]
+        if self.asyncRunning():
+            self.cancelPoll()
+            self.submitThen(self.astage.moveTo(pos_x, pos_y, pos_z),
+                            self.moveSent, start, target)
+            return
+        self.stage.moveTo(pos_x, pos_y, pos_z)
+        self.watchMove(start, target)
+
+    def moveSent(self, start, target, result):
+        '''非同期に送出した移動コマンドの応答が揃ったら完了の監視を始める'''
+        if result is None:
+            logger.warning("moveSent(): move command to %s failed", target)
+        self.watchMove(start, target)
+
+    def watchMove(self, start, target):
+        '''移動の完了監視を開始する
+
+        start, target が None のときは終了時刻を予測せず一定間隔で問い合わせる
+        '''
+        self.moving = True
+        now = time.monotonic()
+        self.detector.startMove(start, target, now)
+        if self.running and start is not None:
+            # 駆動モデルの較正用に，補正前の予測と実測を記録する
+            model = self.detector.model
+            if model is None:
+                model = motionModel.stageMotionModel.fromStage(self.stage)
+            self.step_t_move = now
+            self.step_predicted_move = motionModel.stageMotionModel(
+                    model.axes).moveTime(start, target)
+        self.schedulePoll()
+
+    def stopStage(self):
+        '''ステージを止める'''
+        if self.astage is not None and self.astage.isRunning():
+            # 優先度付きで送出するので，待ち行列の Q: などを追い越す
+            self.astage.submit(self.astage.stop())
+        else:
+            self.stage.stop()
+        self.cancelPoll()
+        if self.moving is True:
+            # 停止後の終了時刻は予測できないので一定間隔の監視にする
+            self.detector.startMove(None, None, time.monotonic())
+        self.query()
+
+    def schedulePoll(self):
+        '''次の問い合わせを予約する'''
+        self.cancelPoll()
+        delay, self.poll_cmd = self.detector.nextPoll(time.monotonic())
+        self.poll_handle = self.scheduler.call_later(delay, self.pollStage)
+
+    def cancelPoll(self):
+        if self.poll_handle is not None:
+            self.poll_handle.cancel()
+            self.poll_handle = None
+
+    def pollStage(self):
+        '''予約したコマンドで問い合わせる'''
+        self.poll_handle = None
+        if self.poll_cmd == completionDetector.POLL_STATUS:
+            self.statusInfo()
+        else:
+            self.query()
+
+    def asyncRunning(self):
+        return self.astage is not None and self.astage.isRunning()
+
+    def submitThen(self, coro, func, *args):
+        '''astage でコルーチンを実行し，終わったら scheduler で func(*args, 結果) を呼ぶ
+
+        結果は futureResult() のとおり（失敗なら None）
+        '''
+        fut = self.astage.submit(coro)
+        fut.add_done_callback(
+                lambda f: self.scheduler.call_soon_threadsafe(
+                    func, *args, futureResult(f)))
+
+    def query(self):
+        '''ステージの状態を問い合わせる（astage が動いていれば非同期に）
+
+        結果は updateQueryInfo で処理する。問い合わせ中であれば何もしない。
+        '''
+        if not self.asyncRunning():
+            self.updateQueryInfo(self.stage.query())
+            return
+        if self.query_in_flight is True:
+            return
+        self.query_in_flight = True
+        self.submitThen(self.astage.query(), self.updateQueryInfo)
+
+    def statusInfo(self):
+        '''Busy/Ready だけを問い合わせる（!:）。結果は updateStatus で処理する'''
+        if not self.asyncRunning():
+            self.updateStatus(self.stage.isReady())
+            return
+        self.submitThen(self.astage.isReady(), self.updateStatus)
+
+    def updateStatus(self, ready):
+        '''!: の結果を処理する。Ready なら移動完了とし，位置のために Q: を送る'''
+        if self.moving is not True:
+            return
+        if ready is None:
+            self.schedulePoll()
+            return
+        self.detector.reportStatus(ready, time.monotonic())
+        if ready is True:
+            self.moveCompleted()
+            self.query()
+        else:
+            self.schedulePoll()
+
+    def updateQueryInfo(self, buf):
+        '''Q: の結果を処理する。移動中に Ready なら移動完了'''
+        self.query_in_flight = False
+        logger.debug("updateQueryInfo: %s", buf)
+        if isinstance(buf, dict):
+            self.emit(EVENT_POSITION, **buf)
+            if buf['ack3'] == 'R':
+                self.stage.last_move_to = [
+                        buf['pos_x'], buf['pos_y'], buf['pos_z']]
+                if self.moving is True:
+                    self.detector.reportStatus(True, time.monotonic())
+                    self.moveCompleted()
+                else:
+                    self.emit(EVENT_READY, latency=None)
+            else:
+                self.emit(EVENT_BUSY)
+                if self.moving is True:
+                    self.detector.reportStatus(False, time.monotonic())
+                    self.schedulePoll()
+        elif self.moving is True:
+            self.schedulePoll()
+
+    def moveCompleted(self):
+        '''移動完了。実行中ならその行のセトリングを始める'''
+        self.moving = False
+        self.cancelPoll()
+        if self.running and self.step_t_move is not None:
+            self.step_measured_move = time.monotonic() - self.step_t_move
+        self.emit(EVENT_READY, latency=self.detector.last_latency)
+        if self.state == STATE_MOVING:
+            self.startRow()
+
+    def runUntilComplete(self, prog, start_row=0, compiled=None):
+        '''scheduler が asyncio のイベントループのとき，最後まで実行する
+
+        run() やその後のコールバック（通信の失敗など）が例外を送出したら，
+        実行を止めてその例外を送出する（完了を待ち続けない）。
+
+        Returns:
+            dict: EVENT_FINISHED の data
+        '''
+        loop = self.scheduler
+        done = loop.create_future()
+
+        def finished(event, data):
+            if event == EVENT_FINISHED and not done.done():
+                done.set_result(data)
+
+        def start():
+            try:
+                self.run(prog, start_row, compiled)
+            except Exception as e:
+                if not done.done():
+                    done.set_exception(e)
+
+        def failed(loop, context):
+            loop.default_exception_handler(context)
+            if context.get('exception') is not None and not done.done():
+                done.set_exception(context['exception'])
+
+        self.subscribe(finished)
+        handler = loop.get_exception_handler()
+        loop.set_exception_handler(failed)
+        try:
+            loop.call_soon(start)
+            return loop.run_until_complete(done)
+        except Exception:
+            if self.running:
+                self.cancelStep()
+                self.cancelPoll()
+                self.finish(FINISH_STOPPED)
+            raise
+        finally:
+            loop.set_exception_handler(handler)
+            self.unsubscribe(finished)
+
+
+def futureResult(fut):
+    '''concurrent.futures.Future の結果（失敗なら None）'''
+    if fut.cancelled() or fut.exception() is not None:
+        return None
+    return fut.result()
+
+
+def test():
+    '''テストコード（shotEmulator で表示なしに実行する）'''
+    import asyncio
+    import shotEmulator
+
+    logging.basicConfig(level=logging.INFO)
+    emu = shotEmulator.shotEmulator()
+    stg = stage.stage()
+    stg.openSerial(emu.start())
+    loop = asyncio.new_event_loop()
+    try:
+        stg.getInfo()
+        engine = runEngine(stg, loop, trigger_duration=0.01)
+        prog = program.test_data(range_x=(0, 1), range_y=(0, 1), range_z=(0, 1),
+                                 settling_time=0.01)
+        events = {}
+        engine.subscribe(
+                lambda event, data: events.__setitem__(event, events.get(event, 0) + 1))
+        print(engine.runUntilComplete(prog))
+        print(events)
+        print(engine.stats())
+        assert engine.steps == len(prog)
+    finally:
+        loop.close()
+        stg.ser.close()
+        emu.stop()
+
+
+if __name__ == '__main__':
+    test()
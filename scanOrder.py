@@ -0,0 +1,279 @@
+''' 測定点の走査順序
+'''
+
+import logging
+
+import numpy as np
+
+import motionModel
+
+logger = logging.getLogger(__name__)
+
+ORDER_RASTER = 'raster'             # meshgrid の順（高速軸は毎回先頭に戻る）
+ORDER_SERPENTINE = 'serpentine'     # 高速軸を往復
+ORDER_SERPENTINE2 = 'serpentine2'   # 高速軸と中間の軸を往復
+ORDER_HILBERT = 'hilbert'           # Hilbert 曲線
+ORDER_MORTON = 'morton'             # Morton（Z）曲線
+ORDER_NEAREST = 'nearest'           # 最近傍法 + 2-opt
+
+ORDER_AUTO = 'auto'                 # 点の数に応じて ORDER_NEAREST か ORDER_HILBERT + 2-opt
+
+ORDERS = (ORDER_RASTER, ORDER_SERPENTINE, ORDER_SERPENTINE2,
+          ORDER_HILBERT, ORDER_MORTON, ORDER_NEAREST)
+
+NEAREST_MAX_POINTS = 2000       # 最近傍法 + 2-opt が 1 s 程度で終わる点の数（O(n^2)）
+TWO_OPT_WINDOW = 64             # 2-opt で入れ替えを試す範囲（行数）
+LARGE_TWO_OPT_WINDOW = 16       # NEAREST_MAX_POINTS を超える点の 2-opt の範囲（行数）
+TWO_OPT_MAX_PASSES = 16
+
+
+def travelTimes(positions, model=None):
+    '''位置の列を順にたどるときの各区間の移動時間 [s]
+
+    各軸は同時に動くので，区間の時間は軸ごとの時間の最大値。
+
+    Args:
+        positions (numpy.ndarray): (n, 3) の位置 [mm]
+        model (motionModel.stageMotionModel): None ならデフォルトの速度設定
+
+    Returns:
+        numpy.ndarray: n-1 個の移動時間
+    '''
+    if model is None:
+        model = motionModel.stageMotionModel()
+    positions = np.asarray(positions, dtype=float)
+    if len(positions) < 2:
+        return np.zeros(0)
+    return model.moveTimes(positions)[1:]
+
+
+def pairTimes(p, q, model):
+    '''点の組 p, q (n, 3) の間の移動時間（配列）'''
+    t = np.zeros(np.broadcast_shapes(p.shape, q.shape)[:-1])
+    for ax, axis_model in enumerate(model.axes):
+        np.maximum(t, axis_model.moveTimes(p[..., ax], q[..., ax]), out=t)
+    return t * model.time_scale
+
+
+def serpentineOrder(shape, naxes=1):
+    '''C 順に並んだ格子 shape (nslow, nmid, nfast) の往復走査順
+
+    Args:
+        shape (tuple): 格子の形
+        naxes (int): 往復させる軸の数。1 なら高速軸だけ，2 なら中間の軸も
+
+    Returns:
+        numpy.ndarray: 平坦化したインデックスの並べ替え
+    '''
+    idx = np.arange(int(np.prod(shape))).reshape(shape)
+    if naxes >= 2:
+        # 奇数番目の面では中間の軸を逆にたどる
+        idx[1::2] = idx[1::2, ::-1]
+    lines = idx.reshape(-1, shape[-1])
+    lines[1::2] = lines[1::2, ::-1]
+    return lines.reshape(-1)
+
+
+def gridCoordinates(positions):
+    '''各軸の値をその軸での順位（0, 1, 2, ...）に置き換えた整数座標
+
+    値が1つしかない軸（16x16x1 の格子の z など）は除く。
+    残すと空間充填曲線がその軸の分も折り返して大きく跳ぶ。
+    '''
+    coords = []
+    for ax in range(positions.shape[1]):
+        _, inverse = np.unique(positions[:, ax], return_inverse=True)
+        if inverse.max(initial=0) > 0:
+            coords.append(inverse.astype(np.int64))
+    if not coords:
+        return np.zeros((len(positions), 1), dtype=np.int64)
+    return np.stack(coords, axis=1)
+
+
+def mortonKeys(coords):
+    '''整数座標 (n, naxes) の Morton 符号'''
+    nbits = max(int(coords.max()).bit_length(), 1)
+    keys = np.zeros(len(coords), dtype=np.int64)
+    for bit in range(nbits - 1, -1, -1):
+        for ax in range(coords.shape[1]):
+            keys = (keys << 1) | ((coords[:, ax] >> bit) & 1)
+    return keys
+
+
+def hilbertKeys(coords):
+    '''整数座標 (n, naxes) の Hilbert 曲線上の順番
+
+    J. Skilling, "Programming the Hilbert curve" (2004) の
+    AxestoTranspose を全点まとめて行う。
+    '''
+    x = coords.astype(np.int64).copy()
+    naxes = x.shape[1]
+    nbits = max(int(x.max()).bit_length(), 1)
+    m = 1 << (nbits - 1)
+    # 逆変換の取り消し
+    q = m
+    while q > 1:
+        p = q - 1
+        for i in range(naxes):
+            on = (x[:, i] & q) != 0
+            x[on, 0] ^= p
+            off = ~on
+            t = (x[off, 0] ^ x[off, i]) & p
+            x[off, 0] ^= t
+            x[off, i] ^= t
+        q >>= 1
+    # Gray 符号化
+    for i in range(1, naxes):
+        x[:, i] ^= x[:, i - 1]
+    t = np.zeros(len(x), dtype=np.int64)
+    q = m
+    while q > 1:
+        t[(x[:, naxes - 1] & q) != 0] ^= q - 1
+        q >>= 1
+    x ^= t[:, np.newaxis]
+    keys = np.zeros(len(x), dtype=np.int64)
+    for bit in range(nbits - 1, -1, -1):
+        for i in range(naxes):
+            keys = (keys << 1) | ((x[:, i] >> bit) & 1)
+    return keys
+
+
+def nearestNeighbourOrder(positions, model, start=0):
+    '''最近傍法による巡回順（移動時間が最小の点を順に選ぶ）
+
+    残りの点だけを配列に残して詰めていくので，後ほど1歩が速くなる。
+    '''
+    n = len(positions)
+    order = np.empty(n, dtype=np.int64)
+    remaining = np.delete(np.arange(n), start)
+    rest = positions[remaining]
+    cur = start
+    order[0] = cur
+    for k in range(1, n):
+        best = int(np.argmin(pairTimes(positions[cur], rest, model)))
+        cur = int(remaining[best])
+        order[k] = cur
+        # 最後の点を選んだ点の場所に移して詰める（順序は関係ない）
+        remaining[best] = remaining[-1]
+        rest[best] = rest[-1]
+        remaining = remaining[:-1]
+        rest = rest[:-1]
+    return order
+
+
+def twoOpt(positions, order, model, window=TWO_OPT_WINDOW,
+           max_passes=TWO_OPT_MAX_PASSES):
+    '''2-opt で経路を改善する（端点は固定しない開いた経路）
+
+    区間 order[i+1:j+1] を反転して短くなるものを探す。
+    移動時間は対称なので反転した区間の内部の時間は変わらない。
+    計算量を抑えるため j は i から window 行以内に限る。
+    1回の走査では全ての i の反転の効果を配列でまとめて計算し，
+    短くなるもののうち区間の重ならないものを先頭から順に反転する。
+    '''
+    order = order.copy()
+    n = len(order)
+    if n < 4:
+        return order
+    rows = np.arange(n - 2)
+    j = rows[:, np.newaxis] + np.arange(2, window + 1)
+    valid = j < n
+    has_d = j + 1 < n
+    j_c = np.minimum(j, n - 1)
+    j_d = np.minimum(j + 1, n - 1)
+    for npass in range(max_passes):
+        pos = positions[order]
+        a = pos[:-2, np.newaxis]
+        b = pos[1:-1, np.newaxis]
+        c = pos[j_c]
+        d = pos[j_d]
+        delta = (pairTimes(a, c, model) - pairTimes(a, b, model)
+                 + np.where(has_d, pairTimes(b, d, model)
+                            - pairTimes(c, d, model), 0.0))
+        delta[~valid] = np.inf
+        best = np.argmin(delta, axis=1)
+        cand = np.nonzero(delta[rows, best] < -1e-9)[0]
+        if len(cand) == 0:
+            break
+        last = -1
+        for i, jj in zip(cand.tolist(), j[cand, best[cand]].tolist()):
+            if i < last:
+                # 前に反転した区間と重なる（次の走査で見直す）
+                continue
+            order[i + 1:jj + 1] = order[i + 1:jj + 1][::-1]
+            last = jj
+    return order
+
+
+def pointOrder(positions, order, model=None):
+    '''任意の点の集合の走査順
+
+    Args:
+        positions (numpy.ndarray): (n, 3) の位置 [mm]
+        order (str): ORDER_RASTER, ORDER_HILBERT, ORDER_MORTON, ORDER_NEAREST,
+            ORDER_AUTO のいずれか（ORDER_RASTER は今の順のまま）。
+            ORDER_AUTO は NEAREST_MAX_POINTS 以下なら ORDER_NEAREST，
+            それより多ければ ORDER_HILBERT の順を範囲を狭めた 2-opt で改善する
+        model (motionModel.stageMotionModel): ORDER_NEAREST, ORDER_AUTO の
+            移動時間に使う
+
+    Returns:
+        numpy.ndarray: 行の並べ替え
+    '''
+    positions = np.asarray(positions, dtype=float)
+    n = len(positions)
+    if n < 3 or order == ORDER_RASTER:
+        return np.arange(n)
+    if order == ORDER_MORTON:
+        return np.argsort(mortonKeys(gridCoordinates(positions)), kind='stable')
+    if order == ORDER_HILBERT:
+        return np.argsort(hilbertKeys(gridCoordinates(positions)), kind='stable')
+    if order == ORDER_AUTO:
+        if n <= NEAREST_MAX_POINTS:
+            return pointOrder(positions, ORDER_NEAREST, model)
+        if model is None:
+            model = motionModel.stageMotionModel()
+        return twoOpt(positions, pointOrder(positions, ORDER_HILBERT), model,
+                      window=LARGE_TWO_OPT_WINDOW)
+    if order == ORDER_NEAREST:
+        if n > NEAREST_MAX_POINTS:
+            raise ValueError(
+                    f"pointOrder(): too many points for '{order}': {n}")
+        if model is None:
+            model = motionModel.stageMotionModel()
+        return twoOpt(positions,
+                      nearestNeighbourOrder(positions, model), model)
+    raise ValueError(f"pointOrder(): unknown order: {order}")
+
+
+def test():
+    '''テストコード'''
+    xx, yy, zz = np.meshgrid(np.arange(0, 10.5, 1.0), np.arange(0, 10.5, 1.0),
+                             np.arange(0, 5.5, 0.5))
+    positions = np.stack([xx.ravel(), yy.ravel(), zz.ravel()], axis=1)
+    shape = xx.shape
+    for order in ORDERS:
+        if order == ORDER_SERPENTINE:
+            perm = serpentineOrder(shape, 1)
+        elif order == ORDER_SERPENTINE2:
+            perm = serpentineOrder(shape, 2)
+        else:
+            perm = pointOrder(positions, order)
+        assert np.array_equal(np.sort(perm), np.arange(len(positions)))
+        print(f"{order:12s} {travelTimes(positions[perm]).sum():8.1f} s")
+    # 点が多ければ Hilbert 曲線の順を 2-opt で改善する
+    xx, yy, zz = np.meshgrid(np.arange(0, 20.5, 1.0), np.arange(0, 20.5, 1.0),
+                             np.arange(0, 5.5, 0.5))
+    positions = np.stack([xx.ravel(), yy.ravel(), zz.ravel()], axis=1)
+    perm = pointOrder(positions, ORDER_AUTO)
+    assert len(positions) > NEAREST_MAX_POINTS
+    assert np.array_equal(np.sort(perm), np.arange(len(positions)))
+    hilbert = travelTimes(positions[pointOrder(positions, ORDER_HILBERT)]).sum()
+    auto = travelTimes(positions[perm]).sum()
+    assert auto <= hilbert
+    print(f"{ORDER_AUTO:12s} {auto:8.1f} s ({len(positions)} points, "
+          f"{ORDER_HILBERT}: {hilbert:.1f} s)")
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,161 @@
+''' シリアル通信の時間計測と集計
+'''
+
+import math
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class latencyHistogram():
+    '''対数間隔のビンによる時間のヒストグラム
+
+    10 us から 100 s までを1桁あたり BINS_PER_DECADE 個のビンに分ける。
+    範囲外の値は両端のビンに入れる。
+    '''
+    MIN_VALUE = 1e-5
+    MAX_VALUE = 1e2
+    BINS_PER_DECADE = 20
+
+    def __init__(self):
+        self.nbins = int(round(
+                math.log10(self.MAX_VALUE / self.MIN_VALUE) * self.BINS_PER_DECADE))
+        self.counts = [0] * self.nbins
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def binIndex(self, value):
+        '''value の入るビンの番号'''
+        if value <= self.MIN_VALUE:
+            return 0
+        idx = int(math.log10(value / self.MIN_VALUE) * self.BINS_PER_DECADE)
+        return min(idx, self.nbins - 1)
+
+    def binValue(self, idx):
+        '''ビンの代表値（対数での中央）'''
+        return self.MIN_VALUE * 10 ** ((idx + 0.5) / self.BINS_PER_DECADE)
+
+    def add(self, value):
+        '''値を1つ加える'''
+        self.counts[self.binIndex(value)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def mean(self):
+        '''平均値'''
+        return self.total / self.count if self.count > 0 else 0.0
+
+    def percentile(self, p):
+        '''p パーセンタイル（ビンの代表値。最大値を超えない）'''
+        if self.count == 0:
+            return 0.0
+        rank = p / 100 * self.count
+        cum = 0
+        for idx, c in enumerate(self.counts):
+            cum += c
+            if cum >= rank and c > 0:
+                return min(self.binValue(idx), self.max)
+        return self.max
+
+
+class commandStats():
+    '''1種類のコマンドの集計'''
+
+    def __init__(self):
+        self.write_time = latencyHistogram()
+        self.reply_time = latencyHistogram()
+        self.count = 0
+        self.timeouts = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+
+class transactionStats():
+    '''コマンド種別ごとの通信時間の集計
+
+    1コマンドごとに，書き出したバイト数・読み出したバイト数・
+    書き出しにかかった時間・書き出し開始から応答を受け取るまでの時間を
+    record() で記録する。コマンド種別は先頭2文字（'Q:', 'A:' など）。
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.commands = {}
+
+    def clear(self):
+        '''集計をクリアする'''
+        with self.lock:
+            self.commands = {}
+
+    def record(self, cmd, nwritten, nread, write_time, reply_time):
+        '''1コマンド分を記録する
+
+        Parameters
+        ----------
+        cmd: string
+            コマンド
+        nwritten, nread: int
+            書き出し・読み出しのバイト数
+        write_time: float
+            書き出しにかかった時間 [s]
+        reply_time: float or None
+            書き出し開始から応答を受け取るまでの時間 [s]。
+            None はタイムアウト
+        '''
+        kind = cmd[:2]
+        with self.lock:
+            st = self.commands.get(kind)
+            if st is None:
+                st = self.commands[kind] = commandStats()
+            st.count += 1
+            st.bytes_written += nwritten
+            st.bytes_read += nread
+            st.write_time.add(write_time)
+            if reply_time is None:
+                st.timeouts += 1
+            else:
+                st.reply_time.add(reply_time)
+
+    def summary(self):
+        '''集計結果を辞書で返す
+
+        Return
+        ------
+        summary: dict
+            コマンド種別ごとに count, timeouts, bytes_written, bytes_read と
+            write_*, reply_* の mean, p50, p95, p99, max [s]
+        '''
+        ret = {}
+        with self.lock:
+            for kind, st in sorted(self.commands.items()):
+                item = {
+                        'count': st.count,
+                        'timeouts': st.timeouts,
+                        'bytes_written': st.bytes_written,
+                        'bytes_read': st.bytes_read,
+                        }
+                for name, hist in (('write', st.write_time),
+                                   ('reply', st.reply_time)):
+                    item[f'{name}_mean'] = hist.mean()
+                    for p in (50, 95, 99):
+                        item[f'{name}_p{p}'] = hist.percentile(p)
+                    item[f'{name}_max'] = hist.max
+                ret[kind] = item
+        return ret
+
+    def report(self):
+        '''集計結果を表形式の文字列にする（時間は ms）'''
+        lines = [f"{'cmd':4s}{'count':>8s}{'t.o.':>6s}{'wr[B]':>8s}{'rd[B]':>8s}"
+                 f"{'write p50':>10s}{'p99':>8s}"
+                 f"{'reply p50':>10s}{'p95':>8s}{'p99':>8s}{'max':>8s}"]
+        for kind, item in self.summary().items():
+            lines.append(
+                    f"{kind:4s}{item['count']:8d}{item['timeouts']:6d}"
+                    f"{item['bytes_written']:8d}{item['bytes_read']:8d}"
+                    f"{item['write_p50'] * 1e3:10.2f}{item['write_p99'] * 1e3:8.2f}"
+                    f"{item['reply_p50'] * 1e3:10.2f}{item['reply_p95'] * 1e3:8.2f}"
+                    f"{item['reply_p99'] * 1e3:8.2f}{item['reply_max'] * 1e3:8.2f}")
+        return '\n'.join(lines)
@@ -3,47 +3,130 @@
 '''
 
 import sys
+import os
 import logging
 import argparse
+import functools
 from socket import gethostname
-import time
+
+import startupProfile
+
+# --startup-profile のときは，以降の import の時間から測る
+startup_profile = None
+if __name__ == '__main__' and '--startup-profile' in sys.argv:
+    startup_profile = startupProfile.startupProfile()
+    startup_profile.install()
+
+import numpy as np
 
 from PyQt5.QtWidgets import QWidget, QMainWindow, qApp, QApplication, QHBoxLayout, QVBoxLayout, QStyle
 from PyQt5.QtWidgets import QPushButton, QLabel, QLCDNumber, QLineEdit, QCheckBox
 from PyQt5.QtWidgets import QSizePolicy
 from PyQt5.QtWidgets import QAction
-from PyQt5.QtWidgets import QDialog, QFileDialog
-from PyQt5.QtWidgets import QTableWidget, QTableWidgetItem, QTableWidgetSelectionRange
+from PyQt5.QtWidgets import QDialog, QFileDialog, QMessageBox, QInputDialog
+from PyQt5.QtWidgets import QTableView
 from PyQt5 import QtCore, QtGui
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QItemSelectionModel
 
 import stage
+import asyncStage
 import portSettingDialog
 import positionController
 import ioMonitor
 import program
+import programTableModel
+import trajectoryPlot
+import completionDetector
+import motionModel
+import runEngine
 import config
-import createProgramDialog
+# programImport, programValidator, programCompiler と，プログラムの作成に使う
+# scanOrder, surfaceRegion, adaptiveScan, createProgramDialog は使うときに読み込む
 
 logger = logging.getLogger(__name__)
 
 
-APP_NAME = "shotControl"
-VENDER_NAME = "makutaga"
+APP_NAME = config.APP_NAME
+VENDER_NAME = config.VENDER_NAME
 
 DEFAULT_PARAMS = {
         'device_name': 'Unknown',
+        'motion_time_scale': '1.0',
+        'motion_move_overhead': '0.0',
+        'motion_step_overhead': '0.0',
+        'travel_min': '',
+        'travel_max': '',
+        'max_step': '',
+        'max_step_rate': '',
+        'measurement_port': '50007',
         }
 
+# 駆動モデルの補正値を config に保存するときのキー
+MOTION_CALIBRATION_KEYS = motionModel.CALIBRATION_CONFIG_KEYS
+
+class qtTimerHandle():
+    '''qtScheduler.call_later の戻り値（cancel() で取り消す）'''
+
+    def __init__(self, timer):
+        self.timer = timer
+
+    def cancel(self):
+        if self.timer is not None:
+            self.timer.stop()
+            self.timer.deleteLater()
+            self.timer = None
+
+
+class qtScheduler(QtCore.QObject):
+    '''runEngine の scheduler を Qt のタイマとシグナルで実現する
+
+    asyncio のイベントループの call_later, call_soon_threadsafe と同じ形。
+    call_soon_threadsafe はほかのスレッドから呼んでも GUI のスレッドで実行する。
+    '''
+    invoke = QtCore.pyqtSignal(object)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.invoke.connect(self.runCallback)
+
+    def runCallback(self, func):
+        func()
+
+    def call_later(self, delay, func, *args):
+        timer = QtCore.QTimer(self)
+        timer.setSingleShot(True)
+        handle = qtTimerHandle(timer)
+
+        def fire():
+            handle.timer = None
+            timer.deleteLater()
+            func(*args)
+
+        timer.timeout.connect(fire)
+        timer.start(int(delay * 1000))
+        return handle
+
+    def call_soon_threadsafe(self, func, *args):
+        self.invoke.emit(functools.partial(func, *args))
+
+
 class MyWindow(QMainWindow):
     ''' メインウィンドウ '''
-    QUERY_INTERVAL = 250
 
     # unit of DURATION is [ms]
     OSCI_TRIGGER_DURATION = 100
     OSCI_TRIGGER_CHANNEL = 1
     TICK_CHANNEL = 3
     DEFAULT_APP_WIN_SIZE_VS_SCREEN = 0.75
+    MIN_CALIBRATION_STEPS = 3
+    MAX_ESTIMATE_ROWS = 2000000
+    ERROR_ROW_COLOR = QtGui.QColor(255, 200, 200)
+    WARNING_ROW_COLOR = QtGui.QColor(255, 240, 180)
+    STREAM_IMPORT_BYTES = 32 * 1024 * 1024   # これより大きな CSV は分割して読む
+    PROGRAM_FILTERS = ("Program (*.shotp *.csv);;"
+                       "Binary program (*.shotp);;CSV (*.csv)")
+
+    importProgress = QtCore.pyqtSignal(object)
 
     def __init__(self, conf, desktop):
         super().__init__()
@@ -53,49 +136,76 @@ class MyWindow(QMainWindow):
         # self.width = 800
         # self.height = 600
         self.device_name = None
-        self.flag_prog_run = False
 
         self.stage = stage.stage()
+        self.astage = asyncStage.asyncStage(self.stage)
+        self.detector = completionDetector.completionDetector(self.stage)
+        self.motion_model = None
+        self.updateMotionModel()
+        self.estimate = None
+        # 移動の監視とプログラムの実行は runEngine が行い，GUI はイベントを表示する
+        self.engine = runEngine.runEngine(
+                self.stage, qtScheduler(self), astage=self.astage,
+                detector=self.detector,
+                trigger_duration=self.OSCI_TRIGGER_DURATION / 1000,
+                trigger_channel=self.OSCI_TRIGGER_CHANNEL,
+                tick_channel=self.TICK_CHANNEL)
+        self.engine.subscribe(self.engineEvent)
         self.program = program.stageProgram()
+        self.row_reader = program.rowReader(self.program)   # 表で選んだ行の参照
+        self.compiled = None
+        self.importer = None
+        self.measurement = None     # 適応走査の測定値の受け取り（socketMeasurement）
+        self.preset_pending = False # 次の位置の問い合わせ結果をプリセットにする
 
         self.initUI()
         self.setupWindowAppearance(desktop)
 
-        self.query_timer = QtCore.QTimer()
-        self.query_timer.timeout.connect(self.queryInfo)
-        self.settling_timer = QtCore.QTimer()
-        self.settling_timer.timeout.connect(self.settlingTimeup)
-        self.settling_timer.setSingleShot(True)
-        self.trigger_timer = QtCore.QTimer()
-        self.trigger_timer.timeout.connect(self.triggerTimeup)
-        self.trigger_timer.setSingleShot(True)
+        self.importProgress.connect(self.updateImport)
+
+    @property
+    def flag_prog_run(self):
+        '''プログラムを実行中か'''
+        return self.engine.running
 
     def initUI(self):
         ''' UIの初期化 '''
         win = QWidget()
         # 全体はQVBoxLayout
-        # posi_con : positionController
+        # posi_con : positionController, traj_plot : trajectoryPlot（横に並べる）
         # io_monitor : ioMonitor
-        # prog_table : QTableWidget
+        # prog_table : QTableView (prog_model : programTableModel)
         layout = QVBoxLayout(win)
 
 
+        layout_pos = QHBoxLayout()
         self.posi_con = positionController.positionController()
-        layout.addWidget(self.posi_con, 0)
+        layout_pos.addWidget(self.posi_con, 0)
+        self.traj_plot = trajectoryPlot.trajectoryPlot()
+        self.traj_plot.setProgram(self.program)
+        layout_pos.addWidget(self.traj_plot, 1)
+        layout.addLayout(layout_pos, 0)
         self.io_monitor = ioMonitor.ioMonitor(output_num=4)
         layout.addWidget(self.io_monitor)
         self.io_monitor.buttonPressed.connect(self.actionOutputOn)
         self.io_monitor.buttonReleased.connect(self.actionOutputOff)
 
-        self.prog_table = QTableWidget()
+        self.prog_model = programTableModel.programTableModel(self.program)
+        self.prog_model.edit_func = self.editCell
+        self.prog_table = QTableView()
+        self.prog_table.setModel(self.prog_model)
         layout.addWidget(self.prog_table)
-        self.prog_table.cellClicked.connect(self.tableSelectRow)
-        self.prog_table.currentCellChanged.connect(
+        self.prog_table.clicked.connect(
+                lambda index: self.tableSelectRow(index.row(), index.column()))
+        self.prog_table.selectionModel().currentChanged.connect(
                 self.actionCurrentCellChanged)
-        self.prog_table.cellChanged.connect(self.actionCurrentCellValueChanged)
 
         self.setCentralWidget(win)
 
+        # プログラムの所要時間の見積り
+        self.lbl_estimate = QLabel('')
+        self.statusBar().addPermanentWidget(self.lbl_estimate)
+
         act_quit = QAction(
                 self.style().standardIcon(QStyle.SP_DialogCloseButton),
                 '&Quit', self)
@@ -183,6 +293,47 @@ class MyWindow(QMainWindow):
         self.act_prog_stop.triggered.connect(self.actionStopProgram)
         self.act_prog_stop.setEnabled(False)
 
+        act_prog_reorder = QAction('&Optimize scan order', self)
+        act_prog_reorder.setStatusTip(
+                'Reorder the program to minimize travel time (nearest neighbour + 2-opt)')
+        act_prog_reorder.triggered.connect(self.actionReorderProgram)
+
+        act_prog_validate = QAction('&Validate', self)
+        act_prog_validate.setStatusTip(
+                'Check every row against travel, step and rate limits and pulse quantization')
+        act_prog_validate.triggered.connect(self.actionValidateProgram)
+
+        act_undo = QAction('&Undo', self)
+        act_undo.setShortcut('Ctrl+Z')
+        act_undo.setStatusTip('Undo the last edit of the program')
+        act_undo.triggered.connect(self.actionUndo)
+
+        act_redo = QAction('&Redo', self)
+        act_redo.setShortcut('Ctrl+Shift+Z')
+        act_redo.setStatusTip('Redo the last undone edit of the program')
+        act_redo.triggered.connect(self.actionRedo)
+
+        act_paste = QAction('&Paste', self)
+        act_paste.setShortcut('Ctrl+V')
+        act_paste.setStatusTip(
+                'Paste tab or comma separated values at the current cell')
+        act_paste.triggered.connect(self.actionPaste)
+
+        act_expression = QAction('Apply &expression...', self)
+        act_expression.setStatusTip(
+                'Set the selected cells from an expression of value and the columns')
+        act_expression.triggered.connect(self.actionApplyExpression)
+
+        act_serial_stats = QAction('Serial &statistics', self)
+        act_serial_stats.setStatusTip(
+                'Show latency statistics of serial transactions')
+        act_serial_stats.triggered.connect(self.actionSerialStats)
+
+        act_clear_visited = QAction('&Clear visited points', self)
+        act_clear_visited.setStatusTip(
+                'Clear the visited points in the trajectory plot')
+        act_clear_visited.triggered.connect(self.traj_plot.clearVisited)
+
         self.posi_con.actionMoveTo.connect(self.stageMove)
         self.posi_con.actionStop.connect(self.stageStop)
         self.posi_con.actionResetOrigin.connect(self.resetOrigin)
@@ -195,6 +346,18 @@ class MyWindow(QMainWindow):
         self.menubar = self.menuBar()
         fileMenu = self.menubar.addMenu('&File')
         fileMenu.addAction(act_quit)
+        editMenu = self.menubar.addMenu('&Edit')
+        editMenu.addAction(act_undo)
+        editMenu.addAction(act_redo)
+        editMenu.addSeparator()
+        editMenu.addAction(act_paste)
+        editMenu.addAction(act_expression)
+        progMenu = self.menubar.addMenu('&Program')
+        progMenu.addAction(act_prog_reorder)
+        progMenu.addAction(act_prog_validate)
+        viewMenu = self.menubar.addMenu('&View')
+        viewMenu.addAction(act_serial_stats)
+        viewMenu.addAction(act_clear_visited)
 
         # TOOL BAR
         self.toolbar = self.addToolBar('Main toolbar')
@@ -244,6 +407,22 @@ class MyWindow(QMainWindow):
 
         self.conf['app_width'] = str(self.width())
         self.conf['app_height'] = str(self.height())
+        self.cancelImport()
+        if hasattr(self.program, 'release'):
+            self.program.release()
+        if self.engine.running:
+            # 実行中ならステージを止める（L: の応答を待ってから切り離す）
+            self.engine.stop(stop_stage=False)
+            self.stage.stop()
+        self.engine.cancelPoll()
+        if self.measurement is not None:
+            self.measurement.close()
+        self.astage.close()
+
+    def openStage(self, device_name, devices=None):
+        ''' ステージのシリアルポートを開き，非同期トランスポートを開始 '''
+        self.stage.openSerial(device_name, devices)
+        self.astage.start()
 
     def showStatus(self, msg=""):
         ''' status bar に情報表示 '''
@@ -252,6 +431,8 @@ class MyWindow(QMainWindow):
             msgs.append('Port:None')
         else:
             msgs.append(self.device_name)
+        if msg != "":
+            msgs.append(msg)
 
         msg = '|'.join(msgs)
         self.statusBar().showMessage(msg)
@@ -260,157 +441,277 @@ class MyWindow(QMainWindow):
         '''指定された位置にステージを移動'''
         logging.debug(
                 "stageMove: pos_x:%d, pos_y:%d, pos_z:%d", pos_x, pos_y, pos_z)
-        self.stage.moveTo(pos_x, pos_y, pos_z)
-        self.query_timer.start(self.QUERY_INTERVAL)
+        self.engine.moveTo(pos_x, pos_y, pos_z)
 
     def stageStop(self):
         ''' ステージを止める '''
         logging.debug("Stop")
-        self.stage.stop()
-        self.query_timer.stop()
-        self.queryInfo()
+        self.engine.stopStage()
 
     def queryInfo(self):
-        ''' ステージの状態を取得し，posi_con を更新
-
-        ステージ移動時にquery_timerがtimeup したとき呼ばれる．
-        ステージがreadyとなればquery_timerを停止
-        このときプログラムが run 中であれば
-        目的位置まで移動完了したことになるので次のステップを
-        実行する．
-        '''
-        buf = self.stage.query()
-        logging.debug("queryInfo: %s", buf)
-        if isinstance(buf, dict):
-            self.posi_con.lcd_x.setCounterValue(buf['pos_x'])
-            self.posi_con.lcd_y.setCounterValue(buf['pos_y'])
-            self.posi_con.lcd_z.setCounterValue(buf['pos_z'])
-            if buf['ack3'] == 'R':
+        ''' ステージの状態を問い合わせる（結果は engineEvent で表示する） '''
+        self.engine.query()
+
+    def engineEvent(self, event, data):
+        ''' runEngine のイベントを表示に反映する '''
+        if event == runEngine.EVENT_POSITION:
+            self.posi_con.lcd_x.setCounterValue(data['pos_x'])
+            self.posi_con.lcd_y.setCounterValue(data['pos_y'])
+            self.posi_con.lcd_z.setCounterValue(data['pos_z'])
+            if self.preset_pending is True:
+                self.preset_pending = False
+                self.posi_con.cancelPreset()
+            # 実行中に Ready だった位置を通過した点とする（問い合わせの結果だけを使う）
+            self.traj_plot.setPosition(
+                    data['pos_x'], data['pos_y'], data['pos_z'],
+                    visited=self.flag_prog_run and data['ack3'] == 'R')
+        elif event == runEngine.EVENT_READY:
+            if data['latency'] is None:
                 self.showStatus('Ready')
-                if self.query_timer.isActive():
-                    self.query_timer.stop()
-                if ((self.flag_prog_run is True) and (self.trigger_timer.isActive() is not True)):
-                    # programの現在の行を取得
-                    cur_row = self.prog_table.currentRow()
-                    param = self.program.paramByIndex(cur_row)
-                    # repetitionsを取得
-                    self.remaining_count = param['repetitions']
-                    # settling_timer を開始
-                    settling_time = param['settling_time'] * 1000
-                    self.settling_timer.start(settling_time)
-                    # tick を出力
-                    tick1 = param['tick1']
-                    if tick1 == 1:
-                        self.outputOn(self.TICK_CHANNEL)
-                    else:
-                        self.outputOff(self.TICK_CHANNEL)
-
-                    logging.debug("\tcur_row: %d: settling_time:%f, tick1:%d repetition:%d",
-                                  cur_row, settling_time, tick1,
-                                  self.remaining_count)
             else:
-                self.showStatus('Busy')
-
-    def settlingTimeup(self):
-        ''' インターバルタイマーがTimeupしたときに呼ばれる。
-            ポストインターバル処理の開始
-        '''
-        logger.debug("settlingTimeup()")
-        #self.settling_timer.stop()
-
-        # オシロ用のトリガを出力
-        self.trigger_timer.start(int(self.OSCI_TRIGGER_DURATION))
-        self.outputOn(self.OSCI_TRIGGER_CHANNEL)
-
-    def triggerTimeup(self):
-        '''トリガ信号用のTimeup処理
-            ポストインターバル処理終了
-        '''
-        logger.debug("triggerTimeup()")
-        #self.trigger_timer.stop()
-
-        self.outputOff(self.OSCI_TRIGGER_CHANNEL)
-
-        self.remaining_count -= 1
-        if self.remaining_count > 0:
-            logger.debug("settling_timer is restarted. self.remaining_count: %d",
-                    self.remaining_count)
-            self.settling_timer.start()
-        else:
-            if self.flag_prog_run is True:
-                self.progNextStep()
-                self.go()
+                self.showStatus(
+                        f"Ready (latency <= {data['latency'] * 1000:.0f} ms)")
+        elif event == runEngine.EVENT_BUSY:
+            self.showStatus('Busy')
+        elif event == runEngine.EVENT_OUTPUT:
+            if data['on']:
+                self.io_monitor.btn_lamp_on(data['channel'])
+            else:
+                self.io_monitor.btn_lamp_off(data['channel'])
+        elif event == runEngine.EVENT_ROW:
+            self.setCurrentRow(data['row'])
+        elif event == runEngine.EVENT_ROWS_ADDED:
+            self.appendProgramRows(data['nrows'])
+            self.showEstimate()
+        elif event == runEngine.EVENT_FINISHED:
+            self.runFinished()
 
     def go(self):
         '''プリセット位置にステージを移動'''
         logger.debug("go:")
         self.posi_con.go()
-        self.query_timer.start(self.QUERY_INTERVAL)
 
     def initPreset(self):
-        '''現在位置をプリセットカウンタにセット'''
+        '''現在位置をプリセットカウンタにセット（問い合わせの結果が届いてから）'''
+        self.preset_pending = True
         self.queryInfo()
-        self.posi_con.cancelPreset()
+        self.updateMotionModel()
+
+    def updateMotionModel(self):
+        '''ステージの設定と config の補正値から駆動モデルを作り直す'''
+        calib = {k: float(self.conf.get(v, DEFAULT_PARAMS[v]))
+                 for k, v in MOTION_CALIBRATION_KEYS.items()}
+        self.motion_model = motionModel.stageMotionModel.fromStage(
+                self.stage, **calib)
+        self.detector.model = self.motion_model
+
+    def estimateProgram(self, prog):
+        '''プログラムの所要時間の合計を見積もる（motionModel.estimateTotals）'''
+        return self.motion_model.estimateTotals(
+                prog.iterChunks(), self.OSCI_TRIGGER_DURATION / 1000,
+                start=self.stage.last_move_to)
+
+    def estimateParams(self, params):
+        '''createProgramDialog の条件で作るプログラムの所要時間（文字列）'''
+        import createProgramDialog
+
+        ranges = [[params[f'{ax}_start'], params[f'{ax}_stop'], params[f'{ax}_step']]
+                  for ax in 'xyz']
+        if params['mode'] == createProgramDialog.PROGRAM_MODE_SURFACE:
+            # 面では z の範囲を使わない（領域の外の点も数えた上限）
+            ranges[2] = [params['z_start'], params['z_start'], 1.0]
+        if min(r[2] for r in ranges) <= 0:
+            return '-'
+        # 点数は範囲の定義だけから求まる
+        nrows = len(program.lazyGridProgram(*ranges))
+        if nrows > self.MAX_ESTIMATE_ROWS:
+            return f"{nrows} steps (too many to estimate)"
+        try:
+            prog = self.generateProgram(params)
+        except ValueError:
+            return '-'
+        if len(prog) == 0:
+            return '-'
+        estimate = self.estimateProgram(prog)
+        return f"{len(prog)} steps, {motionModel.summarizeEstimate(estimate)}"
+
+    def showEstimate(self):
+        '''現在のプログラムの所要時間の見積りを status bar に表示する'''
+        if len(self.program) == 0:
+            self.estimate = None
+            self.lbl_estimate.setText('')
+            return
+        self.estimate = self.estimateProgram(self.program)
+        summary = motionModel.summarizeEstimate(self.estimate)
+        logger.info("program estimate: %d steps, %s",
+                    len(self.program), summary)
+        self.lbl_estimate.setText(
+                "Est. " + motionModel.formatDuration(
+                    self.estimate['total_time']))
+        self.lbl_estimate.setToolTip(summary)
+
+    def calibrateMotionModel(self):
+        '''実行時に記録した所要時間で駆動モデルを較正する'''
+        timings = self.engine.timings
+        self.engine.timings = []
+        if len(timings) < self.MIN_CALIBRATION_STEPS:
+            return
+        predicted_move, measured_move, measured_step, expected_step = zip(*timings)
+        self.motion_model.calibrate(
+                predicted_move, measured_move, measured_step, expected_step)
+        for k, v in self.motion_model.calibration().items():
+            self.conf[MOTION_CALIBRATION_KEYS[k]] = f"{v:.6g}"
+        self.showEstimate()
 
     def resetOrigin(self):
         '''現在位置を電気（論理）原点に設定'''
-        self.stage.resetOrigin()
-        self.queryInfo()
+        self.engine.resetOrigin()
         self.initPreset()
 
     def gotoMechanicalOrigin(self):
         '''機械原点に移動し，カウンタをリセット'''
-        self.stage.gotoMechanicalOrigin()
-        if self.query_timer.isActive() is not True:
-            self.query_timer.start(self.QUERY_INTERVAL)
-        self.queryInfo()
+        self.engine.gotoMechanicalOrigin()
 
     def setProgramData(self, prog):
         '''ステージプログラムをセット'''
-        self.program = prog
+        import programImport
 
-        self.prog_table.cellChanged.disconnect(
-                self.actionCurrentCellValueChanged)
-
-        self.prog_table.setColumnCount(self.program.df.shape[1])
-        self.prog_table.setRowCount(self.program.df.shape[0])
+        if not isinstance(prog, programImport.streamingProgram):
+            self.cancelImport()
+        self.attachProgram(prog, reset=True)
+        self.compiled = None
         logging.debug("setProgramData(): row:%d  column:%d",
-                      self.program.df.shape[0], self.program.df.shape[1])
-        self.prog_table.setHorizontalHeaderLabels(
-                self.program.df.columns.to_list())
-        for r in range(self.program.df.shape[0]):
-            for c in range(self.program.df.shape[1]):
-                item = QTableWidgetItem(f"{self.program.df.iat[r, c]:.3f}")
-                flags = item.flags()
-                # flags = flags & (~ (Qt.ItemFlag.ItemIsEditable ))
-                item.setFlags(flags)
-                self.prog_table.setItem(r, c, item)
-
-        self.prog_table.setVerticalHeaderLabels(
-                [f"{idx}" for idx in self.program.df.index.to_list()])
-
-        self.prog_table.cellChanged.connect(self.actionCurrentCellValueChanged)
+                      len(self.program), len(self.program.columns))
+        self.showEstimate()
+
+    def attachProgram(self, prog, reset=False):
+        '''self.program を prog に替え，編集の通知を受け取るようにする
+
+        reset=False は同じ内容のプログラムへの置き換えで，表の位置を保つ。
+        '''
+        old = self.program
+        if hasattr(old, 'removeListener'):
+            old.removeListener(self.programEdited)
+        self.program = prog
+        self.row_reader = program.rowReader(prog)
+        self.prog_model.setProgram(prog, reset)
+        self.traj_plot.setProgram(prog, clear=reset)
+        if self.engine.running:
+            # 実行中の置き換えは同じ内容のもの（読み込みの終わった CSV など）
+            self.engine.setProgram(prog, self.engine.compiled)
+        if hasattr(prog, 'addListener'):
+            prog.addListener(self.programEdited)
+        if old is not prog and hasattr(old, 'release'):
+            # 読み込んだ CSV の一時ファイル（読み込みに失敗したものを含む）を消す
+            old.release()
+
+    def editableProgram(self):
+        '''編集できるプログラムを返す（読み込み中なら警告して None）
+
+        lazyGridProgram は展開した stageProgram に置き換える。
+        '''
+        if self.importInProgress():
+            QMessageBox.warning(self, 'Edit Program',
+                                'The program is still being imported.')
+            return None
+        if not getattr(self.program, 'editable', True):
+            QMessageBox.warning(self, 'Edit Program',
+                                'This program cannot be edited (adaptive refinement).')
+            return None
+        if isinstance(self.program, program.lazyGridProgram):
+            self.attachProgram(self.program.materialize())
+        return self.program
+
+    def programEdited(self, rows):
+        '''プログラムの編集（stageProgram の通知）を表に反映する'''
+        if len(rows) == 0:
+            return
+        self.prog_model.rowsChanged(rows)
+        self.traj_plot.programChanged()
+        self.compiled = None
+        self.engine.compiled = None
+        self.showEstimate()
+
+    def appendProgramRows(self, nrows):
+        '''プログラムの nrows 行目までを表に表示する'''
+        self.prog_model.appendRows(nrows)
+        self.traj_plot.programChanged()
+
+    def currentRow(self):
+        '''表の現在の行（なければ -1）'''
+        return self.prog_table.currentIndex().row()
+
+    def setCurrentRow(self, row, col=0):
+        '''表の現在のセルを row 行 col 列にする'''
+        self.prog_table.setCurrentIndex(self.prog_model.index(row, col))
+
+    def startImport(self, filename):
+        '''大きな CSV を別スレッドで分割して読み込む
+
+        読み込んだ行から表に追加され，実行もできる。
+        '''
+        import programImport
+
+        self.cancelImport()
+        self.importer = programImport.csvImporter(
+                filename, progress=lambda *args: self.importProgress.emit(args))
+        self.importer.start()
+        self.setProgramData(self.importer.program())
+
+    def cancelImport(self):
+        '''読み込み中の CSV があれば中断する'''
+        if self.importer is not None and not self.importer.finished:
+            self.importer.cancel()
+        self.importer = None
+
+    def importInProgress(self):
+        '''CSV を読み込み中か'''
+        return self.importer is not None and not self.importer.finished
+
+    def updateImport(self, args):
+        '''csvImporter の進捗（importProgress シグナル）を処理する'''
+        import programImport
+
+        rows, bytes_read, total_bytes = args
+        importer = self.importer
+        if importer is None or not isinstance(
+                self.program, programImport.streamingProgram):
+            return
+        self.appendProgramRows(rows)
+        if importer.finished:
+            self.importer = None
+            if importer.error is not None:
+                QMessageBox.warning(self, 'Open Program File',
+                                    f"{importer.src}: {importer.error}")
+            else:
+                self.attachProgram(self.program.materialize())
+            self.showStatus(f"Imported {rows} rows")
+            self.showEstimate()
+        else:
+            self.showStatus(
+                    f"Importing: {bytes_read / max(total_bytes, 1) * 100:.0f}% "
+                    f"({rows} rows)")
+        # 次の行を待っていれば再開する
+        self.engine.rowsAdded()
 
     def progNextStep(self):
         '''プログラムを次のステップに進める'''
-        cur_row = self.prog_table.currentRow()
+        cur_row = self.currentRow()
         cur_col = 0
         logger.debug("progNextStep: currentRow:%d", cur_row)
-        if cur_row+1 < self.prog_table.rowCount():
+        if cur_row+1 < self.prog_model.rowCount():
             cur_row = cur_row + 1
-        elif self.flag_prog_run is True:
-            self.actionStopProgram()
-        # cur_row = min(cur_row + 1, self.prog_table.rowCount() - 1)
-        self.prog_table.setCurrentCell(cur_row, cur_col)
+        # cur_row = min(cur_row + 1, self.prog_model.rowCount() - 1)
+        self.setCurrentRow(cur_row, cur_col)
         self.tableSelectRow(cur_row, 0)
 
     def progPrevStep(self):
         '''プログラムを前のステップに戻す'''
-        cur_row = self.prog_table.currentRow()
+        cur_row = self.currentRow()
         cur_col = 0
         logger.debug("progPrevStep: currentRow:%d", cur_row)
         cur_row = max(cur_row - 1, 0)
-        self.prog_table.setCurrentCell(cur_row, cur_col)
+        self.setCurrentRow(cur_row, cur_col)
         self.tableSelectRow(cur_row, 0)
 
     def tableSelectRow(self, row, col=0):
@@ -419,51 +720,110 @@ class MyWindow(QMainWindow):
                 "tableSelectRow: row:%d, col:%d"
                 "  currentRow:%d currentColumn:%d columnCount:%d",
                 row, col,
-                self.prog_table.currentRow(), self.prog_table.currentColumn(),
-                self.prog_table.columnCount())
-        for r in self.prog_table.selectedRanges():
-            logger.debug("tableSelectRow: SelectedRange.topRow:%d", r.topRow())
-            self.prog_table.setRangeSelected(r, False)
-        if self.prog_table.currentRow() != row:
-            self.prog_table.setCurrentCell(row, col)
-        self.prog_table.setRangeSelected(
-                QTableWidgetSelectionRange(
-                    row, self.prog_table.columnCount()-1, row, 0), True)
-        param = self.program.paramByIndex(row)
+                self.currentRow(), self.prog_table.currentIndex().column(),
+                self.prog_model.columnCount())
+        # 現在のセルを移し，その行だけを選択する
+        self.prog_table.selectionModel().setCurrentIndex(
+                self.prog_model.index(row, col),
+                QItemSelectionModel.ClearAndSelect | QItemSelectionModel.Rows)
+        param = self.row_reader.row(row)
         self.posi_con.setPresetValue(
-                param['pos_x'], param['pos_y'], param['pos_z'], relative=False)
+                param.pos_x, param.pos_y, param.pos_z, relative=False)
         logger.debug(
                 "x:%f y:%f z:%f int:%f",
-                param['pos_x'], param['pos_y'],
-                param['pos_z'], param['settling_time'])
+                param.pos_x, param.pos_y, param.pos_z, param.settling_time)
 
-    def actionCurrentCellChanged(self, cur_row, cur_col, prev_row, prev_col):
+    def actionCurrentCellChanged(self, current, previous):
         ''' current cell（の位置）が変更されたときのaction '''
-        logger.debug("actionCurrentCellChanged: cur_row: %d", cur_row)
-        self.tableSelectRow(cur_row)
+        logger.debug("actionCurrentCellChanged: cur_row: %d", current.row())
+        if current.isValid():
+            self.tableSelectRow(current.row(), current.column())
 
-    def actionCurrentCellValueChanged(self, row, column):
-        ''' current cellの内容が変更されたときのaction '''
-        logger.debug(
-                "actionCurrentCellValueChanged: row:%d, column:%d",
-                row, column)
-        new_celltext = self.prog_table.item(row, column).text()
-        new_cellvalue = float(new_celltext)
-        new_celltext = f"{float(new_cellvalue):.3f}"
-        self.program.df.iloc[row, column] = new_cellvalue
-        self.prog_table.cellChanged.disconnect(
-                self.actionCurrentCellValueChanged)
-        self.prog_table.item(row, column).setText(new_celltext)
-        self.prog_table.cellChanged.connect(self.actionCurrentCellValueChanged)
-        self.tableSelectRow(row, column)
+    def editCell(self, row, column, value):
+        ''' セルが編集されたとき（programTableModel.setData）の処理
+
+        編集できなければ False を返し，表の値は元のままになる。
+        '''
+        logger.debug("editCell: row:%d, column:%d", row, column)
+        prog = self.editableProgram()
+        if prog is None:
+            return False
+        try:
+            # 表の表示は programEdited で更新される
+            prog.setValue(row, prog.columns[column], value)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Edit Program', str(e))
+            return False
+        return True
+
+    def actionUndo(self):
+        ''' 最後の編集を取り消す '''
+        if self.flag_prog_run is False and hasattr(self.program, 'undo'):
+            self.program.undo()
+
+    def actionRedo(self):
+        ''' 取り消した編集をやり直す '''
+        if self.flag_prog_run is False and hasattr(self.program, 'redo'):
+            self.program.redo()
+
+    def actionPaste(self):
+        ''' クリップボードの表（タブまたはカンマ区切り）を現在のセルから貼り付ける '''
+        row = self.currentRow()
+        col = self.prog_table.currentIndex().column()
+        if self.flag_prog_run is True or row < 0 or col < 0:
+            return
+        text = QApplication.clipboard().text().strip()
+        if text == '':
+            return
+        try:
+            values = [[float(v) for v in line.replace(',', '\t').split('\t')]
+                      for line in text.splitlines()]
+            if len({len(line) for line in values}) > 1:
+                raise ValueError("rows have different numbers of values")
+        except ValueError as e:
+            QMessageBox.warning(self, 'Paste', str(e))
+            return
+        prog = self.editableProgram()
+        if prog is None:
+            return
+        try:
+            prog.setBlock(row, col, values)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Paste', str(e))
+
+    def actionApplyExpression(self):
+        ''' 選択したセルに式の値を設定する（1回の編集として取り消せる） '''
+        ranges = list(self.prog_table.selectionModel().selection())
+        if self.flag_prog_run is True or len(ranges) == 0:
+            return
+        expr, ok = QInputDialog.getText(
+                self, 'Apply expression',
+                'Expression of value, ' + ', '.join(self.program.columns)
+                + ' and np:')
+        if not ok or expr.strip() == '':
+            return
+        prog = self.editableProgram()
+        if prog is None:
+            return
+        try:
+            with prog.transaction():
+                for r in ranges:
+                    rows = slice(r.top(), r.bottom() + 1)
+                    for col in range(r.left(), r.right() + 1):
+                        prog.applyExpression(rows, prog.columns[col], expr)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Apply expression', str(e))
 
     def actionNewProgram(self):
         ''' 新規プログラムの action
 
         createProgramDialog を表示して条件を入力し，
         renewProgramを呼んでプログラムを入れ替える。'''
+        import createProgramDialog
+
         logger.debug("actionNewProgram()")
-        dlg = createProgramDialog.createProgramDialog(self)
+        dlg = createProgramDialog.createProgramDialog(
+                self, estimator=self.estimateParams)
         dlg.restoreParamsFromConfig(self.conf)
         dlg.setPlaceHolderFromParams()
         ret = dlg.exec_()
@@ -480,7 +840,46 @@ class MyWindow(QMainWindow):
     def renewProgram(self, params):
         ''' プログラムを更新する '''
         logger.debug('renewProgram()')
+        try:
+            prog = self.generateProgram(params)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Create program', str(e))
+            return
+        self.setProgramData(prog)
 
+    def generateProgram(self, params):
+        ''' createProgramDialog の条件からプログラムを作る
+
+        格子（CUBE）でラスタ・往復走査のときは範囲の定義だけを持つ
+        lazyGridProgram を返す
+        '''
+        import scanOrder
+        import surfaceRegion
+        import adaptiveScan
+        import createProgramDialog
+
+        order = params.get('order', scanOrder.ORDER_RASTER)
+        if (params['mode'] == createProgramDialog.PROGRAM_MODE_CUBE
+                and params.get('adaptive', False)):
+            return adaptiveScan.adaptiveProgram(
+                    [params['x_start'], params['x_stop'], params['x_step']],
+                    [params['y_start'], params['y_stop'], params['y_step']],
+                    [params['z_start'], params['z_stop'], params['z_step']],
+                    max_level=params['refine_levels'],
+                    threshold=params['refine_threshold'],
+                    measure=self.measurementSource(),
+                    settling_time=params['settling_time'],
+                    repetitions=params['repetitions'],
+                    model=self.motion_model)
+        if (params['mode'] == createProgramDialog.PROGRAM_MODE_CUBE
+                and order in program.lazyGridProgram.ORDERS):
+            return program.lazyGridProgram(
+                    [params['x_start'], params['x_stop'], params['x_step']],
+                    [params['y_start'], params['y_stop'], params['y_step']],
+                    [params['z_start'], params['z_stop'], params['z_step']],
+                    settling_time=params['settling_time'],
+                    repetitions=params['repetitions'],
+                    order=order)
         prog = program.stageProgram()
         if params['mode'] == createProgramDialog.PROGRAM_MODE_LINE:
             prog.generateLinePosition(
@@ -490,67 +889,195 @@ class MyWindow(QMainWindow):
                     params['x_step'],
                     settling_time=params['settling_time'],
                     repetitions=params['repetitions'])
+        elif params['mode'] == createProgramDialog.PROGRAM_MODE_SURFACE:
+            prog.generateSurfacePosition(
+                    [params['x_start'], params['x_stop'], params['x_step']],
+                    [params['y_start'], params['y_stop'], params['y_step']],
+                    height=params['z_start'],
+                    plane=surfaceRegion.parsePlane(params['plane']),
+                    region=surfaceRegion.parseRegion(
+                        params['region'], params['region_params']),
+                    settling_time=params['settling_time'],
+                    repetitions=params['repetitions'],
+                    order=order,
+                    model=self.motion_model)
         elif params['mode'] == createProgramDialog.PROGRAM_MODE_CUBE:
             prog.generateGridPosition(
                     [params['x_start'], params['x_stop'], params['x_step']],
                     [params['y_start'], params['y_stop'], params['y_step']],
                     [params['z_start'], params['z_stop'], params['z_step']],
                     settling_time=params['settling_time'],
-                    repetitions=params['repetitions'])
-        self.setProgramData(prog)
-
+                    repetitions=params['repetitions'],
+                    order=order,
+                    model=self.motion_model)
+        return prog
+
+    def measurementSource(self):
+        '''適応走査の測定値を受け取る socketMeasurement（config の measurement_port）'''
+        import adaptiveScan
+
+        port = int(self.conf.get('measurement_port', DEFAULT_PARAMS['measurement_port']))
+        if (self.measurement is None or self.measurement.port != port
+                or self.measurement.disabled):
+            # 前の実行で接続に失敗して無効になったものは作り直す
+            if self.measurement is not None:
+                self.measurement.close()
+            self.measurement = adaptiveScan.socketMeasurement(port)
+        return self.measurement
 
     def actionOpenProgram(self):
         ''' open が選ばれたときの action '''
         logger.debug("actionOpenProgram()")
         fname = QFileDialog.getOpenFileName(
-                self, caption='Open Program File', filter="CSV (*.csv)")
+                self, caption='Open Program File', filter=self.PROGRAM_FILTERS)
         if fname[0] != '':
             logger.debug("    fname: %s", fname[0])
-            prog_opened = program.stageProgram()
-            prog_opened.read_csv(fname[0])
+            if (fname[0].endswith('.csv') and os.path.getsize(fname[0])
+                    > self.STREAM_IMPORT_BYTES):
+                self.startImport(fname[0])
+                return
+            try:
+                prog_opened = program.readProgram(fname[0])
+            except (OSError, ValueError) as e:
+                QMessageBox.warning(self, 'Open Program File', str(e))
+                return
             self.setProgramData(prog_opened)
 
+    def actionReorderProgram(self):
+        ''' 読み込んだプログラムの走査順を最適化する '''
+        import scanOrder
+        import adaptiveScan
+
+        logger.debug("actionReorderProgram()")
+        if (self.flag_prog_run is True or len(self.program) == 0
+                or self.importInProgress()
+                or isinstance(self.program, adaptiveScan.adaptiveProgram)):
+            return
+        if isinstance(self.program, program.lazyGridProgram):
+            self.attachProgram(self.program.materialize())
+        try:
+            # 点が多ければ Hilbert 曲線の順を 2-opt で改善する
+            self.program.reorder(scanOrder.ORDER_AUTO, self.motion_model)
+        except ValueError as e:
+            QMessageBox.warning(self, 'Optimize scan order', str(e))
+            return
+        self.setProgramData(self.program)
+
     def actionSaveProgram(self):
         ''' save が選ばれたときの action '''
         logger.debug("actionSaveProgram()")
-        fname = QFileDialog.getSaveFileName(self, 'Save Program File')
+        if self.importInProgress():
+            QMessageBox.warning(self, 'Save Program File',
+                                'The program is still being imported.')
+            return
+        fname = QFileDialog.getSaveFileName(
+                self, 'Save Program File', filter=self.PROGRAM_FILTERS)
         if fname[0] != '':
-            logger.debug("    fname: %s", fname[0])
-            self.program.to_csv(fname[0])
+            filename = fname[0]
+            if (fname[1].startswith('Binary')
+                    and not filename.endswith(program.BINARY_SUFFIX)):
+                filename += program.BINARY_SUFFIX
+            logger.debug("    fname: %s", filename)
+            if filename.endswith(program.BINARY_SUFFIX):
+                self.program.to_binary(filename)
+            else:
+                self.program.to_csv(filename)
+
+    def validateProgram(self):
+        '''プログラムの全行を検査し，問題のある行に色をつける'''
+        import programValidator
+
+        try:
+            limits = programValidator.programLimits.fromConfig(self.conf)
+        except ValueError as e:
+            logger.warning("validateProgram(): bad limits in config: %s", e)
+            limits = None
+        report = programValidator.validateProgram(
+                self.program, self.stage, limits, self.motion_model,
+                self.OSCI_TRIGGER_DURATION / 1000, start=self.stage.last_move_to)
+        self.highlightRows(report)
+        return report
+
+    def highlightRows(self, report):
+        '''検査で問題のあった行の背景色を変える'''
+        import programValidator
+
+        row_colors = np.where(report.flags & programValidator.ERROR_ISSUES, 1,
+                              np.where(report.flags != 0, 2, 0))
+        self.prog_model.setRowColors(
+                row_colors, [self.ERROR_ROW_COLOR, self.WARNING_ROW_COLOR])
+
+    def actionValidateProgram(self):
+        ''' プログラムを検査して結果を表示する '''
+        logger.debug("actionValidateProgram()")
+        if len(self.program) == 0:
+            return
+        report = self.validateProgram()
+        dlg = QMessageBox(self)
+        dlg.setWindowTitle('Validate program')
+        dlg.setText(f"<pre>{report.summary()}</pre>")
+        dlg.exec_()
+        rows = report.rows()
+        if len(rows) > 0:
+            self.setCurrentRow(int(rows[0]))
 
     def actionRun(self):
         ''' run '''
+        import programCompiler
+        import adaptiveScan
+
         logger.debug("actionRun()")
         if self.flag_prog_run is False:
-            self.flag_prog_run = True
+            report = self.validateProgram()
+            if not report.ok:
+                ret = QMessageBox.question(
+                        self, 'Run program',
+                        f"<pre>{report.summary()}</pre>Run anyway?",
+                        QMessageBox.Yes | QMessageBox.No, QMessageBox.No)
+                if ret != QMessageBox.Yes:
+                    return
+            cur_row = max(self.currentRow(), 0)
+            logger.debug("actionRun(): cur_row:%d", cur_row)
+            if (isinstance(self.program, program.stageProgram)
+                    and not isinstance(self.program, adaptiveScan.adaptiveProgram)):
+                self.compiled = programCompiler.loadOrCompile(
+                        self.program, self.stage, {'tick1': self.TICK_CHANNEL})
+            else:
+                # lazyGridProgram や行の増えるプログラムは行ごとにコマンドを生成する
+                self.compiled = None
             self.act_prog_run.setEnabled(False)
             self.act_prog_stop.setEnabled(True)
-            cur_row = max(self.prog_table.currentRow(), 0)
-            self.tableSelectRow(cur_row)
-            logger.debug("actionRun(): cur_row:%d", cur_row)
-            self.posi_con.go()
+            self.engine.run(self.program, cur_row, self.compiled)
 
     def actionStopProgram(self):
         ''' stop program '''
         logger.debug("actionStopProgram")
-        if self.flag_prog_run is True:
-            self.settling_timer.stop()
-            self.flag_prog_run = False
-            self.act_prog_run.setEnabled(True)
-            self.act_prog_stop.setEnabled(False)
+        self.engine.stop()
+
+    def runFinished(self):
+        ''' プログラムの実行が終わった（中断を含む）とき '''
+        self.act_prog_run.setEnabled(True)
+        self.act_prog_stop.setEnabled(False)
+        self.calibrateMotionModel()
+
+    def actionSerialStats(self):
+        ''' シリアル通信の時間統計を表示する '''
+        report = self.stage.serial_stats.report()
+        logger.info("serial statistics:\n%s", report)
+        dlg = QMessageBox(self)
+        dlg.setWindowTitle('Serial statistics')
+        dlg.setText(f"<pre>{report}</pre>")
+        dlg.exec_()
 
     def outputOn(self, ch):
         ''' 指定されたチャネルの出力をON '''
         logger.debug("outputOn: %d", ch)
-        self.stage.digitalWrite(ch, stage.IO_ON)
-        self.io_monitor.btn_lamp_on(ch)
+        self.engine.output(ch, True)
 
     def outputOff(self, ch):
         ''' 指定されたチャネルの出力をOff '''
-        logger.debug("outputOn: %d", ch)
-        self.stage.digitalWrite(ch, stage.IO_OFF)
-        self.io_monitor.btn_lamp_off(ch)
+        logger.debug("outputOff: %d", ch)
+        self.engine.output(ch, False)
 
     def actionOutputOn(self, ch):
         ''' Output Button is presssed '''
@@ -562,38 +1089,86 @@ class MyWindow(QMainWindow):
         logger.debug("actionOutputOff: %d", ch)
         self.outputOff(ch)
 
-    def selectSerialPort(self):
-        ''' シリアルポートの選択 '''
+    def selectSerialPort(self, devices=None):
+        ''' シリアルポートの選択
+
+        devices は stage.scanDevices() の Future（None ならここで調べる）
+        '''
 
         dlg_port = portSettingDialog.portSettingDialog(self,
-                candidate_device=self.conf['device_name'])
+                candidate_device=self.conf['device_name'], devices=devices)
         if dlg_port.exec_() == QDialog.Accepted:
             self.device_name = dlg_port.selectedPort()
             self.conf['device_name'] = self.device_name
         else:
             self.device_name = None
 
-def main():
+    def startup(self, devices=None, profile=None):
+        ''' ウィンドウを表示したあとの起動処理
+
+        ポートの選択，接続と getInfo()，新規プログラムのダイアログは
+        イベントループが始まってから（最初の描画のあとに）行う。
+
+        Args:
+            devices (concurrent.futures.Future): stage.scanDevices() の結果
+            profile (startupProfile.startupProfile): --startup-profile のとき
+        '''
+        if profile is not None:
+            profile.mark('event loop (window interactive)')
+        if self.device_name is None:
+            self.selectSerialPort(devices)
+            if profile is not None:
+                profile.mark('port selection')
+        if self.device_name is None:
+            qApp.exit()
+            return
+        scanned = None
+        if devices is not None and devices.done() and devices.exception() is None:
+            scanned = devices.result()
+        self.openStage(self.device_name, scanned)
+        self.showStatus()
+        self.stage.getInfo()
+        self.initPreset()
+        if profile is not None:
+            profile.mark('open port, getInfo')
+            print(profile.report(), flush=True)
+        self.actionNewProgram()
+
+def main(args, profile=None):
     ''' メイン関数 '''
+    # ポートの列挙はウィンドウの表示と並行して行う
+    devices = None if args.emulator is True else stage.scanDevices()
     entire_conf = config.readFile(
             appname=APP_NAME, vender=VENDER_NAME, defaults=DEFAULT_PARAMS)
     conf = entire_conf[gethostname()]
+    if profile is not None:
+        profile.mark('config')
 
     app = QApplication(sys.argv)
+    if profile is not None:
+        profile.mark('QApplication')
     gui = MyWindow(conf, app.desktop())
-    gui.selectSerialPort()
+    if profile is not None:
+        profile.mark('main window')
+    emulator = None
+    try:
+        if args.emulator is True:
+            # pty を使うので posix でのみ利用可能
+            import shotEmulator
+            emulator = shotEmulator.shotEmulator()
+            gui.device_name = emulator.start()
+        QtCore.QTimer.singleShot(0, lambda: gui.startup(devices, profile))
+
+        status = app.exec_()
+    finally:
+        # ポートを選ばなかったときや例外で抜けたときもエミュレータを止める
+        if emulator is not None:
+            emulator.stop()
     if gui.device_name is None:
+        # ポートを選ばなかった
         sys.exit()
-    else:
-        gui.stage.openSerial(gui.device_name)
-        gui.showStatus()
-
-        gui.stage.getInfo()
-
-    gui.initPreset()
-    gui.actionNewProgram()
-
-    status = app.exec_()
+    if args.serial_stats is True:
+        print(gui.stage.serial_stats.report())
     config.updateFile(entire_conf, appname=APP_NAME, vender=VENDER_NAME)
     sys.exit(status)
 
@@ -603,6 +1178,17 @@ if __name__ == "__main__":
     parser.add_argument(
             "-v", "--verbose", help="increase verbosity level",
             action="count", default=0)
+    parser.add_argument(
+            "--emulator", help="use built-in SHOT-304GS emulator",
+            action="store_true")
+    parser.add_argument(
+            "--serial-stats",
+            help="print latency statistics of serial transactions on exit",
+            action="store_true")
+    parser.add_argument(
+            "--startup-profile",
+            help="print import and startup phase timings",
+            action="store_true")
     args = parser.parse_args()
 
     if args.verbose > 0:
@@ -610,4 +1196,7 @@ if __name__ == "__main__":
     else:
         logging.basicConfig(level=logging.INFO)
 
-    main()
+    if startup_profile is not None:
+        startup_profile.uninstall()
+        startup_profile.mark('imports')
+    main(args, startup_profile)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+''' SHOT-304GS エミュレータ
+
+疑似端末（pty）に接続し，SHOT-304GS と同じプロトコルで応答する。
+ハードウェアがなくても shotControl.py を実機に近い速度で動かせる。
+
+単独で起動すると疑似端末のデバイス名を表示して待ち受ける::
+
+    $ python shotEmulator.py
+    /dev/pts/3
+
+shotControl.py からは --emulator オプションで同じプロセス内に起動できる。
+'''
+
+import os
+import pty
+import re
+import select
+import sys
+import threading
+import time
+import tty
+import logging
+import argparse
+
+import motionModel
+from motionModel import trapezoidTime, trapezoidPosition
+
+logger = logging.getLogger(__name__)
+
+NAXES = 4
+
+ROM_VERSION = 'V1.00'
+DISTANCE_PER_PULSE = '1.0,1.0,1.0,1.0'  # ?:PW の応答
+DIVISIONS = '2,2,2,2'                   # ?:SW の応答
+
+
+class axisState():
+    '''1軸分の状態'''
+
+    def __init__(self):
+        self.origin = 0             # 論理原点の位置 [pulse]
+        self.start_speed = motionModel.DEFAULT_START_SPEED
+        self.max_speed = motionModel.DEFAULT_MAX_SPEED
+        self.accel_time = motionModel.DEFAULT_ACCEL_TIME
+        self.move_from = 0          # 以下，位置は機械原点基準 [pulse]
+        self.move_to = 0
+        self.move_start = 0.0
+        self.move_time = 0.0
+
+    def startMove(self, target, now):
+        '''target（機械原点基準）への移動を開始する'''
+        self.move_from = self.currentPosition(now)
+        self.move_to = target
+        self.move_start = now
+        self.move_time = trapezoidTime(
+                target - self.move_from,
+                self.start_speed, self.max_speed, self.accel_time)
+
+    def currentPosition(self, now):
+        '''時刻 now の位置'''
+        if self.isBusy(now):
+            return self.move_from + trapezoidPosition(
+                    now - self.move_start, self.move_to - self.move_from,
+                    self.start_speed, self.max_speed, self.accel_time)
+        return self.move_to
+
+    def isBusy(self, now):
+        '''移動中かどうか'''
+        return now < self.move_start + self.move_time
+
+    def stop(self, now):
+        '''その場で停止する'''
+        pos = self.currentPosition(now)
+        self.move_from = pos
+        self.move_to = pos
+        self.move_time = 0.0
+
+
+class shotEmulator():
+    ''' SHOT-304GS のエミュレータ
+
+    Parameters
+    ----------
+    baudrate: int
+        応答の送出時間の計算に使うボーレート。0 なら遅延なし
+    latency: float
+        コマンドを受けてから応答するまでの処理時間 [s]
+    '''
+    BITS_PER_BYTE = 10
+
+    def __init__(self, baudrate=9600, latency=0.002):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.axes = [axisState() for _ in range(NAXES)]
+        self.pending_target = None
+        self.io_out = 0
+        self.ack1 = 'K'
+        self.ack2 = 'K'
+        self.master_fd = None
+        self.slave_fd = None
+        self.port_name = None
+        self.thread = None
+        self.running = False
+        self.rxbuf = b''
+
+    def start(self):
+        '''疑似端末を作成し，応答スレッドを開始する
+
+        Return
+        ------
+        port_name: string
+            接続先のデバイス名
+        '''
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port_name = os.ttyname(self.slave_fd)
+        self.running = True
+        self.thread = threading.Thread(
+                target=self.serve, name='shotEmulator', daemon=True)
+        self.thread.start()
+        logger.info("shotEmulator: listening on %s", self.port_name)
+        return self.port_name
+
+    def stop(self):
+        '''応答スレッドを停止し，疑似端末を閉じる'''
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = None
+        self.slave_fd = None
+
+    def serve(self):
+        '''コマンドを受信して応答する（スレッド本体）'''
+        while self.running:
+            readable, _, _ = select.select([self.master_fd], [], [], 0.1)
+            if not readable:
+                continue
+            try:
+                self.rxbuf += os.read(self.master_fd, 1024)
+            except OSError:
+                break
+            while b'\r\n' in self.rxbuf:
+                line, self.rxbuf = self.rxbuf.split(b'\r\n', 1)
+                cmd = line.decode('utf-8', errors='replace')
+                self.transferDelay(len(line) + 2)
+                reply = self.execute(cmd, time.monotonic())
+                logger.debug("shotEmulator: %s -> %s", cmd, reply)
+                if self.latency > 0:
+                    time.sleep(self.latency)
+                self.transferDelay(len(reply) + 2)
+                os.write(self.master_fd, (reply + '\r\n').encode('utf-8'))
+
+    def transferDelay(self, nbytes):
+        '''nbytes をボーレートで送るのにかかる時間だけ待つ'''
+        if self.baudrate > 0:
+            time.sleep(nbytes * self.BITS_PER_BYTE / self.baudrate)
+
+    def isBusy(self, now):
+        '''いずれかの軸が移動中かどうか'''
+        return any(ax.isBusy(now) for ax in self.axes)
+
+    def execute(self, cmd, now):
+        '''1コマンドを実行して応答文字列を返す'''
+        handlers = {
+                'A': self.cmdMove, 'M': self.cmdMove, 'G': self.cmdGo,
+                'Q': self.cmdQuery, '!': self.cmdStatus, 'O': self.cmdOutput,
+                'L': self.cmdStop, 'R': self.cmdResetOrigin,
+                'H': self.cmdHome, 'D': self.cmdSpeed, '?': self.cmdInfo,
+                }
+        if len(cmd) < 2 or cmd[1] != ':' or cmd[0] not in handlers:
+            return self.ng()
+        reply = handlers[cmd[0]](cmd[0], cmd[2:], now)
+        if reply != 'NG':
+            self.ack1 = 'K'
+        return reply
+
+    def ng(self):
+        '''コマンドエラー'''
+        self.ack1 = 'X'
+        return 'NG'
+
+    def axisIndices(self, spec):
+        '''軸指定（'1'〜'4' または 'W'）を軸番号のリストにする'''
+        if spec == 'W':
+            return list(range(NAXES))
+        if spec in ('1', '2', '3', '4'):
+            return [int(spec) - 1]
+        return None
+
+    def cmdMove(self, kind, args, now):
+        '''A:（絶対移動）と M:（相対移動）の移動量設定'''
+        m = re.fullmatch(r'([1-4W])((?:[+-]P\d+)+)', args)
+        if m is None or self.isBusy(now):
+            return self.ng()
+        indices = self.axisIndices(m.group(1))
+        values = [int(v.replace('P', ''))
+                  for v in re.findall(r'[+-]P\d+', m.group(2))]
+        if len(values) > len(indices):
+            return self.ng()
+        target = [ax.currentPosition(now) for ax in self.axes]
+        for i, v in zip(indices, values):
+            if kind == 'A':
+                target[i] = self.axes[i].origin + v
+            else:
+                target[i] = target[i] + v
+        self.pending_target = target
+        return 'OK'
+
+    def cmdGo(self, kind, args, now):
+        '''G: 駆動開始'''
+        if self.pending_target is None or self.isBusy(now):
+            return self.ng()
+        for ax, target in zip(self.axes, self.pending_target):
+            ax.startMove(target, now)
+        self.pending_target = None
+        return 'OK'
+
+    def cmdQuery(self, kind, args, now):
+        '''Q: 位置と状態'''
+        pos = [f"{ax.currentPosition(now) - ax.origin:10d}"
+               for ax in self.axes]
+        ack3 = 'B' if self.isBusy(now) else 'R'
+        return ','.join(pos + [self.ack1, self.ack2, ack3])
+
+    def cmdStatus(self, kind, args, now):
+        '''!: Busy/Ready'''
+        return 'B' if self.isBusy(now) else 'R'
+
+    def cmdOutput(self, kind, args, now):
+        '''O: I/O出力'''
+        if not args.isdigit():
+            return self.ng()
+        self.io_out = int(args) & 0b1111
+        return 'OK'
+
+    def cmdStop(self, kind, args, now):
+        '''L: 停止（L:E は全軸の非常停止）'''
+        indices = list(range(NAXES)) if args == 'E' else self.axisIndices(args)
+        if indices is None:
+            return self.ng()
+        for i in indices:
+            self.axes[i].stop(now)
+        return 'OK'
+
+    def cmdResetOrigin(self, kind, args, now):
+        '''R: 論理原点の設定'''
+        indices = self.axisIndices(args)
+        if indices is None or self.isBusy(now):
+            return self.ng()
+        for i in indices:
+            self.axes[i].origin = self.axes[i].currentPosition(now)
+        return 'OK'
+
+    def cmdHome(self, kind, args, now):
+        '''H: 機械原点復帰。論理原点も機械原点になる'''
+        indices = self.axisIndices(args)
+        if indices is None or self.isBusy(now):
+            return self.ng()
+        for i in indices:
+            self.axes[i].origin = 0
+            self.axes[i].startMove(0, now)
+        return 'OK'
+
+    def cmdSpeed(self, kind, args, now):
+        '''D: 速度設定。D:1S500F5000R200 または D:WS..F..R..S..F..R..'''
+        m = re.fullmatch(r'([1-4W])((?:S\d+F\d+R\d+)+)', args)
+        if m is None or self.isBusy(now):
+            return self.ng()
+        indices = self.axisIndices(m.group(1))
+        groups = re.findall(r'S(\d+)F(\d+)R(\d+)', m.group(2))
+        if len(groups) > len(indices):
+            return self.ng()
+        for i, (s, f, r) in zip(indices, groups):
+            self.axes[i].start_speed = int(s)
+            self.axes[i].max_speed = int(f)
+            self.axes[i].accel_time = int(r) / 1000
+        return 'OK'
+
+    def cmdInfo(self, kind, args, now):
+        '''?: 内部情報'''
+        info = {'V': ROM_VERSION, 'PW': DISTANCE_PER_PULSE, 'SW': DIVISIONS}
+        if args not in info:
+            return self.ng()
+        return info[args]
+
+
+def main():
+    '''エミュレータを単独で起動する'''
+    parser = argparse.ArgumentParser(description="SHOT-304GS emulator")
+    parser.add_argument(
+            "-b", "--baudrate", type=int, default=9600,
+            help="baudrate used for reply timing (0: no delay)")
+    parser.add_argument(
+            "-l", "--link",
+            help="create a symbolic link to the pseudo terminal")
+    parser.add_argument(
+            "-v", "--verbose", help="increase verbosity level",
+            action="count", default=0)
+    args = parser.parse_args()
+
+    if args.verbose > 0:
+        logging.basicConfig(level=logging.DEBUG)
+    else:
+        logging.basicConfig(level=logging.INFO)
+
+    emu = shotEmulator(baudrate=args.baudrate)
+    port_name = emu.start()
+    if args.link is not None:
+        if os.path.islink(args.link):
+            os.remove(args.link)
+        os.symlink(port_name, args.link)
+        port_name = args.link
+    print(port_name, flush=True)
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emu.stop()
+        if args.link is not None:
+            os.remove(args.link)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
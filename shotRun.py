@@ -0,0 +1,300 @@
+''' 表示なしでプログラムを実行するコマンド（PyQt5 を import しない）
+
+    python shotRun.py [--port PORT | --emulator] program.shotp
+
+ポートを開いて getInfo() し，プログラムを読み込んで検査と変換をしたあと，
+runEngine で GUI と同じ手順（移動，セトリング，tick，トリガ）で実行する。
+進み具合は標準出力（--log があればそのファイル）に書き，最後に
+結果の要約を JSON で出力する。終了コードは EXIT_* のとおり。
+'''
+
+import argparse
+import asyncio
+import json
+import logging
+import signal
+import sys
+import time
+from socket import gethostname
+
+import config
+import stage
+import program
+import programCompiler
+import programValidator
+import completionDetector
+import motionModel
+import runEngine
+
+logger = logging.getLogger(__name__)
+
+# 終了コード
+EXIT_OK = 0
+EXIT_ERROR = 1              # 実行中の予期しないエラー
+EXIT_USAGE = 2              # 引数の誤り（argparse と同じ）
+EXIT_VALIDATION = 3         # 検査でエラーがあった（--force なしのとき）
+EXIT_INTERRUPTED = 4        # SIGINT / SIGTERM で中断した
+EXIT_IO = 5                 # ポートやプログラムファイルを開けない
+
+EXIT_STATUS = {
+        EXIT_OK: 'ok',
+        EXIT_ERROR: 'error',
+        EXIT_USAGE: 'usage',
+        EXIT_VALIDATION: 'validation failed',
+        EXIT_INTERRUPTED: 'interrupted',
+        EXIT_IO: 'i/o error',
+        }
+
+PROGRESS_INTERVAL = 1.0     # 進み具合を出力する間隔 [s]
+
+
+class progressPrinter():
+    '''runEngine のイベントを受けて進み具合を1行ずつ書く
+
+    interval 秒に1回（0 なら毎ステップ）と，実行の終わりに書く。
+    '''
+
+    def __init__(self, out, nrows, start_row=0, interval=PROGRESS_INTERVAL):
+        self.out = out
+        self.nrows = nrows
+        self.start_row = start_row
+        self.interval = interval
+        self.t_start = time.monotonic()
+        self.t_last = None
+        self.steps = 0
+        self.row = start_row
+
+    def __call__(self, event, data):
+        if event == runEngine.EVENT_ROWS_ADDED:
+            self.nrows = data['nrows']
+        elif event == runEngine.EVENT_STEP:
+            self.steps += 1
+            self.row = data['row']
+            now = time.monotonic()
+            if self.t_last is None or now - self.t_last >= self.interval:
+                self.t_last = now
+                self.write(now)
+        elif event == runEngine.EVENT_FINISHED:
+            self.write(time.monotonic(), data['reason'])
+
+    def write(self, now, reason=None):
+        elapsed = now - self.t_start
+        total = self.nrows - self.start_row
+        line = (f"row {self.row}/{self.nrows - 1} "
+                f"steps {self.steps}/{total} "
+                f"({100 * self.steps / max(total, 1):.1f}%) "
+                f"elapsed {elapsed:.1f} s")
+        if reason is None and self.steps > 0:
+            line += f" remaining {elapsed / self.steps * (total - self.steps):.0f} s"
+        if reason is not None:
+            line += f" {reason}"
+        print(line, file=self.out, flush=True)
+
+
+def loadConfig():
+    '''GUI と同じ config のこのホストの部分（読むだけで更新はしない）'''
+    entire_conf = config.readFile(appname=config.APP_NAME, vender=config.VENDER_NAME)
+    return entire_conf[gethostname()]
+
+
+def motionModelFromConfig(stg, conf):
+    '''config の補正値を使った駆動モデル'''
+    calib = {}
+    for k, v in motionModel.CALIBRATION_CONFIG_KEYS.items():
+        try:
+            calib[k] = float(conf[v])
+        except (KeyError, ValueError):
+            pass
+    return motionModel.stageMotionModel.fromStage(stg, **calib)
+
+
+def validate(prog, stg, conf, model, trigger_duration):
+    '''GUI の実行前と同じ検査をする'''
+    try:
+        limits = programValidator.programLimits.fromConfig(conf)
+    except ValueError as e:
+        logger.warning("validate(): bad limits in config: %s", e)
+        limits = None
+    return programValidator.validateProgram(
+            prog, stg, limits, model, trigger_duration, start=stg.last_move_to)
+
+
+def writeSummary(summary, filename):
+    '''要約を JSON で書く（filename が None なら標準出力の最後の1行）'''
+    text = json.dumps(summary)
+    if filename is None:
+        print(text, flush=True)
+        return
+    with open(filename, 'w') as f:
+        f.write(text + '\n')
+
+
+def runProgram(args, conf, out, summary):
+    '''ポートを開いてプログラムを実行し，終了コードを返す（summary に結果を書き込む）'''
+    t0 = time.monotonic()
+    try:
+        prog = program.readProgram(args.program)
+    except (OSError, ValueError) as e:
+        logger.error("cannot read program: %s: %s", args.program, e)
+        return EXIT_IO
+    summary['total_rows'] = len(prog)
+    if args.start_row >= len(prog):
+        logger.error("start row %d is beyond the program (%d rows)",
+                     args.start_row, len(prog))
+        return EXIT_USAGE
+
+    emulator = None
+    port = args.port
+    if args.emulator:
+        # pty を使うので posix でのみ利用可能
+        import shotEmulator
+        emulator = shotEmulator.shotEmulator()
+        port = emulator.start()
+    elif port is None:
+        port = conf.get('device_name', config.DEFAULT_PARAMS['device_name'])
+    summary['port'] = port
+
+    stg = stage.stage()
+    loop = asyncio.new_event_loop()
+    try:
+        stg.openSerial(port)
+        if stg.phantom_port is True and not args.phantom:
+            logger.error("cannot open port: %s", port)
+            return EXIT_IO
+        stg.getInfo()
+        summary['phase_time']['setup'] = time.monotonic() - t0
+
+        t1 = time.monotonic()
+        model = motionModelFromConfig(stg, conf)
+        report = validate(prog, stg, conf, model, args.trigger_duration)
+        summary['validation'] = {name: report.count(issue)
+                                 for issue, name in programValidator.ISSUE_NAMES.items()}
+        for line in report.summary().splitlines():
+            print(line, file=out, flush=True)
+        if not report.ok and not args.force:
+            logger.error("validation failed (use --force to run anyway)")
+            summary['phase_time']['validate'] = time.monotonic() - t1
+            return EXIT_VALIDATION
+        compiled = programCompiler.loadOrCompile(
+                prog, stg, {'tick1': runEngine.TICK_CHANNEL})
+        summary['phase_time']['validate'] = time.monotonic() - t1
+
+        detector = completionDetector.completionDetector(stg, model)
+        engine = runEngine.runEngine(
+                stg, loop, detector=detector,
+                trigger_duration=args.trigger_duration)
+        engine.subscribe(progressPrinter(
+                out, len(prog), args.start_row, args.progress_interval))
+        interrupted = []
+
+        def interrupt():
+            logger.warning("interrupted: stopping the stage")
+            interrupted.append(True)
+            engine.stop()
+
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, interrupt)
+            except (NotImplementedError, RuntimeError):
+                # Windows のイベントループでは使えない（Ctrl-C は KeyboardInterrupt）
+                pass
+        try:
+            result = engine.runUntilComplete(prog, args.start_row, compiled)
+        except KeyboardInterrupt:
+            interrupt()
+            result = {'reason': runEngine.FINISH_STOPPED, 'steps': engine.steps}
+        finally:
+            engine.cancelPoll()
+        stats = engine.stats()
+        summary['points_done'] = result['steps']
+        summary['last_row'] = engine.row
+        summary['run_time'] = stats.pop('elapsed')
+        summary['phase_time'].update(stats.pop('phase_time'))
+        summary['stats'] = stats
+        if interrupted or result['reason'] != runEngine.FINISH_END:
+            return EXIT_INTERRUPTED
+        return EXIT_OK
+    except OSError as e:
+        logger.error("%s: %s", port, e)
+        return EXIT_IO
+    finally:
+        loop.close()
+        if stg.ser is not None and stg.ser.is_open:
+            stg.ser.close()
+        if emulator is not None:
+            emulator.stop()
+
+
+def main(args):
+    ''' メイン関数（終了コードを返す）'''
+    t0 = time.monotonic()
+    out = sys.stdout if args.log is None else open(args.log, 'a')
+    logging.basicConfig(
+            stream=out if args.log is not None else sys.stderr,
+            format='%(asctime)s %(levelname)s %(name)s: %(message)s',
+            level=logging.DEBUG if args.verbose > 0 else logging.INFO)
+    summary = {
+            'status': None,
+            'exit_code': None,
+            'program': args.program,
+            'start_row': args.start_row,
+            'total_rows': None,
+            'points_done': 0,
+            'wall_time': None,
+            'phase_time': {},
+            }
+    try:
+        code = runProgram(args, loadConfig(), out, summary)
+    except Exception:
+        logger.exception("unexpected error")
+        code = EXIT_ERROR
+    summary['status'] = EXIT_STATUS[code]
+    summary['exit_code'] = code
+    summary['wall_time'] = time.monotonic() - t0
+    writeSummary(summary, args.summary)
+    if out is not sys.stdout:
+        out.close()
+    return code
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(
+            description="run a stage program without the GUI")
+    parser.add_argument("program", help="program file (.shotp or .csv)")
+    port = parser.add_mutually_exclusive_group()
+    port.add_argument(
+            "--port", help="serial port (default: device_name in the config)")
+    port.add_argument(
+            "--emulator", help="use built-in SHOT-304GS emulator",
+            action="store_true")
+    parser.add_argument(
+            "--phantom", help="run on the phantom port if the port cannot be opened",
+            action="store_true")
+    parser.add_argument(
+            "--start-row", help="row to start from (default: 0)",
+            type=int, default=0)
+    parser.add_argument(
+            "--force", help="run even if the validation finds errors",
+            action="store_true")
+    parser.add_argument(
+            "--trigger-duration", help="trigger output duration [s]",
+            type=float, default=runEngine.TRIGGER_DURATION)
+    parser.add_argument(
+            "--progress-interval",
+            help=f"seconds between progress lines (0: every step, default: {PROGRESS_INTERVAL})",
+            type=float, default=PROGRESS_INTERVAL)
+    parser.add_argument(
+            "--log", help="write progress and log to FILE instead of stdout/stderr")
+    parser.add_argument(
+            "--summary", help="write the JSON summary to FILE instead of stdout")
+    parser.add_argument(
+            "-v", "--verbose", help="increase verbosity level",
+            action="count", default=0)
+    args = parser.parse_args(argv)
+    if args.start_row < 0:
+        parser.error("--start-row must not be negative")
+    return args
+
+
+if __name__ == "__main__":
+    sys.exit(main(parseArgs()))
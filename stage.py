@@ -1,19 +1,29 @@
 ''' ステージのクラス
 '''
 
+import concurrent.futures
+import os
 import re
+import threading
+import time
 # import sys
 # import io
 import logging
 
 import serial
-import serial.tools.list_ports
+
+import responseFramer
+import serialStats
+import motionModel
 
 logger = logging.getLogger(__name__)
 
 IO_ON = 1
 IO_OFF = 0
 
+# 出力パターン 0〜15 に対するエンコード済みの O: コマンド
+OUTPUT_COMMANDS = [f"O:{v}\r\n".encode('utf-8') for v in range(16)]
+
 class stage():
     ''' XYZステージクラス
 
@@ -26,6 +36,7 @@ class stage():
     DEFAULT_STOPBIT = serial.STOPBITS_ONE
     DEFAULT_TIMEOUT = 1
     DEFAULT_WRITE_TIMEOUT = 1
+    READ_POLL_TIMEOUT = 0.05    # 受信待ち1回あたりの最大時間 [s]
 
     def __init__(self):
         self.npulses_per_mm = 500
@@ -37,11 +48,22 @@ class stage():
         self.rom_version = "dummy"
         self.distance_per_pulse = [1.0, 1.0, 1.0, 1.0]
         self.divisions = [2, 2, 2, 2]
+        # 各軸の速度設定（D: コマンドで設定する値）
+        self.start_speed = [motionModel.DEFAULT_START_SPEED] * 4    # [pps]
+        self.max_speed = [motionModel.DEFAULT_MAX_SPEED] * 4        # [pps]
+        self.accel_time = [motionModel.DEFAULT_ACCEL_TIME] * 4      # [s]
         self.last_move_to = [0, 0, 0]
         self.io_out = 0
+        self.transport = None    # asyncStage など。None なら直接 ser を使う
+        self.step_stats = self.emptyIOStats()
+        self.framer = responseFramer.responseFramer()
+        self.serial_stats = serialStats.transactionStats()
+
+    def openSerial(self, portname, devices=None):
+        ''' シリアルポートを開く
 
-    def openSerial(self, portname):
-        ''' シリアルポートを開く '''
+        devices は get_device_list() の結果（None ならここで調べる）
+        '''
         logger.debug("stage.open(): %s", portname)
         self.serport = portname
         self.ser = serial.Serial()
@@ -50,10 +72,12 @@ class stage():
         self.ser.bytesize = serial.EIGHTBITS
         self.ser.parity = serial.PARITY_NONE
         self.ser.stopbits = serial.STOPBITS_ONE
-        self.ser.timeout = 5
+        # 応答の締切は responseFramer が管理するので，read は短く区切る
+        self.ser.timeout = self.READ_POLL_TIMEOUT
 
-        s_devs = get_device_list()
-        if portname in s_devs:
+        s_devs = get_device_list() if devices is None else devices
+        # 疑似端末（shotEmulator）は一覧に現れないのでパスの存在で判断
+        if portname in s_devs or os.path.exists(portname):
             try:
                 self.ser.open()
                 self.phantom_port = False
@@ -92,14 +116,148 @@ class stage():
         '''
         logger.debug("sendCommand: %s", cmd)
         if self.phantom_port is True:
-            buf = 'OK'
+            buf = self.phantomReply(cmd)
+        elif self.transport is not None:
+            buf = self.transport.request(cmd)
         else:
-            self.ser.write((cmd + '\r\n').encode('utf-8'))
-            buf = self.ser.readline()
-            buf = buf.strip().decode('utf-8')
+            buf = self.sendEncoded((cmd + '\r\n').encode('utf-8'), 1)[0]
 
         return buf
 
+    def sendCommands(self, cmds):
+        '''複数のコマンドをまとめて送出する
+
+        コマンド列を1回で書き出してから，応答を順に読み出す。
+        応答を1つずつ待つより往復の回数が少なくて済む。
+
+        Parameter
+        ----------
+        cmds: list of string
+            送出コマンドの列
+
+        Return
+        ------
+        status: list of string
+            各コマンドへのステージからの返り値
+        '''
+        logger.debug("sendCommands: %s", cmds)
+        if self.phantom_port is True:
+            bufs = [self.phantomReply(cmd) for cmd in cmds]
+        elif self.transport is not None:
+            bufs = self.transport.requestMany(cmds)
+        else:
+            data = b''.join((cmd + '\r\n').encode('utf-8') for cmd in cmds)
+            bufs = self.sendEncoded(data, len(cmds))
+
+        return bufs
+
+    def sendEncoded(self, data, ncommands):
+        '''エンコード済みのコマンド列をそのまま送出する
+
+        Parameter
+        ----------
+        data: bytes
+            CRLF 区切りのコマンド列
+        ncommands: int
+            data に含まれるコマンド数
+
+        Return
+        ------
+        status: list of string
+            各コマンドへのステージからの返り値
+        '''
+        if self.phantom_port is True:
+            bufs = ['OK'] * ncommands
+        elif self.transport is not None:
+            bufs = self.transport.requestEncoded(data, ncommands)
+        else:
+            self.waitResync()
+            now = time.monotonic()
+            reqs = [self.framer.expect(cmd, now)
+                    for cmd in responseFramer.splitCommands(data)]
+            self.ser.write(data)
+            write_time = time.monotonic() - now
+            for req in reqs:
+                req.write_time = write_time
+            nread = self.readReplies(reqs[-1])
+            self.countIO(len(reqs), len(data), nread)
+            self.recordTransactions(reqs)
+            bufs = [req.reply for req in reqs]
+
+        return bufs
+
+    def readReplies(self, last_req):
+        '''last_req の応答が得られる（または締切を過ぎる）まで受信する
+
+        届いているバイトはまとめて読み出し，responseFramer で切り出す。
+
+        Return
+        ------
+        nread: int
+            読み出したバイト数
+        '''
+        nread = 0
+        while last_req.reply is None:
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            nread += len(data)
+            now = time.monotonic()
+            self.framer.feed(data, now)
+            if self.framer.expire(now):
+                # 遅れて届く応答を次の要求の応答と取り違えないように捨てる
+                self.ser.reset_input_buffer()
+        return nread
+
+    def waitResync(self):
+        '''応答の打ち切りのあと，遅れた応答が届かなくなるまで受信を捨てる'''
+        while self.framer.resyncing(time.monotonic()):
+            data = self.ser.read(max(1, self.ser.in_waiting))
+            self.framer.feed(data, time.monotonic())
+
+    def recordTransactions(self, reqs):
+        '''完了した要求（responseFramer.pendingReply）の時間を集計に加える'''
+        for req in reqs:
+            if req.received is None:
+                self.serial_stats.record(
+                        req.cmd, len(req.cmd) + 2, 0, req.write_time, None)
+            else:
+                self.serial_stats.record(
+                        req.cmd, len(req.cmd) + 2, len(req.reply) + 2,
+                        req.write_time, req.received - req.sent)
+
+    @staticmethod
+    def emptyIOStats():
+        '''通信量の集計用の辞書'''
+        return {'round_trips': 0, 'commands': 0,
+                'bytes_written': 0, 'bytes_read': 0}
+
+    def countIO(self, ncommands, nwritten, nread):
+        '''通信量を集計する
+
+        書き出し1回（ncommands > 0）を1往復として数える
+        '''
+        if ncommands > 0:
+            self.step_stats['round_trips'] += 1
+        self.step_stats['commands'] += ncommands
+        self.step_stats['bytes_written'] += nwritten
+        self.step_stats['bytes_read'] += nread
+
+    def endStep(self):
+        '''ステップ単位の通信量の集計を締める
+
+        Return
+        ------
+        stats: dict
+            前回の endStep() 以降の round_trips, commands,
+            bytes_written, bytes_read
+        '''
+        stats = self.step_stats
+        self.step_stats = self.emptyIOStats()
+        return stats
+
+    def phantomReply(self, cmd):
+        '''ファントムポートでの応答'''
+        return 'OK'
+
     def getInfo(self):
         ''' ステージの内部情報を取得する
 
@@ -113,34 +271,73 @@ class stage():
         '''
 
         if self.phantom_port is not True:
-            self.rom_version = self.sendCommand("?:V")
-            buf = self.sendCommand("?:PW")
-            dpp = re.split(r'\s*,\s*', buf)
-            self.distance_per_pulse = [float(v) for v in dpp]
-            buf = self.sendCommand("?:SW")
-            div = re.split(r'\s*,\s*', buf)
-            self.divisions = [int(d) for d in div]
+            self.rom_version, buf_pw, buf_sw = self.sendCommands(
+                    ["?:V", "?:PW", "?:SW"])
+            self.setInfo(buf_pw, buf_sw)
 
         logger.debug("rom_version:%s", self.rom_version)
         logger.debug("distance_per_pulse: %s", f"{self.distance_per_pulse}")
         logger.debug("divisions: %s", f"{self.divisions}")
 
+    def setInfo(self, buf_pw, buf_sw):
+        '''?:PW, ?:SW の応答を解釈して内部情報に代入する'''
+        dpp = re.split(r'\s*,\s*', buf_pw)
+        self.distance_per_pulse = [float(v) for v in dpp]
+        div = re.split(r'\s*,\s*', buf_sw)
+        self.divisions = [int(d) for d in div]
+
     def cmd_go(self):
         ''' G: を送出 '''
         cmd = "G:"
         self.sendCommand(cmd)
 
-    def moveTo(self, pos_x, pos_y, pos_z):
-        ''' 指定した位置に移動する '''
-        logger.debug("moveTo: %f %f %f", pos_x, pos_y, pos_z)
+    def moveToCommand(self, pos_x, pos_y, pos_z):
+        ''' 指定位置への絶対移動コマンド（A:W...）を生成する '''
         cmd = (f"A:W{self.toPulses(pos_x):+d}"
                f"{self.toPulses(pos_y):+d}"
                f"{self.toPulses(pos_z):+d}")
-        cmd = re.sub(r'([+-])', r'\1P', cmd)
-        self.sendCommand(cmd)
-        self.cmd_go()
+        return re.sub(r'([+-])', r'\1P', cmd)
+
+    def moveTo(self, pos_x, pos_y, pos_z):
+        ''' 指定した位置に移動する '''
+        logger.debug("moveTo: %f %f %f", pos_x, pos_y, pos_z)
+        self.sendCommands([self.moveToCommand(pos_x, pos_y, pos_z), "G:"])
         self.last_move_to = [pos_x, pos_y, pos_z]
 
+    def outputAndMoveTo(self, val, pos_x, pos_y, pos_z):
+        ''' I/O出力の一括設定と移動を1往復で行う
+
+        O:, A:, G: をまとめて送出する
+        '''
+        logger.debug("outputAndMoveTo: %04x %f %f %f", val, pos_x, pos_y, pos_z)
+        self.io_out = val & 0b1111
+        self.sendCommands([
+                self.outputCommand(self.io_out),
+                self.moveToCommand(pos_x, pos_y, pos_z),
+                "G:"])
+        self.last_move_to = [pos_x, pos_y, pos_z]
+
+    def setSpeed(self, axis, start_speed, max_speed, accel_time):
+        ''' 軸の速度を設定する（D: コマンド）
+
+        Parameters:
+        -----------
+            axis:
+                軸番号（1 | 2 | 3 | 4）
+            start_speed:
+                起動速度 [pps]
+            max_speed:
+                最高速度 [pps]
+            accel_time:
+                加減速時間 [s]
+        '''
+        cmd = (f"D:{axis}S{int(start_speed)}F{int(max_speed)}"
+               f"R{int(accel_time * 1000)}")
+        self.sendCommand(cmd)
+        self.start_speed[axis - 1] = int(start_speed)
+        self.max_speed[axis - 1] = int(max_speed)
+        self.accel_time[axis - 1] = int(accel_time * 1000) / 1000
+
     def stop(self):
         ''' ステージの移動を停止する '''
         cmd = "L:W"
@@ -150,6 +347,13 @@ class stage():
         '''現在の状態を問い合わせる'''
         ret = self.sendCommand("Q:")
         logger.debug("query(): %s", ret)
+        return self.parseQuery(ret)
+
+    def parseQuery(self, ret):
+        '''Q: の応答を辞書に変換する
+
+        応答が不正な場合は最後の移動先を現在位置とみなす
+        '''
         ret = re.sub(r'\s', '', ret)
         res = re.split(',', ret)
         if len(res) == 7:
@@ -187,6 +391,10 @@ class stage():
         '''Readyかどうか'''
         cmd = "!:"
         status = self.sendCommand(cmd)
+        return self.parseIsReady(status)
+
+    def parseIsReady(self, status):
+        '''!: の応答を解釈する'''
         if self.phantom_port is True:
             ret = True
         else:
@@ -204,8 +412,42 @@ class stage():
         '''
         logger.info("digitalWriteBulk(): val:%04x", val)
         self.io_out = val & 0b1111
-        cmd = f"O:{self.io_out}"
-        self.sendCommand(cmd)
+        self.sendCommand(self.outputCommand(self.io_out))
+
+    def outputAndMoveEncoded(self, val, move_data, pos):
+        ''' I/O出力の一括設定と，エンコード済みの移動コマンドを1往復で送出する
+
+        Parameters:
+        -----------
+            val:
+                 出力パターン
+            move_data:
+                 programCompiler で生成した A: と G: のバイト列
+            pos:
+                 移動先 (pos_x, pos_y, pos_z) [mm]
+        '''
+        self.io_out = val & 0b1111
+        self.sendEncoded(OUTPUT_COMMANDS[self.io_out] + move_data, 3)
+        self.last_move_to = list(pos)
+
+    def outputCommand(self, val):
+        '''出力状態を設定するコマンド（O:）を生成する'''
+        return f"O:{val & 0b1111}"
+
+    def outputPattern(self, ch, on_off):
+        '''ch の出力を on_off にしたときの出力パターンを返す
+
+        範囲外の ch であれば None
+        '''
+        if ch < 0 or ch > 4:
+            logger.error("digitalWrite(): ch is output of range:%d", ch )
+            return None
+        mask = 1 << (ch - 1)
+        if on_off == IO_ON:
+            o_pattern = self.io_out | mask
+        elif on_off == IO_OFF:
+            o_pattern = self.io_out & (~mask & 0b1111)
+        return o_pattern
 
     def digitalWrite(self, ch:int, on_off:int):
         '''I/Oコネクタへの出力状態を設定する
@@ -221,21 +463,36 @@ class stage():
                 stage.IO_OFF は出力トランジスタが OFF
         '''
         logger.info("digitalWrite(): ch:%d  on_off:%d", ch, on_off)
-        if ch < 0 or ch > 4:
-            logger.error("digitalWrite(): ch is output of range:%d", ch )
+        o_pattern = self.outputPattern(ch, on_off)
+        if o_pattern is None:
             return
-        mask = 1 << (ch - 1)
-        if on_off == IO_ON:
-            o_pattern = self.io_out | mask
-        elif on_off == IO_OFF:
-            o_pattern = self.io_out & (~mask & 0b1111)
         self.digitalWriteBulk(o_pattern)
 
 def get_device_list():
     '''シリアルポートのdevice名のリストを得る'''
+    # ポートの列挙は import も含めて時間がかかるので，使うときに読み込む
+    import serial.tools.list_ports
 
     device_list = []
     ports = serial.tools.list_ports.comports()
     for p in ports:
         device_list.append(p.device)
     return device_list
+
+
+def scanDevices():
+    '''get_device_list() を別スレッドで実行する（起動時にウィンドウの表示と並行させる）
+
+    Returns:
+        concurrent.futures.Future: 結果は get_device_list() のリスト
+    '''
+    fut = concurrent.futures.Future()
+
+    def scan():
+        try:
+            fut.set_result(get_device_list())
+        except Exception as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=scan, name='scanDevices', daemon=True).start()
+    return fut
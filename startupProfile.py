@@ -0,0 +1,94 @@
+''' 起動時間の計測（--startup-profile）
+'''
+
+import builtins
+import logging
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+IMPORT_REPORT_MIN = 0.002   # この時間 [s] 未満の import は表示しない
+
+
+class startupProfile():
+    '''import ごとの時間と起動の段階ごとの時間を記録する
+
+    install() の間は builtins.__import__ を置き換えて，まだ読み込まれて
+    いないモジュールの import にかかった時間（中で import したものを含む）を
+    記録する。mark(name) は前の mark からの時間を段階 name の時間とする。
+    '''
+
+    def __init__(self):
+        self.t_start = time.perf_counter()
+        self.t_mark = self.t_start
+        self.phases = []        # (段階の名前, 時間 [s])
+        self.imports = []       # [深さ, モジュール名, 時間 [s]]（import の順）
+        self.depth = 0
+        self.orig_import = None
+
+    def install(self):
+        '''import の計測を始める'''
+        if self.orig_import is None:
+            self.orig_import = builtins.__import__
+            builtins.__import__ = self.timedImport
+
+    def uninstall(self):
+        '''import の計測をやめる'''
+        if self.orig_import is not None:
+            builtins.__import__ = self.orig_import
+            self.orig_import = None
+
+    def timedImport(self, name, globals=None, locals=None, fromlist=(), level=0):
+        if level != 0 or name in sys.modules:
+            return self.orig_import(name, globals, locals, fromlist, level)
+        record = [self.depth, name, 0.0]
+        self.imports.append(record)
+        self.depth += 1
+        t0 = time.perf_counter()
+        try:
+            return self.orig_import(name, globals, locals, fromlist, level)
+        finally:
+            record[2] = time.perf_counter() - t0
+            self.depth -= 1
+
+    def mark(self, name):
+        '''前の mark() から今までを段階 name の時間として記録する'''
+        now = time.perf_counter()
+        self.phases.append((name, now - self.t_mark))
+        logger.debug("startup: %s: %.1f ms", name, (now - self.t_mark) * 1000)
+        self.t_mark = now
+
+    def elapsed(self):
+        '''計測を始めてからの時間 [s]'''
+        return time.perf_counter() - self.t_start
+
+    def report(self, min_time=IMPORT_REPORT_MIN):
+        '''計測結果（文字列）'''
+        lines = ['imports (cumulative, nested imports indented):']
+        for depth, name, t in self.imports:
+            if t >= min_time:
+                lines.append(f"  {t * 1000:8.1f} ms  {'  ' * depth}{name}")
+        lines.append('phases:')
+        total = 0.0
+        for name, t in self.phases:
+            total += t
+            lines.append(f"  {t * 1000:8.1f} ms  {name} (at {total * 1000:.1f} ms)")
+        return '\n'.join(lines)
+
+
+def test():
+    '''テストコード'''
+    profile = startupProfile()
+    profile.install()
+    import json         # 読み込み済みなら記録されない
+    import decimal
+    profile.uninstall()
+    profile.mark('imports')
+    time.sleep(0.01)
+    profile.mark('sleep')
+    print(profile.report(min_time=0.0))
+
+
+if __name__ == '__main__':
+    test()
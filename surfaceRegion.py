@@ -0,0 +1,143 @@
+''' 面の走査（SURFACE）のための平面と領域マスク
+'''
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+REGION_NONE = 'none'
+REGION_CIRCLE = 'circle'        # 'cx, cy, r'
+REGION_POLYGON = 'polygon'      # 'x1, y1; x2, y2; ...'
+
+REGIONS = (REGION_NONE, REGION_CIRCLE, REGION_POLYGON)
+
+
+def parsePoints(text, ndim):
+    ''''a, b; c, d; ...' の形の文字列を (n, ndim) の配列にする'''
+    points = []
+    for item in text.split(';'):
+        if item.strip() == '':
+            continue
+        values = [float(v) for v in item.split(',')]
+        if len(values) != ndim:
+            raise ValueError(f"parsePoints(): need {ndim} values: {item}")
+        points.append(values)
+    return np.array(points, dtype=float).reshape(-1, ndim)
+
+
+def parsePlane(text):
+    '''平面を決める3点 'x, y, z; x, y, z; x, y, z' を (3, 3) の配列にする
+
+    空なら None（水平面）
+    '''
+    if text.strip() == '':
+        return None
+    points = parsePoints(text, 3)
+    if len(points) != 3:
+        raise ValueError(f"parsePlane(): need 3 points: {text}")
+    return points
+
+
+def parseRegion(kind, text):
+    '''領域の種類と値の文字列から領域の定義（dict）を作る
+
+    Returns:
+        dict or None: {'type': 'circle', 'center': [cx, cy], 'radius': r} または
+            {'type': 'polygon', 'vertices': [[x1, y1], ...]}。REGION_NONE なら None
+    '''
+    if kind == REGION_NONE:
+        return None
+    if kind == REGION_CIRCLE:
+        values = parsePoints(text, 3)
+        if len(values) != 1 or values[0, 2] <= 0:
+            raise ValueError(f"parseRegion(): need 'cx, cy, r': {text}")
+        return {'type': kind, 'center': values[0, :2].tolist(),
+                'radius': float(values[0, 2])}
+    if kind == REGION_POLYGON:
+        vertices = parsePoints(text, 2)
+        if len(vertices) < 3:
+            raise ValueError(f"parseRegion(): need 3 or more vertices: {text}")
+        return {'type': kind, 'vertices': vertices.tolist()}
+    raise ValueError(f"parseRegion(): unknown region: {kind}")
+
+
+def planeHeight(points, u, v, axes=(0, 1)):
+    '''3点を通る平面上で，格子の座標 (u, v) に対応する残りの軸の座標
+
+    Args:
+        points (numpy.ndarray): (3, 3) の平面上の3点 [mm]
+        u, v (numpy.ndarray): 格子の2軸の座標 [mm]
+        axes (tuple): u, v の軸の番号（0: x, 1: y, 2: z）
+
+    Returns:
+        numpy.ndarray: 残りの軸の座標 [mm]
+    '''
+    p1, p2, p3 = np.asarray(points, dtype=float)
+    normal = np.cross(p2 - p1, p3 - p1)
+    scale = np.linalg.norm(p2 - p1) * np.linalg.norm(p3 - p1)
+    if scale == 0 or np.linalg.norm(normal) < 1e-9 * scale:
+        raise ValueError("planeHeight(): the points are on a line")
+    i, j = axes
+    d = 3 - i - j
+    if abs(normal[d]) < 1e-9 * np.linalg.norm(normal):
+        raise ValueError("planeHeight(): the plane is parallel to the scan axis")
+    return p1[d] - (normal[i] * (u - p1[i]) + normal[j] * (v - p1[j])) / normal[d]
+
+
+def circleMask(u, v, center, radius):
+    '''円の内側（周上を含む）'''
+    eps = 1e-9 * max(radius, 1.0)
+    return (u - center[0]) ** 2 + (v - center[1]) ** 2 <= (radius + eps) ** 2
+
+
+def polygonMask(u, v, vertices):
+    '''多角形の内側（偶奇規則。辺の上の点も含める）
+
+    辺ごとに全点をまとめて判定するので，ループは頂点数だけ。
+    '''
+    vertices = np.asarray(vertices, dtype=float)
+    inside = np.zeros(np.broadcast_shapes(np.shape(u), np.shape(v)), dtype=bool)
+    on_edge = np.zeros_like(inside)
+    eps = 1e-9 * max(np.ptp(vertices, axis=0).max(), 1.0)
+    x2, y2 = vertices[-1]
+    for x1, y1 in vertices:
+        crosses = (y1 > v) != (y2 > v)
+        dy = y2 - y1 if y2 != y1 else 1.0
+        x_cross = x1 + (x2 - x1) * (v - y1) / dy
+        inside ^= crosses & (u < x_cross)
+        # 辺までの距離
+        ex, ey = x2 - x1, y2 - y1
+        t = np.clip(((u - x1) * ex + (v - y1) * ey) / max(ex * ex + ey * ey, eps),
+                    0.0, 1.0)
+        on_edge |= (u - x1 - t * ex) ** 2 + (v - y1 - t * ey) ** 2 <= eps ** 2
+        x2, y2 = x1, y1
+    return inside | on_edge
+
+
+def regionMask(region, u, v):
+    '''領域の定義（parseRegion の結果）で格子の点を選ぶ（None なら全点）'''
+    if region is None:
+        return np.ones(np.broadcast_shapes(np.shape(u), np.shape(v)), dtype=bool)
+    if region['type'] == REGION_CIRCLE:
+        return circleMask(u, v, region['center'], region['radius'])
+    if region['type'] == REGION_POLYGON:
+        return polygonMask(u, v, region['vertices'])
+    raise ValueError(f"regionMask(): unknown region: {region['type']}")
+
+
+def test():
+    '''テストコード'''
+    uu, vv = np.meshgrid(np.arange(-10, 10.5, 0.5), np.arange(-10, 10.5, 0.5))
+    circle = regionMask(parseRegion(REGION_CIRCLE, '0, 0, 10'), uu, vv)
+    print(f"circle: {circle.mean():.3f} (pi/4 = {np.pi / 4:.3f})")
+    square = regionMask(
+            parseRegion(REGION_POLYGON, '-5, -5; 5, -5; 5, 5; -5, 5'), uu, vv)
+    print(f"square: {square.sum()} points")
+    zz = planeHeight(parsePlane('0, 0, 1; 10, 0, 2; 0, 10, 1'), uu, vv)
+    print(f"plane: z = {zz.min():.2f} ... {zz.max():.2f}")
+
+
+if __name__ == '__main__':
+    test()
@@ -0,0 +1,268 @@
+''' trajectoryPlot クラス
+'''
+
+import logging
+
+import numpy as np
+
+from PyQt5.QtWidgets import QWidget, QSizePolicy
+from PyQt5 import QtCore, QtGui
+from PyQt5.QtCore import Qt
+
+import program
+
+logger = logging.getLogger(__name__)
+
+
+class trajectoryPlot(QWidget):
+    '''プログラムの経路と通過した点を XY, XZ の投影で表示する Widget
+
+    経路はプログラムの全行を iterChunks() で読み，投影ごとに表示の
+    画素と同じ大きさのラスタに数えておく（点の多いところほど濃くする）。
+    描画はラスタの画像を貼るだけなので，時間は点の数によらず表示の大きさで決まる。
+    点が LINE_MAX_POINTS 以下のときだけ経路を線でも描く。
+
+    通過した点と現在位置は setPosition() で受け取る（runEngine の
+    EVENT_POSITION，つまり問い合わせの結果を渡すので，通信は増えない）。
+    '''
+    PROJECTIONS = (('X', 'Y', 0, 1), ('X', 'Z', 0, 2))     # (横軸, 縦軸, 軸の番号)
+    MARGIN = 14                 # 投影の枠の外側の余白 [px]
+    LINE_MAX_POINTS = 5000
+    REBIN_DELAY = 200           # 大きさやプログラムが変わってから数え直すまで [ms]
+    MIN_SPAN = 1e-3             # 範囲の幅の下限 [mm]
+    VISITED_RADIUS = 1          # 通過した点の大きさ（(2r + 1) 画素の正方形）
+    PLANNED_COLOR = (40, 90, 200)
+    VISITED_COLOR = (0, 170, 60)
+    POSITION_COLOR = QtGui.QColor(230, 0, 0)
+    FRAME_COLOR = QtGui.QColor(160, 160, 160)
+    SIZE_HINT = QtCore.QSize(360, 180)
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.program = None
+        self.lower = None           # 表示範囲 [mm]（3軸）
+        self.upper = None
+        self.panels = []            # 投影ごとの dict（rect, scale, origin, rgba, image）
+        self.visited = []           # 通過した点 [mm]
+        self.position = None        # 現在位置 [mm]
+        self.rebin_timer = QtCore.QTimer(self)
+        self.rebin_timer.setSingleShot(True)
+        self.rebin_timer.timeout.connect(self.rebin)
+        self.setSizePolicy(QSizePolicy.Expanding, QSizePolicy.Preferred)
+        self.setMinimumSize(self.SIZE_HINT / 2)
+
+    def sizeHint(self):
+        return self.SIZE_HINT
+
+    def setProgram(self, prog, clear=True):
+        '''表示するプログラムを替える（clear=False なら通過した点を残す）'''
+        self.program = prog
+        if clear:
+            self.visited = []
+        self.scheduleRebin()
+
+    def programChanged(self):
+        '''プログラムの行が編集されたか増えたときに呼ぶ'''
+        self.scheduleRebin()
+
+    def clearVisited(self):
+        '''通過した点を消す'''
+        self.visited = []
+        for panel in self.panels:
+            panel['rgba'][..., :] = panel['planned']
+        self.update()
+
+    def setPosition(self, pos_x, pos_y, pos_z, visited=False):
+        '''現在位置を更新する（visited=True なら通過した点として残す）'''
+        self.position = (pos_x, pos_y, pos_z)
+        if visited:
+            self.visited.append(self.position)
+            for panel in self.panels:
+                self.paintPoints(panel, np.array([self.position]), self.VISITED_COLOR)
+        self.update()
+
+    def scheduleRebin(self):
+        self.rebin_timer.start(self.REBIN_DELAY)
+
+    def resizeEvent(self, ev):
+        super().resizeEvent(ev)
+        self.scheduleRebin()
+
+    # -------- 数え上げ --------
+
+    def programBounds(self):
+        '''プログラムの位置の範囲（3軸の最小と最大）。行がなければ None
+
+        範囲の外の現在位置や通過した点は枠の縁に描く。
+        '''
+        lower = np.full(3, np.inf)
+        upper = np.full(3, -np.inf)
+        if self.program is not None and len(self.program) > 0:
+            for chunk in self.program.iterChunks():
+                if len(chunk) == 0:
+                    continue
+                pos = np.stack([np.asarray(chunk[ax], dtype=float)
+                                for ax in program.POSITION_COLUMNS], axis=1)
+                lower = np.minimum(lower, pos.min(axis=0))
+                upper = np.maximum(upper, pos.max(axis=0))
+        if not np.all(np.isfinite(lower)):
+            return None
+        # 幅のない軸（面の走査の z など）にも少し幅を持たせる
+        floor = max(float((upper - lower).max()) * 0.05, self.MIN_SPAN)
+        pad = np.maximum(floor - (upper - lower), 0) / 2
+        return lower - pad, upper + pad
+
+    def layoutPanels(self):
+        '''投影ごとの枠と mm から画素への換算を決める（縦横の縮尺は同じ）'''
+        self.panels = []
+        n = len(self.PROJECTIONS)
+        width = (self.width() - self.MARGIN * (n + 1)) // n
+        height = self.height() - 2 * self.MARGIN
+        if width < 8 or height < 8 or self.lower is None:
+            return
+        span = self.upper - self.lower
+        for i, (name_u, name_v, ax_u, ax_v) in enumerate(self.PROJECTIONS):
+            scale = min(width / span[ax_u], height / span[ax_v])
+            w = max(int(span[ax_u] * scale), 1)
+            h = max(int(span[ax_v] * scale), 1)
+            left = self.MARGIN + i * (width + self.MARGIN) + (width - w) // 2
+            top = self.MARGIN + (height - h) // 2
+            self.panels.append({
+                    'name': name_u + name_v,
+                    'axes': (ax_u, ax_v),
+                    'rect': QtCore.QRect(left, top, w, h),
+                    'scale': scale,
+                    'origin': (self.lower[ax_u], self.upper[ax_v]),
+                    'planned': np.zeros((h, w, 4), dtype=np.uint8),
+                    'rgba': np.zeros((h, w, 4), dtype=np.uint8),
+                    })
+
+    def pixels(self, panel, pos):
+        '''位置 (n, 3) [mm] を枠の中の画素の番号 (列, 行) にする'''
+        ax_u, ax_v = panel['axes']
+        h, w = panel['rgba'].shape[:2]
+        col = ((pos[:, ax_u] - panel['origin'][0]) * panel['scale']).astype(np.int64)
+        row = ((panel['origin'][1] - pos[:, ax_v]) * panel['scale']).astype(np.int64)
+        return np.clip(col, 0, w - 1), np.clip(row, 0, h - 1)
+
+    def paintPoints(self, panel, pos, color, radius=VISITED_RADIUS):
+        '''ラスタに点を (2 radius + 1) 画素の正方形で描く'''
+        col, row = self.pixels(panel, pos)
+        h, w = panel['rgba'].shape[:2]
+        offsets = np.arange(-radius, radius + 1)
+        rows = np.clip(row[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis], 0, h - 1)
+        cols = np.clip(col[:, np.newaxis, np.newaxis] + offsets, 0, w - 1)
+        panel['rgba'][rows, cols] = color + (255,)
+
+    def rebin(self):
+        '''プログラムの経路を投影ごとのラスタに数え直す'''
+        bounds = self.programBounds()
+        self.lower, self.upper = (None, None) if bounds is None else bounds
+        self.layoutPanels()
+        if not self.panels:
+            self.update()
+            return
+        counts = [np.zeros(panel['rgba'].shape[0] * panel['rgba'].shape[1], dtype=np.int64)
+                  for panel in self.panels]
+        nrows = len(self.program) if self.program is not None else 0
+        line = [] if 0 < nrows <= self.LINE_MAX_POINTS else None
+        if nrows > 0:
+            for chunk in self.program.iterChunks():
+                pos = np.stack([np.asarray(chunk[ax], dtype=float)
+                                for ax in program.POSITION_COLUMNS], axis=1)
+                for panel, count in zip(self.panels, counts):
+                    col, row = self.pixels(panel, pos)
+                    w = panel['rgba'].shape[1]
+                    count += np.bincount(row * w + col, minlength=len(count))
+                if line is not None:
+                    line.append(pos)
+        for panel, count in zip(self.panels, counts):
+            # 線で描く経路（LINE_MAX_POINTS 以下のとき）
+            panel['polygon'] = None
+            if line is not None and nrows > 1:
+                panel['polygon'] = QtGui.QPolygonF(
+                        [self.toWidget(panel, p) for p in np.concatenate(line)])
+            # 点の多いところほど不透明にする（対数）
+            alpha = np.zeros(len(count))
+            hit = count > 0
+            if hit.any():
+                alpha[hit] = 90 + 165 * np.log(count[hit]) / max(np.log(count.max()), 1)
+            planned = panel['planned'].reshape(-1, 4)
+            planned[:, :3] = self.PLANNED_COLOR
+            planned[:, 3] = alpha.astype(np.uint8)
+            panel['rgba'][...] = panel['planned']
+            if self.visited:
+                self.paintPoints(panel, np.array(self.visited), self.VISITED_COLOR)
+            h, w = panel['rgba'].shape[:2]
+            panel['image'] = QtGui.QImage(
+                    panel['rgba'].data, w, h, 4 * w, QtGui.QImage.Format_RGBA8888)
+        logger.debug("trajectoryPlot.rebin(): %d rows, %s", nrows,
+                     [panel['rgba'].shape[:2] for panel in self.panels])
+        self.update()
+
+    # -------- 描画 --------
+
+    def toWidget(self, panel, pos):
+        '''位置 [mm] を Widget の座標にする'''
+        ax_u, ax_v = panel['axes']
+        rect = panel['rect']
+        return QtCore.QPointF(
+                rect.left() + (pos[ax_u] - panel['origin'][0]) * panel['scale'],
+                rect.top() + (panel['origin'][1] - pos[ax_v]) * panel['scale'])
+
+    def paintEvent(self, ev):
+        painter = QtGui.QPainter(self)
+        painter.fillRect(self.rect(), self.palette().base())
+        for panel in self.panels:
+            rect = panel['rect']
+            painter.setPen(self.FRAME_COLOR)
+            painter.drawRect(rect.adjusted(-1, -1, 0, 0))
+            painter.drawText(rect.left(), rect.top() - 3, panel['name'])
+            if panel['polygon'] is not None:
+                painter.setPen(QtGui.QPen(QtGui.QColor(*self.PLANNED_COLOR, 120), 1))
+                painter.drawPolyline(panel['polygon'])
+            painter.drawImage(rect.topLeft(), panel['image'])
+            if self.position is not None:
+                center = self.toWidget(panel, self.position)
+                painter.setPen(QtGui.QPen(self.POSITION_COLOR, 2))
+                painter.setBrush(Qt.NoBrush)
+                painter.drawEllipse(center, 4, 4)
+        painter.end()
+
+
+def test():
+    '''テストコード（100万点のプログラムに現在位置を動かしながら表示する）'''
+    import sys
+    import time
+
+    from PyQt5.QtWidgets import QApplication
+
+    logging.basicConfig(level=logging.DEBUG)
+    app = QApplication(sys.argv)
+    plot = trajectoryPlot()
+    plot.resize(800, 400)
+    prog = program.lazyGridProgram((0, 99), (0, 99), (0, 99))
+    plot.setProgram(prog)
+    plot.show()
+    t0 = time.perf_counter()
+    plot.rebin()
+    print(f"rebin {len(prog)} rows: {time.perf_counter() - t0:.3f} s")
+    t0 = time.perf_counter()
+    for _ in range(100):
+        plot.repaint()
+    print(f"repaint: {(time.perf_counter() - t0) * 10:.2f} ms")
+
+    rows = iter(range(len(prog)))
+
+    def step():
+        param = prog.paramByIndex(next(rows))
+        plot.setPosition(param['pos_x'], param['pos_y'], param['pos_z'], visited=True)
+
+    timer = QtCore.QTimer()
+    timer.timeout.connect(step)
+    timer.start(10)
+    app.exec_()
+
+
+if __name__ == '__main__':
+    test()